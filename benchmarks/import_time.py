@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Import-time benchmark for the APM bootstrap
+
+Measures, in fresh interpreters, what loading the app's hooks costs a
+process:
+
+- lazy:  import erpnext_apm.hooks as a bench CLI command (bench migrate)
+         or a worker before its first job would
+- eager: the same plus what every process used to pay at hooks load -
+         importing elasticapm and the middleware and creating a client
+
+Run it from the app directory:
+    python benchmarks/import_time.py [--runs 20]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SNIPPET = """
+import json, sys, time
+started = time.perf_counter()
+import erpnext_apm.hooks
+if {eager}:
+	import erpnext_apm.wsgi
+	from erpnext_apm.apm import init_apm
+	init_apm()
+elapsed = time.perf_counter() - started
+print(json.dumps({{"ms": elapsed * 1000, "elasticapm": "elasticapm" in sys.modules}}))
+"""
+
+ENV = {
+	"ELASTIC_APM_SERVICE_NAME": "import-benchmark",
+	"ELASTIC_APM_SERVER_URL": "http://127.0.0.1:8200",
+	"ELASTIC_APM_DISABLE_SEND": "true",
+	"ELASTIC_APM_CENTRAL_CONFIG": "false",
+	"ELASTIC_APM_CLOUD_PROVIDER": "none",
+	"ERPNEXT_APM_PROCESS_ROLE": "cli",
+}
+
+
+def measure(eager, runs):
+	env = dict(os.environ, **ENV, PYTHONPATH=APP_PATH, PYTHONDONTWRITEBYTECODE="1")
+	code = SNIPPET.format(eager=eager)
+	timings, loaded = [], False
+	for _ in range(runs):
+		output = subprocess.check_output([sys.executable, "-c", code], env=env, cwd=APP_PATH)
+		result = json.loads(output.decode().strip().splitlines()[-1])
+		timings.append(result["ms"])
+		loaded = result["elasticapm"]
+	return statistics.median(timings), min(timings), loaded
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--runs", type=int, default=20)
+	args = parser.parse_args()
+
+	print(f"{'mode':<8}{'median ms':>12}{'min ms':>10}  elasticapm imported")
+	for name, eager in (("lazy", False), ("eager", True)):
+		median, minimum, loaded = measure(eager, args.runs)
+		print(f"{name:<8}{median:>12.1f}{minimum:>10.1f}  {loaded}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Per-job cost of APM in RQ work horses
+
+Runs a job that does nothing the way an RQ worker does: each job in a
+forked work horse that calls the before_job / after_job hooks and leaves
+through os._exit(). Compares the wall time per job with APM off and on,
+against a local intake that answers each batch after --delay-ms, the
+second time with a flush timeout long enough to wait for every answer
+(what the horse did before ERPNEXT_APM_JOB_FLUSH_TIMEOUT_MS).
+
+Run it from the app directory:
+    python benchmarks/job_overhead.py [--jobs 200] [--delay-ms 50] [--timeout-ms 100]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+METHOD = "erpnext.stock.reorder_item.reorder_item"
+
+
+def _horse():
+	from erpnext_apm import jobs
+
+	code = 1
+	try:
+		os.setsid()
+		jobs.before_job(method=METHOD, kwargs={})
+		jobs.after_job(method=METHOD)
+		code = 0
+	finally:
+		os._exit(code)
+
+
+def _worker(env, count, write):
+	"""Set up as an RQ worker with `env`, run `count` jobs and report ms/job"""
+	os.environ.update(env)
+	# Jobs whose events miss the timeout are expected here
+	logging.getLogger("erpnext_apm").setLevel(logging.ERROR)
+	from erpnext_apm import jobs
+
+	# The worker builds its runtime with its first job, not in a horse
+	jobs.before_job(method=METHOD, kwargs={})
+	jobs.after_job(method=METHOD)
+
+	started = time.perf_counter()
+	for _ in range(count):
+		pid = os.fork()
+		if pid == 0:
+			_horse()
+		_pid, status = os.waitpid(pid, 0)
+		if os.waitstatus_to_exitcode(status) != 0:
+			raise SystemExit("work horse failed")
+	os.write(write, f"{(time.perf_counter() - started) / count * 1000:.3f}".encode())
+	os._exit(0)
+
+
+def _measure(env, count):
+	read, write = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read)
+		try:
+			_worker(env, count, write)
+		finally:
+			os._exit(1)
+	os.close(write)
+	result = os.read(read, 64)
+	os.close(read)
+	os.waitpid(pid, 0)
+	return float(result) if result else float("nan")
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--jobs", type=int, default=200)
+	parser.add_argument("--delay-ms", type=float, default=50)
+	parser.add_argument("--timeout-ms", type=float, default=100)
+	args = parser.parse_args()
+
+	from tests.intake import Intake
+
+	intake = Intake()
+	intake.delay = args.delay_ms / 1000
+	base = {
+		"ELASTIC_APM_SERVICE_NAME": "erpnext-apm-benchmark",
+		"ELASTIC_APM_SERVER_URL": intake.url,
+		"ELASTIC_APM_CENTRAL_CONFIG": "false",
+		"ELASTIC_APM_CLOUD_PROVIDER": "none",
+		"ELASTIC_APM_METRICS_INTERVAL": "0ms",
+		"ERPNEXT_APM_PROCESS_ROLE": "worker",
+		"ERPNEXT_APM_WATCHDOG": "false",
+	}
+	runs = [
+		("off", {**base, "ELASTIC_APM_ENABLED": "false"}),
+		(f"on, {args.timeout_ms:g} ms timeout", {**base, "ERPNEXT_APM_JOB_FLUSH_TIMEOUT_MS": str(args.timeout_ms)}),
+		("on, waiting for the server", {**base, "ERPNEXT_APM_JOB_FLUSH_TIMEOUT_MS": "10000"}),
+	]
+	try:
+		print(f"intake answers after {args.delay_ms:g} ms")
+		print(f"{'APM':<34}{'ms/job':>10}")
+		for label, env in runs:
+			print(f"{label:<34}{_measure(env, args.jobs):>10.2f}")
+	finally:
+		intake.close()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Overhead of the sampling profiler on request threads
+
+Runs a CPU-bound stand-in for a request (pure Python work at a stack depth
+typical of a Frappe request) in a few threads, each registered with the
+profiler the way the WSGI middleware does it, and compares the work done
+with the profiler off and sampling at --hz.
+
+The two are measured in short alternating phases of the same run, with a
+new profiler started for each phase it is on, so that changes in machine
+load over the run hit both sides alike. The overhead reported is the median
+over the on phases, each against the off phases on either side of it. --hz 1
+gives an idea of the noise: the sampler ticks about once per phase.
+
+Run it from the app directory:
+    python benchmarks/profiler_overhead.py [--hz 100] [--threads 4] [--depth 60] [--max-depth 32]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def _work(depth):
+	"""Recurse to `depth` frames, then do a fixed amount of Python work"""
+	if depth:
+		return _work(depth - 1)
+	total = 0
+	for i in range(2000):
+		total += i * i % 7
+	return total
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--hz", type=float, default=100)
+	parser.add_argument("--threads", type=int, default=4)
+	parser.add_argument("--depth", type=int, default=60)
+	parser.add_argument("--max-depth", type=int, default=32, help="ERPNEXT_APM_PROFILER_MAX_DEPTH")
+	parser.add_argument("--seconds", type=float, default=120)
+	parser.add_argument("--phase", type=float, default=0.5, help="seconds per on or off phase")
+	args = parser.parse_args()
+
+	from erpnext_apm.profiler import StackProfiler
+
+	# The profiler of the current phase, None while it is off
+	current = [None]
+	done = [0] * args.threads
+	stop = threading.Event()
+
+	def worker(index):
+		while not stop.is_set():
+			profiler = current[0]
+			if profiler is not None:
+				profiler.enter("GET /api/method/<method>")
+			for _ in range(10):
+				_work(args.depth)
+				done[index] += 1
+			if profiler is not None:
+				profiler.exit()
+
+	pool = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+	for thread in pool:
+		thread.start()
+
+	# Work per second of each phase, off phases at even indexes
+	rates = []
+	elapsed = 0.0
+	samples = ticks = busy = 0
+	# Starts and ends with an off phase, so each on phase is between two
+	for phase in range(round(args.seconds / args.phase) | 1):
+		on = phase % 2 == 1
+		if on:
+			current[0] = StackProfiler(hz=args.hz, max_depth=args.max_depth)
+			current[0].start()
+		before, started = sum(done), time.perf_counter()
+		time.sleep(args.phase)
+		duration = time.perf_counter() - started
+		rates.append((sum(done) - before) / duration)
+		if on:
+			elapsed += duration
+			profiler, current[0] = current[0], None
+			profiler.stop()
+			samples += profiler.samples
+			ticks += profiler.ticks
+			busy += profiler.busy
+
+	stop.set()
+	for thread in pool:
+		thread.join()
+
+	# Each on phase against the off phases on either side of it; the median
+	# leaves out phases hit by a burst of other load on the machine
+	overheads = sorted(
+		1 - rates[i] / ((rates[i - 1] + rates[i + 1]) / 2) for i in range(1, len(rates) - 1, 2)
+	)
+	off, on = statistics.mean(rates[0::2]), statistics.mean(rates[1::2])
+	print(f"{'profiler':<28}{'work/s':>12}")
+	print(f"{'off':<28}{off:>12.1f}")
+	print(f"{f'on, {args.hz:g} Hz':<28}{on:>12.1f}")
+	print(
+		f"overhead: {statistics.median(overheads) * 100:.2f}% median of {len(overheads)} phases, "
+		f"quartiles {overheads[len(overheads) // 4] * 100:.2f}% to {overheads[len(overheads) * 3 // 4] * 100:.2f}%"
+	)
+	print(
+		f"ticks/s: {ticks / elapsed:.1f}, samples/s: {samples / elapsed:.1f}, "
+		f"sampler busy: {busy / elapsed * 100:.2f}% of wall time, {busy / max(ticks, 1) * 1e6:.0f} us per tick"
+	)
+
+
+if __name__ == "__main__":
+	main()
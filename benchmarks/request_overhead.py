@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Per-request cost of the APM first-request setup
+
+Compares, per request, once the process has been set up:
+
+- hook:     dispatching the old before_request hook
+            (erpnext_apm.startup.ensure_apm_initialized) the way frappe.call
+            does it - resolve the dotted path, inspect the signature, call
+- wrapper:  the WSGI stand-in that now does first-request setup, minus the
+            application it wraps
+
+Uses frappe.call when Frappe is importable, otherwise the same steps inline.
+Run it from the app directory:
+    python benchmarks/request_overhead.py [--number 200000]
+"""
+
+import argparse
+import importlib
+import inspect
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Measure the bootstrap paths only, not the agent
+os.environ["ELASTIC_APM_ENABLED"] = "false"
+
+HOOK = "erpnext_apm.startup.ensure_apm_initialized"
+
+
+def _frappe_call(method):
+	"""frappe.call(method) without Frappe: resolve, inspect and call"""
+	module, attr = method.rsplit(".", 1)
+	fn = getattr(importlib.import_module(module), attr)
+	inspect.getfullargspec(fn)
+	return fn()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--number", type=int, default=200000)
+	args = parser.parse_args()
+
+	try:
+		import frappe
+
+		call = frappe.call
+	except ImportError:
+		call = _frappe_call
+
+	from erpnext_apm.bootstrap import DeferredElasticAPMWSGI
+
+	def application(environ, start_response):
+		return None
+
+	wrapper = DeferredElasticAPMWSGI(application)
+	environ = {"PATH_INFO": "/api/method/ping", "REQUEST_METHOD": "GET"}
+	wrapper(environ, None)
+	call(HOOK)
+
+	number = args.number
+	baseline = min(timeit.repeat(lambda: application(environ, None), number=number, repeat=5))
+	hook = min(timeit.repeat(lambda: call(HOOK), number=number, repeat=5))
+	wrapped = min(timeit.repeat(lambda: wrapper(environ, None), number=number, repeat=5))
+
+	print(f"{'path':<34}{'ns/request':>12}")
+	print(f"{'before_request hook (removed)':<34}{hook / number * 1e9:>12.0f}")
+	print(f"{'WSGI stand-in, steady state':<34}{(wrapped - baseline) / number * 1e9:>12.0f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -6,8 +6,6 @@ Run this in your gunicorn pod to verify APM is working:
     bench --site erp.localhost execute erpnext_apm.check_apm.check_status
 """
 
-import frappe
-
 
 def check_status():
 	"""Check APM status and print results"""
@@ -97,6 +95,98 @@ def check_status():
 	except ImportError:
 		print("   ✗ elastic-apm not installed")
 	
+	# 5-7 are kept per worker process. bench execute is a process of its own,
+	# so the workers' state is read from the files they publish
+	from erpnext_apm.apm import get_config
+	from erpnext_apm.bootstrap import boot_info
+
+	# Missing required variables are reported under 1.
+	config = get_config(required=False)
+	workers = []
+	if config.get("PROMETHEUS"):
+		from erpnext_apm.prometheus import read_workers
+
+		workers = read_workers(config["PROMETHEUS_DIR"])
+	if workers:
+		print(f"\n   Workers publishing to {config['PROMETHEUS_DIR']} (as of their last request):")
+	else:
+		print("\n   No worker metrics files: the pipeline and breaker below are those of this")
+		print("   bench execute process, NOT of the web workers. Set ERPNEXT_APM_PROMETHEUS=true")
+		print("   for the workers to publish their own")
+
+	def worker_label(values):
+		return f"pid {values['pid']}" + ("" if values["live"] else " (exited)")
+
+	scope = "" if workers else " (this bench execute process)"
+
+	# 5. Event pipeline
+	print(f"\n5. Event Pipeline{scope}:")
+	try:
+		if workers:
+			for values in workers:
+				buffered = f"buffered {values['pipeline_buffered']}, " if values["live"] else ""
+				print(
+					f"   {worker_label(values)}: {buffered}enqueued {values['pipeline_enqueued']}, "
+					f"flushed {values['pipeline_flushed']}, dropped {values['pipeline_dropped']} "
+					f"({values['pipeline_dropped_unsampled']} unsampled), held back {values['pipeline_held_back']}"
+				)
+		else:
+			stats = boot_info()["pipeline"]
+			if stats:
+				print(f"   Buffered: {stats['buffered']}/{stats['capacity']}")
+				print(f"   Enqueued: {stats['enqueued']}, flushed: {stats['flushed']}")
+				print(f"   Dropped: {stats['dropped']} ({stats['dropped_unsampled']} unsampled)")
+				print(f"   Held back (transport queue full): {stats['held_back']}")
+			else:
+				print("   Pipeline not active in this process")
+	except Exception as e:
+		print(f"   ✗ Error: {e}")
+
+	# 6. Circuit breaker
+	print(f"\n6. Circuit Breaker{scope}:")
+	try:
+		if workers:
+			live = [values for values in workers if values["live"]]
+			open_workers = sum(values["breaker_open"] for values in live)
+			mark = "✓" if not open_workers else "✗"
+			print(f"   {mark} Open in {open_workers} of {len(live)} live workers")
+			for values in workers:
+				state = ("open" if values["breaker_open"] else "closed") + ", " if values["live"] else ""
+				print(
+					f"   {worker_label(values)}: {state}trips {values['breaker_trips']}, "
+					f"requests passed through {values['breaker_shed']}"
+				)
+		else:
+			stats = boot_info()["breaker"]
+			if stats:
+				mark = "✓" if stats["state"] == "closed" else "✗"
+				print(f"   {mark} State: {stats['state']}")
+				print(f"   Consecutive transport failures: {stats['consecutive_failures']}")
+				print(f"   Trips: {stats['trips']}, requests passed through: {stats['shed']}")
+				if stats["state"] != "closed":
+					print(f"   Next probe in: {stats['retry_in_s']}s (backoff {stats['backoff_s']:.0f}s)")
+			else:
+				print("   Circuit breaker not active in this process")
+	except Exception as e:
+		print(f"   ✗ Error: {e}")
+
+	# 7. Disk spool, read from the spool files themselves
+	print("\n7. Disk Spool:")
+	try:
+		if config.get("SPOOL"):
+			from erpnext_apm.spool import read_spools
+
+			spools = read_spools(config["SPOOL_DIR"])
+			for spool in spools:
+				owner = "live worker" if spool["live"] else "exited worker, replayed by another"
+				print(f"   {spool['path']} ({owner}): {spool['bytes_used']}/{spool['capacity']} bytes waiting")
+			if not spools:
+				print(f"   No spool files in {config['SPOOL_DIR']}")
+		else:
+			print("   Disk spool not enabled (ERPNEXT_APM_SPOOL)")
+	except Exception as e:
+		print(f"   ✗ Error: {e}")
+
 	print("\n" + "=" * 60)
 	print("Check complete!")
 	print("=" * 60)
@@ -7,12 +7,40 @@ Elastic APM initialization and configuration
 
 import os
 import logging
+import tempfile
 
 logger = logging.getLogger(__name__)
 
-# Global APM client instance
-_apm_client = None
-_initialized = False
+# Request headers and WSGI environ keys captured in "lazy" context mode
+DEFAULT_CAPTURE_HEADERS = (
+	"Host",
+	"User-Agent",
+	"Accept",
+	"Content-Type",
+	"Content-Length",
+	"Referer",
+	"X-Forwarded-For",
+	"X-Forwarded-Proto",
+	"X-Frappe-Site-Name",
+	"X-Request-Id",
+)
+DEFAULT_CAPTURE_ENVIRON = (
+	"REMOTE_ADDR",
+	"SERVER_NAME",
+	"SERVER_PORT",
+	"SERVER_PROTOCOL",
+	"SCRIPT_NAME",
+)
+
+# Process roles that are traced; bench migrate, console etc. are not
+DEFAULT_PROCESS_ROLES = ("web", "worker", "scheduler")
+
+# Per-route sample rates, matched in order against the route template
+DEFAULT_SAMPLE_RATES = (
+	("/assets/*", 0.01),
+	("/api/method/frappe.realtime.*", 0.01),
+	("/api/method/frappe.desk.query_report.run", 1.0),
+)
 
 
 def is_apm_enabled():
@@ -21,17 +49,93 @@ def is_apm_enabled():
 	return enabled in ("true", "1", "yes", "on")
 
 
-def get_config():
-	"""Get APM configuration from environment variables"""
+def _get_env_list(name, default):
+	"""Read a comma separated environment variable into a tuple"""
+	value = os.getenv(name)
+	if value is None:
+		return tuple(default)
+	return tuple(item.strip() for item in value.split(",") if item.strip())
+
+
+def _get_env_choice(name, choices, default):
+	"""Read an environment variable that must be one of `choices`"""
+	value = os.getenv(name, default).strip().lower()
+	if value not in choices:
+		logger.warning(f"Invalid {name}={value!r}, expected one of {', '.join(choices)}; using {default!r}")
+		return default
+	return value
+
+
+def _get_env_int(name, default):
+	"""Read an integer environment variable, falling back to the default"""
+	try:
+		return int(os.getenv(name, default))
+	except ValueError:
+		logger.warning(f"Invalid integer for {name}, using default {default}")
+		return default
+
+
+def _get_env_float(name, default):
+	"""Read a float environment variable, falling back to the default"""
+	try:
+		return float(os.getenv(name, default))
+	except ValueError:
+		logger.warning(f"Invalid number for {name}, using default {default}")
+		return default
+
+
+def _get_env_floats(name, default):
+	"""Read a comma separated list of numbers into a tuple"""
+	try:
+		return tuple(float(item) for item in _get_env_list(name, default))
+	except ValueError:
+		logger.warning(f"Invalid number in {name}, using default {default}")
+		return tuple(default)
+
+
+def _get_env_bool(name, default):
+	"""Read a boolean environment variable"""
+	value = os.getenv(name)
+	if value is None:
+		return default
+	return value.lower() in ("true", "1", "yes", "on")
+
+
+def _get_env_rates(name, default):
+	"""Read "pattern=rate" pairs from a comma separated environment variable"""
+	value = os.getenv(name)
+	if value is None:
+		return tuple(default)
+
+	rates = []
+	for item in value.split(","):
+		pattern, sep, rate = item.strip().rpartition("=")
+		if not sep or not pattern:
+			continue
+		try:
+			rates.append((pattern.strip(), float(rate)))
+		except ValueError:
+			logger.warning(f"Invalid sample rate {item!r} in {name}, ignoring")
+	return tuple(rates)
+
+
+def get_config(required=True):
+	"""
+	Get APM configuration from environment variables
+
+	Raises ValueError when ELASTIC_APM_SERVICE_NAME or ELASTIC_APM_SERVER_URL
+	is not set, unless `required` is False, as for diagnostics that still
+	need the ERPNEXT_APM_* settings.
+	"""
 	config = {}
 	
 	# Required
 	service_name = os.getenv("ELASTIC_APM_SERVICE_NAME")
 	server_url = os.getenv("ELASTIC_APM_SERVER_URL")
 	
-	if not service_name:
+	if not service_name and required:
 		raise ValueError("ELASTIC_APM_SERVICE_NAME environment variable is required")
-	if not server_url:
+	if not server_url and required:
 		raise ValueError("ELASTIC_APM_SERVER_URL environment variable is required")
 	
 	config["SERVICE_NAME"] = service_name
@@ -55,38 +159,160 @@ def get_config():
 	config["FRAMEWORK_NAME"] = "frappe"
 	config["FRAMEWORK_VERSION"] = "14+"
 	
-	return config
+	# Request context capture: "lazy" (allowlisted, sampled transactions only),
+	# "eager" (every header and environ key on every request) or "off"
+	config["CAPTURE_CONTEXT"] = os.getenv("ERPNEXT_APM_CAPTURE_CONTEXT", "lazy").lower()
+	config["CAPTURE_HEADERS"] = _get_env_list("ERPNEXT_APM_CAPTURE_HEADERS", DEFAULT_CAPTURE_HEADERS)
+	config["CAPTURE_ENVIRON"] = _get_env_list("ERPNEXT_APM_CAPTURE_ENVIRON", DEFAULT_CAPTURE_ENVIRON)
+	
+	# Transaction naming: route template cache size and distinct name cap
+	config["ROUTE_CACHE_SIZE"] = _get_env_int("ERPNEXT_APM_ROUTE_CACHE_SIZE", 4096)
+	config["MAX_TRANSACTION_NAMES"] = _get_env_int("ERPNEXT_APM_MAX_TRANSACTION_NAMES", 500)
+	
+	# Head sampling: per-route rates, per-worker transactions per second budget
+	# (0 = unlimited) and the always-keep rule for errors and slow requests
+	config["SAMPLE_RATE"] = _get_env_float("ERPNEXT_APM_SAMPLE_RATE", 1.0)
+	config["SAMPLE_RATES"] = _get_env_rates("ERPNEXT_APM_SAMPLE_RATES", DEFAULT_SAMPLE_RATES)
+	config["MAX_TPS"] = _get_env_float("ERPNEXT_APM_MAX_TPS", 0)
+	config["SLOW_THRESHOLD_MS"] = _get_env_float("ERPNEXT_APM_SLOW_THRESHOLD_MS", 2000)
+	config["KEEP_ERRORS"] = _get_env_bool("ERPNEXT_APM_KEEP_ERRORS", True)
 
+	# Multi-site benches: label transactions with the site, cap the distinct
+	# sites per worker and give each site its own sampling budget (0 = none)
+	config["SITE_TAGGING"] = _get_env_bool("ERPNEXT_APM_SITE_TAGGING", True)
+	config["MAX_SITES"] = _get_env_int("ERPNEXT_APM_MAX_SITES", 200)
+	config["SITE_MAX_TPS"] = _get_env_float("ERPNEXT_APM_SITE_MAX_TPS", 0)
+	
+	# Tail sampling: trace requests rejected by the head sampler into a bounded
+	# buffer and only send them if they were slow, failed or won the keep rate
+	config["TAIL_SAMPLING"] = _get_env_bool("ERPNEXT_APM_TAIL_SAMPLING", False)
+	config["TAIL_KEEP_RATE"] = _get_env_float("ERPNEXT_APM_TAIL_KEEP_RATE", 0.0)
+	config["TAIL_MAX_SPANS"] = _get_env_int("ERPNEXT_APM_TAIL_MAX_SPANS", 500)
+	config["TAIL_MAX_BUFFERED_SPANS"] = _get_env_int("ERPNEXT_APM_TAIL_MAX_BUFFERED_SPANS", 20000)
+	
+	# Database spans for frappe.db.sql / get_value / get_all
+	config["DB_SPANS"] = _get_env_bool("ERPNEXT_APM_DB_SPANS", True)
+	config["SQL_FINGERPRINT_CACHE_SIZE"] = _get_env_int("ERPNEXT_APM_SQL_FINGERPRINT_CACHE_SIZE", 1024)
+	
+	# N+1 detection: identical query fingerprints or get_doc fetches per
+	# transaction before they are folded into one aggregated span (0 = off)
+	config["N_PLUS_ONE_THRESHOLD"] = _get_env_int("ERPNEXT_APM_N_PLUS_ONE_THRESHOLD", 10)
+	config["N_PLUS_ONE_MAX_PATTERNS"] = _get_env_int("ERPNEXT_APM_N_PLUS_ONE_MAX_PATTERNS", 256)
+	
+	# Span compression, done by the agent: consecutive exit spans under the same
+	# parent are merged when they are an exact match (same name) or of the same
+	# kind and each lasted at most the duration for that strategy
+	config["SPAN_COMPRESSION"] = _get_env_bool("ERPNEXT_APM_SPAN_COMPRESSION", True)
+	config["SPAN_COMPRESSION_MAX_DURATION_MS"] = _get_env_float(
+		"ERPNEXT_APM_SPAN_COMPRESSION_MAX_DURATION_MS", 50
+	)
+	config["SPAN_COMPRESSION_SAME_KIND_MAX_DURATION_MS"] = _get_env_float(
+		"ERPNEXT_APM_SPAN_COMPRESSION_SAME_KIND_MAX_DURATION_MS", 0
+	)
+	
+	# Longest an RQ work horse waits for its job's events to be sent before it exits
+	config["JOB_FLUSH_TIMEOUT_MS"] = _get_env_float("ERPNEXT_APM_JOB_FLUSH_TIMEOUT_MS", 100)
+	
+	# Scheduler tick transactions and metrics for bench schedule
+	config["SCHEDULER_TRACING"] = _get_env_bool("ERPNEXT_APM_SCHEDULER_TRACING", True)
+	
+	# Bounded event pipeline in front of the agent's transport
+	config["PIPELINE"] = _get_env_bool("ERPNEXT_APM_PIPELINE", True)
+	config["PIPELINE_CAPACITY"] = _get_env_int("ERPNEXT_APM_PIPELINE_CAPACITY", 2048)
+	config["PIPELINE_BATCH_SIZE"] = _get_env_int("ERPNEXT_APM_PIPELINE_BATCH_SIZE", 256)
+	config["PIPELINE_FLUSH_INTERVAL_MS"] = _get_env_int("ERPNEXT_APM_PIPELINE_FLUSH_INTERVAL_MS", 1000)
+	config["PIPELINE_DROP_POLICY"] = _get_env_choice(
+		"ERPNEXT_APM_PIPELINE_DROP_POLICY", ("drop_unsampled", "drop_oldest"), "drop_unsampled"
+	)
+	
+	# Per-route latency histograms of all requests, sent as metrics
+	config["ROUTE_HISTOGRAMS"] = _get_env_bool("ERPNEXT_APM_ROUTE_HISTOGRAMS", True)
+	
+	# Circuit breaker: stop tracing after consecutive transport failures
+	config["BREAKER"] = _get_env_bool("ERPNEXT_APM_BREAKER", True)
+	config["BREAKER_FAILURES"] = _get_env_int("ERPNEXT_APM_BREAKER_FAILURES", 5)
+	config["BREAKER_BACKOFF_MS"] = _get_env_int("ERPNEXT_APM_BREAKER_BACKOFF_MS", 30000)
+	config["BREAKER_MAX_BACKOFF_MS"] = _get_env_int("ERPNEXT_APM_BREAKER_MAX_BACKOFF_MS", 300000)
+	
+	# Disk spool for batches the APM server could not take
+	config["SPOOL"] = _get_env_bool("ERPNEXT_APM_SPOOL", False)
+	config["SPOOL_DIR"] = os.getenv(
+		"ERPNEXT_APM_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "erpnext-apm-spool")
+	)
+	config["SPOOL_SIZE_MB"] = _get_env_float("ERPNEXT_APM_SPOOL_SIZE_MB", 64)
+	config["SPOOL_REPLAY_RATE"] = _get_env_float("ERPNEXT_APM_SPOOL_REPLAY_RATE", 5)
 
-def init_apm(force=False):
-	"""Initialize Elastic APM client"""
-	global _apm_client, _initialized
-	
-	if _initialized and not force:
-		# If already initialized but client is None, something went wrong
-		# Allow re-initialization if client is None
-		if _apm_client is None and not force:
-			logger.warning("APM was marked as initialized but client is None. Attempting re-initialization...")
-			_initialized = False
-		else:
-			return _apm_client
-	
-	if not is_apm_enabled():
-		logger.info("Elastic APM is disabled (ELASTIC_APM_ENABLED=false)")
-		_initialized = True
-		return None
+	# Prometheus metrics of the web workers, summed across workers from one
+	# memory-mapped file each; served on a separate port and/or, given a
+	# bearer token, on a path of the site itself
+	config["PROMETHEUS"] = _get_env_bool("ERPNEXT_APM_PROMETHEUS", False)
+	config["PROMETHEUS_DIR"] = os.getenv(
+		"ERPNEXT_APM_PROMETHEUS_DIR", os.path.join(tempfile.gettempdir(), "erpnext-apm-metrics")
+	)
+	config["PROMETHEUS_PORT"] = _get_env_int("ERPNEXT_APM_PROMETHEUS_PORT", 0)
+	config["PROMETHEUS_HOST"] = os.getenv("ERPNEXT_APM_PROMETHEUS_HOST", "0.0.0.0")
+	config["PROMETHEUS_PATH"] = os.getenv("ERPNEXT_APM_PROMETHEUS_PATH", "/metrics")
+	config["PROMETHEUS_TOKEN"] = os.getenv("ERPNEXT_APM_PROMETHEUS_TOKEN")
+
+	# Sampling profiler of the web workers' request threads
+	config["PROFILER"] = _get_env_bool("ERPNEXT_APM_PROFILER", False)
+	config["PROFILER_HZ"] = _get_env_float("ERPNEXT_APM_PROFILER_HZ", 100)
+	config["PROFILER_MAX_DEPTH"] = _get_env_int("ERPNEXT_APM_PROFILER_MAX_DEPTH", 32)
+	config["PROFILER_MAX_STACKS"] = _get_env_int("ERPNEXT_APM_PROFILER_MAX_STACKS", 1000)
+	config["PROFILER_DIR"] = os.getenv(
+		"ERPNEXT_APM_PROFILER_DIR", os.path.join(tempfile.gettempdir(), "erpnext-apm-profiles")
+	)
+	config["PROFILER_EXPORT_INTERVAL"] = _get_env_float("ERPNEXT_APM_PROFILER_EXPORT_INTERVAL", 60)
+	
+	# Watchdog reporting the stack of web requests still running past each threshold
+	config["WATCHDOG"] = _get_env_bool("ERPNEXT_APM_WATCHDOG", True)
+	config["WATCHDOG_THRESHOLDS_MS"] = _get_env_floats("ERPNEXT_APM_WATCHDOG_THRESHOLDS_MS", (10000, 60000))
+	config["WATCHDOG_INTERVAL_MS"] = _get_env_int("ERPNEXT_APM_WATCHDOG_INTERVAL_MS", 1000)
+	
+	# Memory accounting: RSS delta and tracemalloc allocations of a fraction of
+	# web requests, aggregated per route, and the worker RSS trend
+	config["MEMORY_TRACKING"] = _get_env_bool("ERPNEXT_APM_MEMORY_TRACKING", False)
+	config["MEMORY_SAMPLE_RATE"] = _get_env_float("ERPNEXT_APM_MEMORY_SAMPLE_RATE", 0.001)
+	config["MEMORY_TRACEMALLOC"] = _get_env_bool("ERPNEXT_APM_MEMORY_TRACEMALLOC", True)
+	
+	# Garbage collector pause time, as transaction labels and metrics
+	config["GC_METRICS"] = _get_env_bool("ERPNEXT_APM_GC_METRICS", True)
 	
+	# Request queueing time from the front proxy's X-Request-Start/X-Queue-Start
+	config["QUEUE_TIME"] = _get_env_bool("ERPNEXT_APM_QUEUE_TIME", True)
+	
+	# Requests in flight and thread utilization per web worker and gunicorn pool;
+	# the thread count is read from the gunicorn command line when 0
+	config["CONCURRENCY_METRICS"] = _get_env_bool("ERPNEXT_APM_CONCURRENCY_METRICS", True)
+	config["CONCURRENCY_DIR"] = os.getenv("ERPNEXT_APM_CONCURRENCY_DIR")
+	config["WORKER_THREADS"] = _get_env_int("ERPNEXT_APM_WORKER_THREADS", 0)
+	
+	# Process roles to trace, and an explicit role for this process when it
+	# cannot be told from the command line
+	config["PROCESS_ROLES"] = _get_env_list("ERPNEXT_APM_PROCESS_ROLES", DEFAULT_PROCESS_ROLES)
+	config["PROCESS_ROLE"] = os.getenv("ERPNEXT_APM_PROCESS_ROLE")
+	
+	return config
+
+
+def create_client(config=None):
+	"""
+	Create a new elasticapm.Client
+
+	Use init_apm()/get_client() instead: the bootstrap makes sure there is
+	only one client per process.
+	"""
 	try:
 		import elasticapm
 	except ImportError:
 		logger.error(
 			"elastic-apm package not found. Install it with: pip install elastic-apm"
 		)
-		_initialized = True
 		return None
 	
 	try:
-		config = get_config()
+		if config is None:
+			config = get_config()
 		logger.debug(f"APM config loaded: SERVICE_NAME={config.get('SERVICE_NAME')}, SERVER_URL={config.get('SERVER_URL')}")
 		
 		# Build config dict for elasticapm.Client
@@ -109,43 +335,54 @@ def init_apm(force=False):
 		if "SERVICE_NODE_NAME" in config:
 			client_config["SERVICE_NODE_NAME"] = config["SERVICE_NODE_NAME"]
 		
+		# Span compression is the agent's; ELASTIC_APM_SPAN_COMPRESSION_* still win
+		client_config["SPAN_COMPRESSION_ENABLED"] = config.get("SPAN_COMPRESSION", True)
+		client_config["SPAN_COMPRESSION_EXACT_MATCH_MAX_DURATION"] = (
+			f"{config.get('SPAN_COMPRESSION_MAX_DURATION_MS', 50):g}ms"
+		)
+		client_config["SPAN_COMPRESSION_SAME_KIND_MAX_DURATION"] = (
+			f"{config.get('SPAN_COMPRESSION_SAME_KIND_MAX_DURATION_MS', 0):g}ms"
+		)
+		
 		logger.debug(f"Creating Elastic APM client with config keys: {list(client_config.keys())}")
 		
 		# Create client
 		# Note: Client automatically starts capturing when created
-		_apm_client = elasticapm.Client(client_config)
-		
-		if not _apm_client:
-			logger.error("elasticapm.Client() returned None - this should not happen")
-			_initialized = True
-			return None
+		client = elasticapm.Client(client_config)
 		
 		logger.info(
 			f"Elastic APM initialized: service={config['SERVICE_NAME']}, "
-			f"server={config['SERVER_URL']}, client={_apm_client}"
+			f"server={config['SERVER_URL']}, pid={os.getpid()}"
 		)
-		
-		# Verify client is ready
-		logger.info(f"APM client created successfully, service_name={_apm_client.config.service_name}")
-		
-		_initialized = True
-		return _apm_client
+		return client
 		
 	except ValueError as e:
 		# Configuration error - missing required vars
 		logger.error(f"APM configuration error: {e}. Check environment variables.")
-		_initialized = True
 		return None
 	except Exception as e:
 		logger.error(f"Failed to initialize Elastic APM: {e}", exc_info=True)
 		# Don't crash the application if APM fails
-		_initialized = True
 		return None
 
 
+def init_apm(force=False):
+	"""
+	Initialize the Elastic APM client for this process
+	
+	Returns the existing client if there is one. force=True only retries
+	a previously failed initialization; it never creates a second client.
+	"""
+	from erpnext_apm.bootstrap import get_client as _get_process_client
+	
+	return _get_process_client(retry=force)
+
+
 def get_client():
 	"""Get the initialized APM client"""
-	return _apm_client
+	from erpnext_apm.bootstrap import peek_client
+	
+	return peek_client()
 
 
 def capture_exception(exc_info=None, **kwargs):
@@ -160,13 +397,12 @@ def capture_exception(exc_info=None, **kwargs):
 		except Exception:
 			capture_exception()
 	"""
-	global _apm_client
-	
-	if not _apm_client:
+	client = get_client()
+	if not client:
 		return
 	
 	try:
-		_apm_client.capture_exception(exc_info=exc_info, **kwargs)
+		client.capture_exception(exc_info=exc_info, **kwargs)
 	except Exception as e:
 		# Don't let APM errors break the application
 		logger.debug(f"Failed to capture exception to APM: {e}")
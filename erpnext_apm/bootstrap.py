@@ -0,0 +1,511 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Single, fork-aware APM bootstrap
+
+setup() decides once per process whether it is traced, from its role (web,
+worker, scheduler or a CLI command like migrate or console), and if so puts
+cheap hooks in place: a stand-in for the WSGI application and the scheduler
+patch. It does not import elasticapm, so loading hooks.py costs next to
+nothing. The elasticapm client, the queue stages installed on it and the
+library patches are created by get_runtime() on first real use (the first
+request, job or scheduler tick) in the process that uses it.
+
+Under gunicorn --preload hooks are loaded in the master before fork, so the
+client must not exist yet at that point: each worker builds its own after
+fork. os.register_at_fork drops anything a child inherited, so there is
+exactly one client and one set of agent threads per process. The exception
+is an RQ worker: it builds its runtime before forking the first work horse,
+and every horse carries on with it instead of building its own per job.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_runtime = None
+# A failed attempt is not retried on every request; init_apm(force=True) can retry
+_attempted = False
+_setup_done = False
+_active = False
+_role = None
+_forks = 0
+_fork_locks_held = []
+
+# bench commands that run traced code; any other command is a CLI process
+_COMMAND_ROLES = {
+	"serve": "web",
+	"worker": "worker",
+	"worker-pool": "worker",
+	"schedule": "scheduler",
+}
+
+
+class Runtime:
+	"""The process' client and the stages installed on it"""
+
+	__slots__ = (
+		"boot_time",
+		"breaker",
+		"client",
+		"concurrency",
+		"config",
+		"gc",
+		"memory",
+		"pid",
+		"pipeline",
+		"profiler",
+		"prometheus",
+		"queue_time",
+		"route_latency",
+		"scheduler_metrics",
+		"spool",
+		"tail",
+		"watchdog",
+	)
+
+	def __init__(self, client, config):
+		self.client = client
+		self.config = config
+		self.pid = os.getpid()
+		self.boot_time = None
+		self.pipeline = None
+		self.breaker = None
+		self.spool = None
+		self.route_latency = None
+		self.queue_time = None
+		self.concurrency = None
+		self.memory = None
+		self.gc = None
+		self.prometheus = None
+		self.profiler = None
+		self.watchdog = None
+		self.tail = None
+		self.scheduler_metrics = None
+
+
+def _install_stages(runtime):
+	"""Install the per-client queue stages and metric sets"""
+	from erpnext_apm.breaker import install_circuit_breaker
+	from erpnext_apm.concurrency import ConcurrencyTracker, worker_threads
+	from erpnext_apm.gc_pauses import install_gc_monitor
+	from erpnext_apm.memory import MemoryTracker
+	from erpnext_apm.metrics import (
+		ConcurrencyMetricSet,
+		GcMetricSet,
+		MemoryMetricSet,
+		QueueTimeMetricSet,
+		RouteLatencyMetricSet,
+		SchedulerMetricSet,
+		register_metricset,
+	)
+	from erpnext_apm.pipeline import install_event_pipeline
+	from erpnext_apm.profiler import install_profiler
+	from erpnext_apm.prometheus import install_prometheus
+	from erpnext_apm.spool import install_spool
+	from erpnext_apm.tail_sampling import install_tail_sampler
+	from erpnext_apm.watchdog import install_watchdog
+
+	client, config = runtime.client, runtime.config
+
+	if config.get("BREAKER", True):
+		runtime.breaker = install_circuit_breaker(
+			client,
+			failure_threshold=config.get("BREAKER_FAILURES", 5),
+			backoff_ms=config.get("BREAKER_BACKOFF_MS", 30000),
+			max_backoff_ms=config.get("BREAKER_MAX_BACKOFF_MS", 300000),
+		)
+
+	if config.get("SPOOL"):
+		runtime.spool = install_spool(
+			client,
+			config.get("SPOOL_DIR"),
+			size_mb=config.get("SPOOL_SIZE_MB", 64),
+			replay_rate=config.get("SPOOL_REPLAY_RATE", 5),
+			breaker=runtime.breaker,
+		)
+
+	# Installed first so it sits directly in front of the transport
+	if config.get("PIPELINE", True):
+		runtime.pipeline = install_event_pipeline(
+			client,
+			capacity=config.get("PIPELINE_CAPACITY", 2048),
+			batch_size=config.get("PIPELINE_BATCH_SIZE", 256),
+			flush_interval_ms=config.get("PIPELINE_FLUSH_INTERVAL_MS", 1000),
+			drop_policy=config.get("PIPELINE_DROP_POLICY", "drop_unsampled"),
+		)
+
+	if config.get("TAIL_SAMPLING"):
+		runtime.tail = install_tail_sampler(
+			client,
+			latency_threshold_ms=config.get("SLOW_THRESHOLD_MS", 2000),
+			keep_rate=config.get("TAIL_KEEP_RATE", 0.0),
+			max_spans=config.get("TAIL_MAX_SPANS", 500),
+			max_buffered_spans=config.get("TAIL_MAX_BUFFERED_SPANS", 20000),
+		)
+
+	if config.get("ROUTE_HISTOGRAMS", True):
+		runtime.route_latency = register_metricset(client, RouteLatencyMetricSet)
+		if runtime.route_latency is not None:
+			runtime.route_latency.histograms.max_routes = config.get("MAX_TRANSACTION_NAMES", 500)
+
+	if config.get("QUEUE_TIME", True) and _role == "web":
+		runtime.queue_time = register_metricset(client, QueueTimeMetricSet)
+
+	if config.get("CONCURRENCY_METRICS", True) and _role == "web":
+		runtime.concurrency = register_metricset(client, ConcurrencyMetricSet)
+		if runtime.concurrency is not None:
+			try:
+				runtime.concurrency.tracker = ConcurrencyTracker(
+					config.get("CONCURRENCY_DIR"), capacity=config.get("WORKER_THREADS") or worker_threads()
+				)
+			except OSError as e:
+				logger.warning(f"Could not set up APM concurrency metrics: {e}")
+
+	if config.get("GC_METRICS", True):
+		runtime.gc = register_metricset(client, GcMetricSet)
+		if runtime.gc is not None:
+			install_gc_monitor(runtime.gc.monitor)
+
+	if config.get("MEMORY_TRACKING") and _role == "web":
+		runtime.memory = register_metricset(client, MemoryMetricSet)
+		if runtime.memory is not None:
+			runtime.memory.tracker = MemoryTracker(
+				sample_rate=config.get("MEMORY_SAMPLE_RATE", 0.001),
+				tracemalloc_enabled=config.get("MEMORY_TRACEMALLOC", True),
+				max_routes=config.get("MAX_TRANSACTION_NAMES", 500),
+			)
+
+	# Counted by the WSGI middleware, so only web workers have a metrics file
+	if config.get("PROMETHEUS") and _role == "web":
+		runtime.prometheus = install_prometheus(
+			runtime,
+			config.get("PROMETHEUS_DIR"),
+			max_routes=config.get("MAX_TRANSACTION_NAMES", 500),
+			port=config.get("PROMETHEUS_PORT", 0),
+			host=config.get("PROMETHEUS_HOST", "0.0.0.0"),
+		)
+
+	if config.get("PROFILER") and _role == "web":
+		runtime.profiler = install_profiler(config)
+
+	if config.get("WATCHDOG", True) and _role == "web":
+		runtime.watchdog = install_watchdog(runtime)
+
+	if config.get("SCHEDULER_TRACING", True):
+		runtime.scheduler_metrics = register_metricset(client, SchedulerMetricSet)
+
+
+def _create_runtime(retry=False):
+	global _runtime, _attempted
+
+	with _lock:
+		if _runtime is not None or (_attempted and not retry):
+			return _runtime
+		_attempted = True
+
+		from erpnext_apm.apm import create_client, get_config, is_apm_enabled
+
+		if not is_apm_enabled():
+			logger.info("Elastic APM is disabled (ELASTIC_APM_ENABLED=false)")
+			return None
+
+		started = time.perf_counter()
+		client = create_client()
+		if client is None:
+			return None
+
+		try:
+			from erpnext_apm.instrument import install_instrumentation
+
+			runtime = Runtime(client, get_config())
+			_install_stages(runtime)
+			install_instrumentation(runtime.config)
+		except Exception as e:
+			logger.error(f"Failed to set up APM runtime: {e}", exc_info=True)
+			return None
+
+		runtime.boot_time = time.perf_counter() - started
+		_runtime = runtime
+		logger.info(f"APM runtime ready in pid {runtime.pid} ({runtime.boot_time * 1000:.1f} ms)")
+		return runtime
+
+
+def get_runtime(retry=False):
+	"""Return this process' runtime, creating the client on first use"""
+	runtime = _runtime
+	if runtime is not None or (_attempted and not retry):
+		return runtime
+	return _create_runtime(retry=retry)
+
+
+def get_client(retry=False):
+	"""Return this process' client, creating it on first use"""
+	runtime = get_runtime(retry=retry)
+	return runtime.client if runtime is not None else None
+
+
+def peek_client():
+	"""Return this process' client without creating it"""
+	runtime = _runtime
+	return runtime.client if runtime is not None else None
+
+
+def detect_process_role(argv=None):
+	"""Tell the process role from the command line, None if it is not known"""
+	argv = sys.argv if argv is None else argv
+	if not argv:
+		return None
+
+	program = argv[0]
+	if "gunicorn" in program or "uwsgi" in os.path.basename(program):
+		return "web"
+	if "bench_helper" not in program:
+		# Any other server that has loaded the WSGI app before the hooks
+		return "web" if "frappe.app" in sys.modules else None
+
+	# python -m frappe.utils.bench_helper frappe [--site SITE] <command> ...
+	args = iter(argv[1:])
+	for arg in args:
+		if arg == "frappe":
+			continue
+		if arg.startswith("-"):
+			if arg == "--site":
+				next(args, None)
+			continue
+		return _COMMAND_ROLES.get(arg, "cli")
+	return "cli"
+
+
+def setup(role=None):
+	"""
+	Put the APM hooks in place if this process is traced
+
+	`role` is a hint from the calling entry point, used when the role cannot
+	be told from ERPNEXT_APM_PROCESS_ROLE or the command line. Idempotent once
+	a role is known; creates no client and does not import elasticapm, so it
+	is safe and cheap to run in a pre-fork master or at hooks load.
+	Returns whether this process is traced.
+	"""
+	global _setup_done, _active, _role
+
+	if _setup_done:
+		return _active
+
+	from erpnext_apm.apm import get_config, is_apm_enabled
+
+	if not is_apm_enabled():
+		logger.debug("APM is disabled, skipping setup")
+		_setup_done = True
+		return False
+
+	try:
+		config = get_config()
+	except ValueError as e:
+		logger.error(f"APM configuration error: {e}. Check environment variables.")
+		_setup_done = True
+		return False
+
+	role = config.get("PROCESS_ROLE") or detect_process_role() or role
+	if role is None:
+		# Decided by the first entry point that knows (a request or a job)
+		return False
+
+	_setup_done = True
+	_role = role
+	_active = role in config.get("PROCESS_ROLES", ())
+	if not _active:
+		logger.debug(f"APM not enabled for process role {role!r}")
+		return False
+
+	if role == "web":
+		_wrap_frappe_application()
+	elif role == "scheduler" and config.get("SCHEDULER_TRACING", True):
+		from erpnext_apm.scheduler import install_scheduler_instrumentation
+
+		try:
+			install_scheduler_instrumentation()
+		except Exception as e:
+			logger.error(f"Failed to install scheduler instrumentation: {e}", exc_info=True)
+
+	logger.info(f"APM enabled for process role {role!r}")
+	return True
+
+
+class DeferredElasticAPMWSGI:
+	"""
+	Stands in for ElasticAPMWSGI until the first request
+
+	Keeps elasticapm out of the process until a request is actually
+	served; the first call creates the runtime and the real middleware,
+	which then also replaces this object as frappe.app.application.
+	"""
+
+	_erpnext_apm_patched = True
+
+	def __init__(self, application):
+		self.application = application
+		self._middleware = None
+		self._lock = threading.Lock()
+
+	def _build(self):
+		with self._lock:
+			if self._middleware is not None:
+				return self._middleware
+
+			middleware = self.application
+			if get_runtime() is not None:
+				from erpnext_apm.wsgi import wrap_application
+
+				middleware = wrap_application(self.application)
+
+			frappe_app = sys.modules.get("frappe.app")
+			if frappe_app is not None and getattr(frappe_app, "application", None) is self:
+				frappe_app.application = middleware
+
+			self._middleware = middleware
+			return middleware
+
+	def __call__(self, environ, start_response):
+		middleware = self._middleware
+		if middleware is None:
+			middleware = self._build()
+		return middleware(environ, start_response)
+
+
+def _wrap_frappe_application():
+	"""Put the deferred APM middleware in front of frappe.app.application"""
+	try:
+		import frappe.app as frappe_app
+	except ImportError as e:
+		logger.debug(f"frappe.app not available ({e}), skipping WSGI wrapping")
+		return
+
+	application = getattr(frappe_app, "application", None)
+	if application is None:
+		logger.debug("frappe.app.application not found, skipping WSGI wrapping")
+		return
+
+	if getattr(application, "_erpnext_apm_patched", False):
+		return
+
+	frappe_app.application = DeferredElasticAPMWSGI(application)
+
+
+def boot_info():
+	"""Return per-process bootstrap diagnostics"""
+	runtime = _runtime
+	threads = threading.enumerate()
+	return {
+		"pid": os.getpid(),
+		"role": _role,
+		"active": _active,
+		"client": runtime is not None,
+		"client_pid": runtime.pid if runtime is not None else None,
+		"boot_time_ms": round(runtime.boot_time * 1000, 1) if runtime is not None else None,
+		"forks": _forks,
+		"threads": len(threads),
+		"agent_threads": sorted(t.name for t in threads if t.name.startswith(("eapm", "erpnext_apm"))),
+		"pipeline": runtime.pipeline.stats() if runtime is not None and runtime.pipeline is not None else None,
+		"breaker": runtime.breaker.stats() if runtime is not None and runtime.breaker is not None else None,
+		"spool": runtime.spool.spool.stats() if runtime is not None and runtime.spool is not None else None,
+		"prometheus": runtime.prometheus.stats() if runtime is not None and runtime.prometheus is not None else None,
+		"profiler": runtime.profiler.stats() if runtime is not None and runtime.profiler is not None else None,
+		"watchdog": runtime.watchdog.stats() if runtime is not None and runtime.watchdog is not None else None,
+		"concurrency": (
+			runtime.concurrency.tracker.stats()
+			if runtime is not None and runtime.concurrency is not None and runtime.concurrency.tracker is not None
+			else None
+		),
+	}
+
+
+def _keeps_runtime(runtime):
+	"""Whether a forked child carries on with the parent's runtime"""
+	# An RQ worker forks a work horse per job; building a client in each would
+	# cost more than most jobs. The spool's file and replay thread stay per process
+	return _role == "worker" and runtime.spool is None
+
+
+def _fork_locks(runtime):
+	"""Locks the runtime's background threads take, held across a fork"""
+	locks = []
+	if runtime.pipeline is not None:
+		locks.append(runtime.pipeline._lock)
+	if runtime.breaker is not None:
+		locks.append(runtime.breaker._lock)
+	event_queue = getattr(getattr(runtime.client, "_transport", None), "_event_queue", None)
+	if hasattr(event_queue, "mutex"):
+		locks.append(event_queue.mutex)
+	return locks
+
+
+def _before_fork():
+	"""Build a worker's runtime before its first work horse, and quiesce it"""
+	global _fork_locks_held
+
+	if _active and _role == "worker" and _runtime is None and not _attempted:
+		runtime = get_runtime()
+		if runtime is not None:
+			# The worker runs no jobs itself; each horse restarts the timer
+			runtime.client.metrics.stop_thread()
+
+	runtime = _runtime
+	if runtime is None or not _keeps_runtime(runtime):
+		return
+
+	locks = _fork_locks(runtime)
+	for lock in locks:
+		lock.acquire()
+	_fork_locks_held = locks
+
+
+def _release_fork_locks():
+	global _fork_locks_held
+
+	for lock in reversed(_fork_locks_held):
+		lock.release()
+	_fork_locks_held = []
+
+
+def _after_fork_in_child():
+	"""Keep a worker's runtime in its work horse, forget any other inherited one"""
+	global _lock, _runtime, _attempted, _forks
+
+	_lock = threading.Lock()
+	_forks += 1
+	_release_fork_locks()
+
+	if _runtime is not None and _keeps_runtime(_runtime):
+		# The agent and the pipeline restart their threads on the pid change;
+		# events still queued in the worker are the worker's to send
+		transport = getattr(_runtime.client, "_transport", None)
+		if transport is not None:
+			transport._flushed = threading.Event()
+			if hasattr(transport._event_queue, "queue"):
+				transport._event_queue.queue.clear()
+		return
+
+	if _runtime is not None:
+		_runtime = None
+		# The inherited client's threads did not survive the fork; make sure the
+		# agent does not treat it as the process-wide singleton either
+		try:
+			import elasticapm.base
+
+			elasticapm.base.CLIENT_SINGLETON = None
+		except Exception:
+			pass
+	_attempted = False
+
+
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(
+		before=_before_fork, after_in_parent=_release_fork_locks, after_in_child=_after_fork_in_child
+	)
@@ -0,0 +1,150 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Circuit breaker around the agent's transport
+
+Counts consecutive send failures reported by the transport. After
+`failure_threshold` of them the breaker opens: the middleware and job hooks
+stop creating transactions, so no context is captured, no spans are recorded
+and nothing is serialized while the APM server is unreachable.
+
+With the disk spool enabled the middleware keeps tracing while the breaker
+is open; batches go straight to the spool instead of the network.
+
+After the backoff the breaker lets a single probe transaction through
+(half-open). The next send result closes it again, or re-opens it with the
+backoff doubled up to `max_backoff_ms`. A probe whose result never arrives
+within `probe_timeout_ms` counts as a failure.
+"""
+
+import logging
+import threading
+import time
+
+from erpnext_apm.spool import SpooledError
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+	"""Per-worker transport circuit breaker"""
+
+	def __init__(
+		self, failure_threshold=5, backoff_ms=30000, max_backoff_ms=300000, probe_timeout_ms=60000, on_half_open=None
+	):
+		self.failure_threshold = max(int(failure_threshold), 1)
+		self.initial_backoff = backoff_ms / 1000
+		self.max_backoff = max(max_backoff_ms, backoff_ms) / 1000
+		self.probe_timeout = probe_timeout_ms / 1000
+		self._on_half_open = on_half_open
+
+		self.state = CLOSED
+		self.failures = 0
+		self.backoff = self.initial_backoff
+		self._retry_at = 0.0
+		self._probe_sent_at = None
+		self._lock = threading.Lock()
+
+		self.trips = 0
+		self.shed = 0
+
+	def allow(self):
+		"""Whether a new transaction may be recorded"""
+		if self.state is CLOSED:
+			return True
+
+		now = time.monotonic()
+		with self._lock:
+			if self.state is OPEN and now >= self._retry_at:
+				self.state = HALF_OPEN
+				self._probe_sent_at = None
+				if self._on_half_open is not None:
+					self._on_half_open()
+
+			if self.state is HALF_OPEN:
+				if self._probe_sent_at is None:
+					self._probe_sent_at = now
+					logger.info("APM circuit breaker half-open, sending a probe")
+					return True
+				if now - self._probe_sent_at >= self.probe_timeout:
+					self._open(now)
+
+			self.shed += 1
+			return False
+
+	def _open(self, now):
+		if self.state is HALF_OPEN:
+			self.backoff = min(self.backoff * 2, self.max_backoff)
+		self.state = OPEN
+		self._retry_at = now + self.backoff
+		self.trips += 1
+		logger.warning(
+			f"APM circuit breaker open after {self.failures} consecutive transport failures, "
+			f"retrying in {self.backoff:.1f}s"
+		)
+
+	def record_success(self):
+		if self.state is CLOSED and not self.failures:
+			return
+
+		with self._lock:
+			if self.state is not CLOSED:
+				logger.info("APM circuit breaker closed, transport recovered")
+			self.state = CLOSED
+			self.failures = 0
+			self.backoff = self.initial_backoff
+
+	def record_failure(self):
+		with self._lock:
+			self.failures += 1
+			if self.state is HALF_OPEN or (self.state is CLOSED and self.failures >= self.failure_threshold):
+				self._open(time.monotonic())
+
+	def stats(self):
+		"""Return the breaker state and counters"""
+		retry_in = max(self._retry_at - time.monotonic(), 0.0) if self.state is OPEN else 0.0
+		return {
+			"state": self.state,
+			"consecutive_failures": self.failures,
+			"trips": self.trips,
+			"shed": self.shed,
+			"backoff_s": self.backoff,
+			"retry_in_s": round(retry_in, 1),
+		}
+
+
+def install_circuit_breaker(client, **kwargs):
+	"""Feed the client's transport send results into a CircuitBreaker"""
+	transport = client._transport
+
+	def on_half_open():
+		# The agent keeps its own send backoff, which would drop the probe unsent
+		transport.state.set_success()
+
+	breaker = CircuitBreaker(on_half_open=on_half_open, **kwargs)
+
+	on_success = transport.handle_transport_success
+	on_fail = transport.handle_transport_fail
+
+	def handle_transport_success(**kw):
+		breaker.record_success()
+		return on_success(**kw)
+
+	def handle_transport_fail(exception=None, **kw):
+		if isinstance(exception, SpooledError):
+			# Kept on disk: no agent back-off, and only real send failures count
+			logger.debug(str(exception))
+			if exception.cause is not None:
+				breaker.record_failure()
+			return None
+		breaker.record_failure()
+		return on_fail(exception=exception, **kw)
+
+	transport.handle_transport_success = handle_transport_success
+	transport.handle_transport_fail = handle_transport_fail
+	return breaker
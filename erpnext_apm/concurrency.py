@@ -0,0 +1,278 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+In-flight request counts and worker saturation
+
+Each web worker keeps its requests in flight in a dict keyed by thread, so
+a request only does one store when it starts and one pop when it ends, and
+the count is the dict's length: no lock is taken. The worker publishes the
+count and its peak on every change, and the share of its threads' time
+spent in requests once per metrics interval, into its slot of a small
+memory-mapped file shared by all workers of the same
+gunicorn master (CONCURRENCY_DIR/erpnext-apm-concurrency-<master pid>,
+on /dev/shm where there is one). Each slot has a single writer.
+
+A worker holds a POSIX record lock on its slot for life, so a slot whose
+lock is free belongs to a worker that has exited and is taken over by the
+next worker to start. The live worker with the lowest slot reports the
+pool-wide figures; pool utilization is the capacity-weighted mean of the
+workers' last published utilization.
+
+File layout, all values little endian u64:
+
+	header (64 bytes): magic "EAPMCON\\0", version, slots, slots used,
+	                   pool peak, 3 reserved
+	slots: `slots` * 8 values: pid, in flight, peak, capacity (threads),
+	       requests, utilization in parts per million, 2 reserved
+"""
+
+import errno
+import fcntl
+import glob
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"EAPMCON\0"
+VERSION = 1
+HEADER_SIZE = 64
+SLOT_SIZE = 64
+SLOT_VALUES = SLOT_SIZE // 8
+FILE_PREFIX = "erpnext-apm-concurrency-"
+
+_HEADER = struct.Struct("<8s7Q")
+
+# Header values, as indexes into the file viewed as u64s
+_SLOTS = 2
+_USED = 3
+_POOL_PEAK = 4
+
+# Slot values, as offsets from the slot's first u64
+PID = 0
+IN_FLIGHT = 1
+PEAK = 2
+CAPACITY = 3
+REQUESTS = 4
+UTILIZATION = 5
+
+
+def default_directory():
+	return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def worker_threads(argv=None, environ=None):
+	"""Return the threads per worker from the gunicorn command line, 1 if not given"""
+	argv = sys.argv if argv is None else argv
+	environ = os.environ if environ is None else environ
+	args = list(argv) + environ.get("GUNICORN_CMD_ARGS", "").split()
+	threads = 1
+	for i, arg in enumerate(args):
+		value = None
+		if arg.startswith("--threads="):
+			value = arg.split("=", 1)[1]
+		elif arg == "--threads" and i + 1 < len(args):
+			value = args[i + 1]
+		if value is not None:
+			try:
+				threads = max(int(value), 1)
+			except ValueError:
+				pass
+	return threads
+
+
+def _lock(fd, offset, length, blocking=False):
+	try:
+		fcntl.lockf(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB, length, offset)
+	except OSError as e:
+		if e.errno in (errno.EAGAIN, errno.EACCES):
+			return False
+		raise
+	return True
+
+
+def _unlock(fd, offset, length):
+	fcntl.lockf(fd, fcntl.LOCK_UN, length, offset)
+
+
+def _pid_alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True
+	return True
+
+
+def _remove_stale_files(directory, keep):
+	"""Remove the files of gunicorn masters that are gone"""
+	for path in glob.glob(os.path.join(directory, f"{FILE_PREFIX}*")):
+		match = re.fullmatch(rf"{FILE_PREFIX}(\d+)", os.path.basename(path))
+		if match is None or path == keep or _pid_alive(int(match.group(1))):
+			continue
+		try:
+			os.unlink(path)
+		except OSError:
+			pass
+
+
+class ConcurrencyTracker:
+	"""This worker's in-flight requests, published into its slot of the shared file"""
+
+	def __init__(self, directory=None, capacity=1, slots=256):
+		self.capacity = max(int(capacity), 1)
+		self.directory = directory or default_directory()
+		self.path = os.path.join(self.directory, f"{FILE_PREFIX}{os.getppid()}")
+		self.slots = max(int(slots), 1)
+		self.peak = 0
+
+		# Thread ident -> request start; thread ident -> [requests, busy seconds]
+		self._active = {}
+		self._busy = {}
+		self._last_busy = 0.0
+		self._last_collect = time.monotonic()
+		# In-flight value indexes of the slots in use, for the pool peak
+		self._used = None
+		self._pool_indexes = ()
+
+		os.makedirs(self.directory, exist_ok=True)
+		_remove_stale_files(self.directory, self.path)
+		self._open()
+
+	def _open(self):
+		size = HEADER_SIZE + self.slots * SLOT_SIZE
+		self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+		# The header lock serializes setting up the file and claiming slots
+		_lock(self._fd, 0, HEADER_SIZE, blocking=True)
+		try:
+			if os.fstat(self._fd).st_size < size:
+				os.ftruncate(self._fd, size)
+			self._mm = mmap.mmap(self._fd, size)
+			magic, version, slots = struct.unpack_from("<8sQQ", self._mm)
+			if (magic, version, slots) != (MAGIC, VERSION, self.slots):
+				self._mm[:size] = bytes(size)
+				_HEADER.pack_into(self._mm, 0, MAGIC, VERSION, self.slots, 0, 0, 0, 0, 0)
+			self._values = memoryview(self._mm).cast("Q")
+
+			for slot in range(self.slots):
+				if _lock(self._fd, HEADER_SIZE + slot * SLOT_SIZE, SLOT_SIZE):
+					break
+			else:
+				raise OSError(f"No free slot in {self.path}")
+
+			self.slot = slot
+			self._base = HEADER_SIZE // 8 + slot * SLOT_VALUES
+			self._values[self._base : self._base + SLOT_VALUES] = memoryview(bytes(SLOT_SIZE)).cast("Q")
+			self._values[self._base + PID] = os.getpid()
+			self._values[self._base + CAPACITY] = self.capacity
+			if self._values[_USED] <= slot:
+				self._values[_USED] = slot + 1
+		finally:
+			_unlock(self._fd, 0, HEADER_SIZE)
+
+	def begin(self):
+		"""Count a request starting on the calling thread"""
+		active = self._active
+		active[threading.get_ident()] = time.perf_counter()
+		in_flight = len(active)
+		values, base = self._values, self._base
+		values[base + IN_FLIGHT] = in_flight
+		if in_flight > self.peak:
+			self.peak = in_flight
+			values[base + PEAK] = in_flight
+
+		if values[_USED] != self._used:
+			self._used = values[_USED]
+			first = HEADER_SIZE // 8 + IN_FLIGHT
+			self._pool_indexes = tuple(first + slot * SLOT_VALUES for slot in range(self._used))
+		pool = sum(map(values.__getitem__, self._pool_indexes))
+		if pool > values[_POOL_PEAK]:
+			values[_POOL_PEAK] = pool
+
+	def end(self):
+		"""Count the calling thread's request as finished"""
+		ident = threading.get_ident()
+		started = self._active.pop(ident, None)
+		values, base = self._values, self._base
+		values[base + IN_FLIGHT] = len(self._active)
+		if started is None:
+			return
+
+		totals = self._busy.get(ident)
+		if totals is None:
+			totals = self._busy[ident] = [0, 0.0]
+		totals[0] += 1
+		totals[1] += time.perf_counter() - started
+		values[base + REQUESTS] += 1
+
+	def _busy_time(self):
+		"""Thread time spent in requests so far, counting the ones in flight up to now"""
+		now = time.perf_counter()
+		finished = sum(totals[1] for totals in list(self._busy.values()))
+		return finished + sum(now - started for started in list(self._active.values()))
+
+	def _live_slots(self):
+		"""Return the slots of live workers; zero the in-flight counts of the others"""
+		live = []
+		for slot in range(self._values[_USED]):
+			if slot == self.slot:
+				live.append(slot)
+				continue
+			offset = HEADER_SIZE + slot * SLOT_SIZE
+			if _lock(self._fd, offset, SLOT_SIZE):
+				# A worker that exited mid-request left its count behind
+				self._values[offset // 8 + IN_FLIGHT] = 0
+				_unlock(self._fd, offset, SLOT_SIZE)
+			else:
+				live.append(slot)
+		return live
+
+	def collect(self):
+		"""Return this worker's figures since the last call, and the pool's if this worker reports them"""
+		now = time.monotonic()
+		elapsed = max(now - self._last_collect, 1e-6)
+		self._last_collect = now
+
+		in_flight = len(self._active)
+		busy = self._busy_time()
+		utilization = min(max((busy - self._last_busy) / (self.capacity * elapsed), 0.0), 1.0)
+		worker = {
+			"in_flight": in_flight,
+			"peak": self.peak,
+			"capacity": self.capacity,
+			"utilization": utilization,
+		}
+		self._last_busy = busy
+		self.peak = in_flight
+		self._values[self._base + PEAK] = in_flight
+		self._values[self._base + UTILIZATION] = round(utilization * 1000000)
+
+		live = self._live_slots()
+		if not live or live[0] != self.slot:
+			return worker, None
+
+		values = self._values
+		slots = [HEADER_SIZE // 8 + slot * SLOT_VALUES for slot in live]
+		capacity = sum(values[base + CAPACITY] for base in slots)
+		utilization = sum(values[base + UTILIZATION] * values[base + CAPACITY] for base in slots)
+		pool = {
+			"workers": len(live),
+			"in_flight": sum(values[base + IN_FLIGHT] for base in slots),
+			"peak": values[_POOL_PEAK],
+			"capacity": capacity,
+			"utilization": utilization / 1000000 / max(capacity, 1),
+		}
+		values[_POOL_PEAK] = pool["in_flight"]
+		return worker, pool
+
+	def stats(self):
+		return {"path": self.path, "slot": self.slot, "capacity": self.capacity, "in_flight": len(self._active)}
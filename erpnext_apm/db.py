@@ -0,0 +1,167 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Span instrumentation for Frappe database calls
+
+Patches frappe.database.database.Database so that sql(), get_value() and
+get_all() each record a span while a transaction is active. SQL spans carry
+a normalized fingerprint of the statement (literals stripped, IN lists
+collapsed); fingerprints are memoized in an LRU since the same query text
+comes back on almost every request.
+
+A SQL span is named after the statement's signature ("SELECT FROM tabBin")
+and a digest of its fingerprint. The agent's span compression merges exact
+matches by name, so only runs of the same query are merged, and the
+statement the composite span keeps is the one all of them share. Composite
+spans carry the count and total duration of the merged spans, not their
+minimum or maximum.
+"""
+
+import functools
+import logging
+import re
+import time
+import zlib
+
+import elasticapm
+from elasticapm.instrumentation.packages.dbapi2 import extract_signature
+
+from erpnext_apm import nplusone
+from erpnext_apm.state import current_state
+
+logger = logging.getLogger(__name__)
+
+_installed = False
+
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+# MariaDB also takes "..." as a string unless ANSI_QUOTES is set; on Postgres it quotes an identifier
+_QUOTED_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'" r'|"(?:[^"\\]|\\.|"")*"')
+_NUMBER_RE = re.compile(r"(?<![\w`])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?(?![\w`])", re.IGNORECASE)
+_PLACEHOLDER_RE = re.compile(r"%(?:\([^)]*\))?s")
+_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _fingerprint_sql(query, db_type="mariadb"):
+	"""Normalize a statement into its fingerprint and span name"""
+	fingerprint = _WHITESPACE_RE.sub(" ", query).strip()
+	fingerprint = (_STRING_RE if db_type == "postgresql" else _QUOTED_RE).sub("?", fingerprint)
+	fingerprint = _PLACEHOLDER_RE.sub("?", fingerprint)
+	fingerprint = _NUMBER_RE.sub("?", fingerprint)
+	fingerprint = _IN_LIST_RE.sub("IN (...)", fingerprint)
+	return fingerprint, f"{extract_signature(fingerprint)} [{zlib.crc32(fingerprint.encode()):08x}]"
+
+
+# Replaced with a sized LRU by install_db_instrumentation
+fingerprint_sql = functools.lru_cache(maxsize=1024)(_fingerprint_sql)
+
+
+def _wrap_sql(original, db_type):
+	@functools.wraps(original)
+	def sql(self, query, *args, **kwargs):
+		state = current_state()
+		if state is None:
+			return original(self, query, *args, **kwargs)
+
+		fingerprint, signature = fingerprint_sql(query if isinstance(query, str) else str(query), db_type)
+		pattern = nplusone.track_query(state, fingerprint, signature)
+		started = time.perf_counter()
+		try:
+			if pattern is not None:
+				# Past the N+1 threshold - folded into one aggregated span instead
+				return original(self, query, *args, **kwargs)
+
+			with elasticapm.capture_span(
+				signature,
+				span_type="db",
+				span_subtype=db_type,
+				span_action="query",
+				extra={"db": {"type": "sql", "statement": fingerprint}},
+				leaf=True,
+			):
+				return original(self, query, *args, **kwargs)
+		finally:
+			elapsed = time.perf_counter() - started
+			state.db_count += 1
+			state.db_time += elapsed
+			if pattern is not None:
+				pattern.aggregate(elapsed)
+
+	return sql
+
+
+def _wrap_orm_call(original, db_type, action):
+	@functools.wraps(original)
+	def call(self, *args, **kwargs):
+		state = current_state()
+		if state is None:
+			return original(self, *args, **kwargs)
+
+		doctype = args[0] if args else kwargs.get("doctype")
+		name = f"frappe.db.{action} {doctype}"
+		pattern = nplusone.track_query(state, name, name)
+		if pattern is not None:
+			started = time.perf_counter()
+			try:
+				return original(self, *args, **kwargs)
+			finally:
+				pattern.aggregate(time.perf_counter() - started)
+
+		with elasticapm.capture_span(name, span_type="db", span_subtype=db_type, span_action=action):
+			return original(self, *args, **kwargs)
+
+	return call
+
+
+def install_db_instrumentation(config=None):
+	"""
+	Patch Frappe's Database class to record spans
+
+	Safe to call more than once; returns True if the patch is in place.
+	"""
+	global _installed, fingerprint_sql
+
+	if _installed:
+		return True
+
+	config = config or {}
+	if not config.get("DB_SPANS", True):
+		logger.debug("Database span instrumentation disabled")
+		return False
+
+	try:
+		import frappe
+		from frappe.database.database import Database
+	except ImportError as e:
+		logger.debug(f"Frappe database module not available ({e}), skipping DB instrumentation")
+		return False
+
+	try:
+		db_type = (frappe.conf.get("db_type") if frappe.conf else None) or "mariadb"
+	except Exception:
+		db_type = "mariadb"
+	if db_type == "postgres":
+		db_type = "postgresql"
+
+	fingerprint_sql = functools.lru_cache(maxsize=config.get("SQL_FINGERPRINT_CACHE_SIZE", 1024))(
+		_fingerprint_sql
+	)
+
+	Database.sql = _wrap_sql(Database.sql, db_type)
+	for action in ("get_value", "get_all"):
+		if hasattr(Database, action):
+			setattr(Database, action, _wrap_orm_call(getattr(Database, action), db_type, action))
+
+	# N+1 detection piggybacks on the sql() wrapper and a frappe.get_doc patch
+	nplusone.configure(
+		threshold=config.get("N_PLUS_ONE_THRESHOLD", 10),
+		max_patterns=config.get("N_PLUS_ONE_MAX_PATTERNS", 256),
+		db_type=db_type,
+	)
+	if config.get("N_PLUS_ONE_THRESHOLD", 10):
+		nplusone.install_get_doc_tracking()
+
+	_installed = True
+	logger.info(f"Frappe database instrumentation installed (db_type={db_type})")
+	return True
@@ -0,0 +1,88 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Garbage collector pause timing
+
+A gc.callbacks hook times every collection. The pause is added to the
+TransactionState of the thread that triggered it, so the transaction gets
+gc_pause_ms / gc_collections labels, and counted into a per-generation
+histogram (the log-linear buckets of erpnext_apm.histograms) sent as
+metrics by GcMetricSet.
+
+The callback runs inside the collector, which may have been triggered by
+any allocation: it takes no locks and allocates nothing it does not have
+to. Collections are serialized by the interpreter, so the counters are
+only ever updated by one callback at a time.
+"""
+
+import gc
+import logging
+import time
+from array import array
+
+from erpnext_apm.histograms import BUCKET_COUNT, bucket_index
+from erpnext_apm.state import current_state
+
+logger = logging.getLogger(__name__)
+
+GENERATIONS = 3
+
+_EMPTY = bytes(BUCKET_COUNT * 4)
+
+# The installed callback, replaced by the monitor of a forked child
+_callback = None
+
+
+class GcMonitor:
+	"""Per-worker collection counts and pause histograms"""
+
+	def __init__(self):
+		self._started = None
+		self._reset()
+
+	def _reset(self):
+		self._counts = [array("I", _EMPTY) for _ in range(GENERATIONS)]
+		self._pause = [0.0] * GENERATIONS
+		self._collected = [0] * GENERATIONS
+
+	def __call__(self, phase, info):
+		if phase == "start":
+			self._started = time.perf_counter()
+			return
+
+		started = self._started
+		if started is None:
+			return
+		self._started = None
+		duration = time.perf_counter() - started
+		generation = min(info.get("generation", 0), GENERATIONS - 1)
+
+		self._counts[generation][bucket_index(int(duration * 1000000))] += 1
+		self._pause[generation] += duration
+		self._collected[generation] += info.get("collected", 0)
+
+		state = current_state()
+		if state is not None:
+			state.gc_count += 1
+			state.gc_time += duration
+
+	def collect(self):
+		"""Return (histograms, pause seconds, objects collected) per generation since the last call"""
+		counts, pause, collected = self._counts, self._pause, self._collected
+		self._reset()
+		return counts, pause, collected
+
+
+def install_gc_monitor(monitor):
+	"""Time collections with `monitor`, replacing any monitor installed before a fork"""
+	global _callback
+
+	if _callback is not None:
+		try:
+			gc.callbacks.remove(_callback)
+		except ValueError:
+			pass
+	gc.callbacks.append(monitor)
+	_callback = monitor
+	logger.debug("APM garbage collector monitor installed")
@@ -0,0 +1,128 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Fixed-bucket log-linear latency histograms
+
+Durations are counted in microseconds into HDR-style buckets: values below
+32 us get one bucket each, above that every power of two is split into 16
+linear sub-buckets, so a bucket is never wider than 1/16 of its lower
+bound. Values up to 2^32 us (about 71 minutes) fit in BUCKET_COUNT
+buckets; longer ones land in the last bucket.
+
+Each route owns one array of BUCKET_COUNT 32-bit counters, so memory is
+bounded by max_routes * BUCKET_COUNT * 4 bytes. A Histogram is a single
+such array, for per-worker durations.
+"""
+
+import threading
+from array import array
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+LINEAR_LIMIT = SUB_BUCKETS * 2
+MAX_VALUE_BITS = 32
+BUCKET_COUNT = LINEAR_LIMIT + (MAX_VALUE_BITS - SUB_BUCKET_BITS - 1) * SUB_BUCKETS
+MAX_VALUE = (1 << MAX_VALUE_BITS) - 1
+
+OVERFLOW_ROUTE = "<other>"
+
+_EMPTY = bytes(BUCKET_COUNT * 4)
+
+
+def bucket_index(value):
+	"""Return the bucket of a duration in microseconds"""
+	if value < LINEAR_LIMIT:
+		return max(value, 0)
+	if value > MAX_VALUE:
+		value = MAX_VALUE
+	shift = value.bit_length() - SUB_BUCKET_BITS - 1
+	return LINEAR_LIMIT + (shift - 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_bounds(index):
+	"""Return the [lower, upper) microsecond range of a bucket"""
+	if index < LINEAR_LIMIT:
+		return index, index + 1
+	shift, sub = divmod(index - LINEAR_LIMIT, SUB_BUCKETS)
+	shift += 1
+	mantissa = sub + SUB_BUCKETS
+	return mantissa << shift, (mantissa + 1) << shift
+
+
+def bucket_midpoint(index):
+	lower, upper = bucket_bounds(index)
+	return (lower + upper) / 2
+
+
+def percentiles(counts, quantiles):
+	"""Return the bucket midpoints (us) at the given quantiles, or None if empty"""
+	total = sum(counts)
+	if not total:
+		return None
+
+	ranks = [max(1, round(q * total)) for q in quantiles]
+	results = [None] * len(quantiles)
+	seen = 0
+	pending = 0
+	for index, count in enumerate(counts):
+		if not count:
+			continue
+		seen += count
+		while pending < len(ranks) and seen >= ranks[pending]:
+			results[pending] = bucket_midpoint(index)
+			pending += 1
+		if pending == len(ranks):
+			break
+	return results
+
+
+class Histogram:
+	"""One latency histogram for a worker"""
+
+	def __init__(self):
+		self._counts = array("I", _EMPTY)
+		self._lock = threading.Lock()
+
+	def record(self, duration):
+		"""Count one duration of `duration` seconds"""
+		index = bucket_index(int(duration * 1000000))
+		with self._lock:
+			self._counts[index] += 1
+
+	def collect(self):
+		"""Return the counts recorded since the last call and start over"""
+		with self._lock:
+			counts, self._counts = self._counts, array("I", _EMPTY)
+		return counts
+
+
+class RouteHistograms:
+	"""Per-route latency histograms for one worker"""
+
+	def __init__(self, max_routes=500):
+		self.max_routes = max_routes
+		self._routes = {}
+		self._lock = threading.Lock()
+
+	def record(self, route, duration):
+		"""Count one request of `duration` seconds for the route"""
+		index = bucket_index(int(duration * 1000000))
+		with self._lock:
+			counts = self._routes.get(route)
+			if counts is None:
+				if len(self._routes) >= self.max_routes:
+					route = OVERFLOW_ROUTE
+					counts = self._routes.get(route)
+				if counts is None:
+					counts = self._routes[route] = array("I", _EMPTY)
+			counts[index] += 1
+
+	def collect(self):
+		"""Return the counts recorded since the last call and start over"""
+		with self._lock:
+			routes, self._routes = self._routes, {}
+		return routes
+
+	def __len__(self):
+		return len(self._routes)
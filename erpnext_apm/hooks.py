@@ -87,24 +87,21 @@ app_license = "mit"
 
 # APM Setup - Initialize early via module import
 # Import monkey_patch to trigger APM wrapping at module load time
-# This ensures the WSGI application is wrapped early, similar to Sentry
+# This ensures the WSGI application is wrapped early, similar to Sentry.
+# Only cheap hooks are put in place here, and only in traced process roles:
+# elasticapm is imported and the client created per worker process, after
+# fork, on its first request or job (see erpnext_apm.bootstrap)
 try:
-	import erpnext_apm.monkey_patch  # noqa: F401
-except ImportError:
-	pass
-
-# Also try app_patcher as another approach
-try:
-	import erpnext_apm.app_patcher  # noqa: F401
+	import erpnext_apm.monkey_patch
 except ImportError:
 	pass
 
 # Also use after_migrate and startup as fallback
 after_migrate = ["erpnext_apm.startup.setup_apm"]
 
-# Use before_request hook to ensure APM is initialized on first request
-# This is a fallback in case module-level initialization didn't work
-before_request = ["erpnext_apm.startup.ensure_apm_initialized"]
+# No before_request hook: Frappe would dispatch it on every request for the
+# life of the process. First-request setup happens in the WSGI stand-in
+# installed above (erpnext_apm.bootstrap.DeferredElasticAPMWSGI)
 
 # Uninstallation
 # ------------
@@ -222,8 +219,9 @@ before_request = ["erpnext_apm.startup.ensure_apm_initialized"]
 
 # Job Events
 # ----------
-# before_job = ["erpnext_apm.utils.before_job"]
-# after_job = ["erpnext_apm.utils.after_job"]
+# Trace background jobs run by bench worker as "job" transactions
+before_job = ["erpnext_apm.jobs.before_job"]
+after_job = ["erpnext_apm.jobs.after_job"]
 
 # User Data Protection
 # --------------------
@@ -0,0 +1,34 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Installs the library patches shared by the web, background job and
+scheduler processes
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def install_instrumentation(config):
+	"""Install database spans, job trace propagation and scheduler tracing (idempotent)"""
+	from erpnext_apm.db import install_db_instrumentation
+	from erpnext_apm.propagation import install_enqueue_propagation
+	from erpnext_apm.scheduler import install_scheduler_instrumentation
+
+	try:
+		install_db_instrumentation(config)
+	except Exception as e:
+		logger.error(f"Failed to install database instrumentation: {e}", exc_info=True)
+
+	try:
+		install_enqueue_propagation()
+	except Exception as e:
+		logger.error(f"Failed to install job trace propagation: {e}", exc_info=True)
+
+	if config.get("SCHEDULER_TRACING", True):
+		try:
+			install_scheduler_instrumentation()
+		except Exception as e:
+			logger.error(f"Failed to install scheduler instrumentation: {e}", exc_info=True)
@@ -0,0 +1,171 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Background job (RQ) instrumentation
+
+Registered as Frappe's before_job / after_job hooks, so every job run by
+`bench worker` (short, default and long queues) gets a transaction of type
+"job" named after the job method. The time the job spent waiting in the
+queue is recorded as the message age, and the job outcome as the result.
+Jobs enqueued during a traced request continue that request's trace.
+"""
+
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+
+from erpnext_apm.propagation import pop_trace_parent
+
+logger = logging.getLogger(__name__)
+
+
+def _get_client():
+	"""Return the process' APM client, creating it on the first job"""
+	try:
+		from erpnext_apm import bootstrap
+
+		if not bootstrap.setup(role="worker"):
+			return None
+		return bootstrap.get_client()
+	except Exception as e:
+		logger.error(f"Failed to set up APM for background jobs: {e}", exc_info=True)
+		return None
+
+
+def _breaker_closed():
+	from erpnext_apm.bootstrap import get_runtime
+
+	runtime = get_runtime()
+	return (
+		runtime is None or runtime.breaker is None or runtime.spool is not None or runtime.breaker.state == "closed"
+	)
+
+
+def _in_work_horse(runtime):
+	"""Whether this process is an RQ work horse, forked to run one job"""
+	# The horse either inherited the worker's runtime or calls os.setsid()
+	# before building one of its own
+	pid = os.getpid()
+	return runtime.pid != pid or os.getsid(0) == pid
+
+
+def _flush(runtime):
+	"""Send the job's events before the horse leaves through os._exit()"""
+	if runtime.pipeline is not None:
+		runtime.pipeline.flush()
+
+	transport = getattr(runtime.client, "_transport", None)
+	if transport is None or not transport.is_started():
+		return
+	# Transport.flush() would wait as long as a request to the APM server may
+	# take; a slow server must not hold up every job by that much
+	timeout = runtime.config.get("JOB_FLUSH_TIMEOUT_MS", 100)
+	transport.queue(None, None, flush=True)
+	if not transport._flushed.wait(timeout / 1000):
+		logger.warning(f"APM events of the job not sent within {timeout:g} ms, dropped")
+
+
+def _queue_wait():
+	"""Return (queue name, seconds between enqueue and start) for the current RQ job"""
+	try:
+		from rq import get_current_job
+
+		job = get_current_job()
+	except ImportError:
+		return None, None
+
+	if job is None or not job.enqueued_at:
+		return None, None
+	# RQ stores UTC timestamps, naive or aware depending on the version
+	started_at = job.started_at or datetime.now(timezone.utc).replace(tzinfo=job.enqueued_at.tzinfo)
+	return job.origin, max((started_at - job.enqueued_at).total_seconds(), 0.0)
+
+
+def before_job(method=None, kwargs=None, transaction_type=None):
+	"""Start a job transaction - called via the before_job hook"""
+	# Always strip the propagated traceparent so it never reaches the job method
+	trace_parent = pop_trace_parent(kwargs)
+
+	client = _get_client()
+	if client is None:
+		return
+
+	from erpnext_apm.bootstrap import get_runtime
+
+	# Untraced while the circuit breaker is open
+	runtime = get_runtime()
+	breaker = runtime.breaker if runtime.spool is None else None
+	if breaker is not None and not breaker.allow():
+		return
+
+	try:
+		import elasticapm
+
+		from erpnext_apm.state import start_state
+
+		transaction = client.begin_transaction("job", trace_parent=trace_parent)
+		if transaction is None:
+			return
+
+		elasticapm.set_transaction_name(method or "unknown", override=False)
+		start_state()
+
+		queue, wait = _queue_wait()
+		if wait is not None:
+			wait_ms = round(wait * 1000, 3)
+			elasticapm.label(queue=queue, queue_wait_ms=wait_ms)
+			elasticapm.set_context({"queue": {"name": queue}, "age": {"ms": wait_ms}}, "message")
+	except Exception as e:
+		logger.debug(f"Failed to start job transaction: {e}")
+
+
+def after_job(method=None, kwargs=None, result=None):
+	"""End the job transaction - called via the after_job hook"""
+	from erpnext_apm.bootstrap import get_runtime, peek_client
+
+	client = peek_client()
+	if client is None:
+		return
+
+	try:
+		import elasticapm
+
+		from erpnext_apm.state import end_state
+
+		# Nothing to report for a job the open circuit breaker let through untraced
+		if elasticapm.get_transaction_id() is None and not _breaker_closed():
+			return
+
+		# after_job runs in the finally block of Frappe's execute_job,
+		# so a failing job still has its exception set here
+		exc_info = sys.exc_info()
+		if exc_info[1] is not None:
+			client.capture_exception(exc_info=exc_info)
+			elasticapm.set_transaction_result("error", override=False)
+		else:
+			elasticapm.set_transaction_result("success", override=False)
+			if result is not None:
+				elasticapm.label(job_result=type(result).__name__)
+		exc_info = None
+
+		state = end_state()
+		if state is not None:
+			labels = state.finish()
+			if labels:
+				elasticapm.label(**labels)
+
+		client.end_transaction(method)
+	except Exception as e:
+		logger.debug(f"Failed to end job transaction: {e}")
+		return
+
+	# RQ ends a work horse with os._exit(), so neither atexit handlers nor the
+	# agent's threads get to send what is still queued
+	runtime = get_runtime()
+	try:
+		if runtime is not None and _in_work_horse(runtime):
+			_flush(runtime)
+	except Exception as e:
+		logger.debug(f"Failed to flush job events: {e}")
@@ -0,0 +1,153 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Per-request memory accounting for web workers
+
+A fraction (MEMORY_SAMPLE_RATE) of requests is measured: the worker's RSS
+before and after the request and, when no other request of the worker is
+being traced, the Python allocations made during the request and still
+alive at its end, from tracemalloc started and stopped around it. Requests
+that are not picked cost one random() call.
+
+tracemalloc is process-wide, so in a threaded worker the allocations of
+requests running at the same time are counted too; the per-route
+aggregates even this out. When tracemalloc was already started by
+something else, it is left alone and only RSS is measured.
+"""
+
+import logging
+import os
+import random
+import threading
+import tracemalloc
+
+from erpnext_apm.histograms import OVERFLOW_ROUTE
+
+logger = logging.getLogger(__name__)
+
+# Requests allocating at least this much get their top allocation sites attached
+TOP_SITES_MIN_BYTES = 1024 * 1024
+TOP_SITES = 10
+
+try:
+	_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+	_PAGE_SIZE = 4096
+
+
+def current_rss():
+	"""Return the resident set size of this process in bytes, or None if unknown"""
+	try:
+		with open("/proc/self/statm", "rb") as f:
+			return int(f.read().split()[1]) * _PAGE_SIZE
+	except (OSError, ValueError, IndexError):
+		return None
+
+
+class _Measurement:
+	__slots__ = ("rss", "tracing")
+
+	def __init__(self, rss, tracing):
+		self.rss = rss
+		self.tracing = tracing
+
+
+class MemoryUsage:
+	"""What a measured request did to the worker's memory"""
+
+	__slots__ = ("allocated", "peak", "rss_delta", "top_sites")
+
+	def __init__(self, rss_delta, allocated=None, peak=None, top_sites=None):
+		self.rss_delta = rss_delta
+		self.allocated = allocated
+		self.peak = peak
+		self.top_sites = top_sites
+
+	def labels(self):
+		labels = {}
+		if self.rss_delta is not None:
+			labels["mem_rss_delta_kb"] = round(self.rss_delta / 1024)
+		if self.allocated is not None:
+			labels["mem_alloc_kb"] = round(self.allocated / 1024)
+			labels["mem_alloc_peak_kb"] = round(self.peak / 1024)
+		return labels
+
+
+class MemoryTracker:
+	"""Measures sampled requests and keeps per-route memory growth aggregates"""
+
+	def __init__(self, sample_rate=0.001, tracemalloc_enabled=True, max_routes=500):
+		self.sample_rate = sample_rate
+		self.tracemalloc_enabled = tracemalloc_enabled
+		self.max_routes = max_routes
+
+		# Thread ident -> _Measurement; only written by the request threads
+		self._active = {}
+		self._tracing = threading.Lock()
+		self._lock = threading.Lock()
+		self._routes = {}
+		self.measured = 0
+
+	def begin(self):
+		"""Measure the request starting on the calling thread, if it is picked"""
+		if random.random() >= self.sample_rate:
+			return
+
+		tracing = (
+			self.tracemalloc_enabled and not tracemalloc.is_tracing() and self._tracing.acquire(blocking=False)
+		)
+		if tracing:
+			tracemalloc.start(1)
+		self._active[threading.get_ident()] = _Measurement(current_rss(), tracing)
+
+	def end(self, route):
+		"""Finish measuring the calling thread's request; return its MemoryUsage, or None"""
+		if not self._active:
+			return None
+		measurement = self._active.pop(threading.get_ident(), None)
+		if measurement is None:
+			return None
+
+		allocated = peak = top_sites = None
+		if measurement.tracing:
+			try:
+				allocated, peak = tracemalloc.get_traced_memory()
+				if allocated >= TOP_SITES_MIN_BYTES:
+					statistics = tracemalloc.take_snapshot().statistics("lineno")[:TOP_SITES]
+					top_sites = [
+						f"{stat.traceback[0].filename}:{stat.traceback[0].lineno} {round(stat.size / 1024)} KB in {stat.count}"
+						for stat in statistics
+					]
+			finally:
+				tracemalloc.stop()
+				self._tracing.release()
+
+		rss = current_rss()
+		rss_delta = rss - measurement.rss if rss is not None and measurement.rss is not None else None
+		usage = MemoryUsage(rss_delta, allocated, peak, top_sites)
+
+		with self._lock:
+			self.measured += 1
+			totals = self._routes.get(route)
+			if totals is None:
+				if len(self._routes) >= self.max_routes:
+					route = OVERFLOW_ROUTE
+					totals = self._routes.get(route)
+				if totals is None:
+					# requests, rss delta sum, rss delta max, traced requests, allocated sum
+					totals = self._routes[route] = [0, 0, None, 0, 0]
+			totals[0] += 1
+			if rss_delta is not None:
+				totals[1] += rss_delta
+				totals[2] = rss_delta if totals[2] is None else max(totals[2], rss_delta)
+			if allocated is not None:
+				totals[3] += 1
+				totals[4] += allocated
+		return usage
+
+	def collect(self):
+		"""Return the per-route totals since the last call and start over"""
+		with self._lock:
+			routes, self._routes = self._routes, {}
+		return routes
@@ -0,0 +1,255 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Custom metric sets reported through the agent's metrics registry
+
+Metric sets are registered on the client with register_metricset() and are
+collected by the agent every ELASTIC_APM_METRICS_INTERVAL.
+"""
+
+import logging
+import time
+from collections import deque
+
+from elasticapm.metrics.base_metrics import MetricSet
+
+from erpnext_apm.gc_pauses import GcMonitor
+from erpnext_apm.histograms import Histogram, RouteHistograms, bucket_midpoint, percentiles
+from erpnext_apm.memory import MemoryTracker, current_rss
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerMetricSet(MetricSet):
+	"""Scheduler tick duration, overruns and queue backlog"""
+
+	def record_tick(self, duration, interval, sites, jobs_enqueued, backlog):
+		self.gauge("scheduler.tick.duration.ms").val = duration * 1000
+		self.gauge("scheduler.tick.sites").val = sites
+		self.gauge("scheduler.tick.jobs_enqueued").val = jobs_enqueued
+		self.counter("scheduler.tick.count").inc()
+		if interval and duration > interval:
+			self.counter("scheduler.tick.overrun").inc()
+		for queue, length in backlog.items():
+			self.gauge("scheduler.queue.backlog", queue=queue).val = length
+
+
+class RouteLatencyMetricSet(MetricSet):
+	"""
+	Per-route latency histograms of every request, sampled or not
+
+	Each collection sends one metricset per route seen in the interval,
+	with the non-empty buckets as a histogram (bucket midpoints in us) and
+	the request count and p50/p95/p99 in ms as plain values.
+	"""
+
+	QUANTILES = (0.5, 0.95, 0.99)
+
+	def __init__(self, registry):
+		super().__init__(registry)
+		self.histograms = RouteHistograms()
+
+	def collect(self):
+		timestamp = int(time.time() * 1000000)
+		for route, counts in self.histograms.collect().items():
+			values, bucket_counts = [], []
+			for index, count in enumerate(counts):
+				if count:
+					values.append(bucket_midpoint(index))
+					bucket_counts.append(count)
+			if not bucket_counts:
+				continue
+
+			samples = {
+				"route.duration.us": {"values": values, "counts": bucket_counts, "type": "histogram"},
+				"route.requests": {"value": sum(bucket_counts)},
+			}
+			for quantile, value in zip(self.QUANTILES, percentiles(counts, self.QUANTILES), strict=True):
+				samples[f"route.duration.p{round(quantile * 100)}.ms"] = {"value": value / 1000, "type": "gauge"}
+
+			yield self.before_yield(
+				{
+					"samples": samples,
+					"timestamp": timestamp,
+					"tags": {"route": route},
+					"transaction": {"name": route, "type": "request"},
+				}
+			)
+
+
+class ConcurrencyMetricSet(MetricSet):
+	"""
+	Requests in flight and thread utilization of the worker and its pool
+
+	Every worker sends its current and peak in-flight requests, its thread
+	capacity and the share of thread time spent in requests over the
+	interval. The worker reporting for the pool also sends the same summed
+	over all live workers of its gunicorn master, tagged scope=pool.
+	"""
+
+	def __init__(self, registry):
+		super().__init__(registry)
+		# Set up by the bootstrap, which knows the worker's thread count
+		self.tracker = None
+
+	def collect(self):
+		if self.tracker is None:
+			return
+
+		worker, pool = self.tracker.collect()
+		timestamp = int(time.time() * 1000000)
+		for scope, figures in (("worker", worker), ("pool", pool)):
+			if figures is None:
+				continue
+			samples = {
+				f"concurrency.{name}": {"value": value, "type": "gauge"} for name, value in figures.items()
+			}
+			yield self.before_yield({"samples": samples, "timestamp": timestamp, "tags": {"scope": scope}})
+
+
+class QueueTimeMetricSet(MetricSet):
+	"""
+	Time requests waited for a free worker, from the front proxy's stamp
+
+	Each collection sends the histogram of the interval (bucket midpoints
+	in us), the number of requests and p50/p95/p99 in ms.
+	"""
+
+	QUANTILES = (0.5, 0.95, 0.99)
+
+	def __init__(self, registry):
+		super().__init__(registry)
+		self.histogram = Histogram()
+
+	def collect(self):
+		counts = self.histogram.collect()
+		values, bucket_counts = [], []
+		for index, count in enumerate(counts):
+			if count:
+				values.append(bucket_midpoint(index))
+				bucket_counts.append(count)
+		if not bucket_counts:
+			return
+
+		samples = {
+			"request.queue.us": {"values": values, "counts": bucket_counts, "type": "histogram"},
+			"request.queue.requests": {"value": sum(bucket_counts)},
+		}
+		for quantile, value in zip(self.QUANTILES, percentiles(counts, self.QUANTILES), strict=True):
+			samples[f"request.queue.p{round(quantile * 100)}.ms"] = {"value": value / 1000, "type": "gauge"}
+
+		yield self.before_yield({"samples": samples, "timestamp": int(time.time() * 1000000)})
+
+
+class GcMetricSet(MetricSet):
+	"""
+	Garbage collector pauses of the worker, per generation
+
+	Each collection sends one metricset per generation that ran in the
+	interval, with the pause histogram (bucket midpoints in us), the number
+	of collections, the total pause in ms and the objects collected.
+	"""
+
+	def __init__(self, registry):
+		super().__init__(registry)
+		self.monitor = GcMonitor()
+
+	def collect(self):
+		timestamp = int(time.time() * 1000000)
+		histograms, pauses, collected = self.monitor.collect()
+		for generation, counts in enumerate(histograms):
+			values, bucket_counts = [], []
+			for index, count in enumerate(counts):
+				if count:
+					values.append(bucket_midpoint(index))
+					bucket_counts.append(count)
+			if not bucket_counts:
+				continue
+
+			yield self.before_yield(
+				{
+					"samples": {
+						"gc.pause.us": {"values": values, "counts": bucket_counts, "type": "histogram"},
+						"gc.collections": {"value": sum(bucket_counts)},
+						"gc.pause.total.ms": {"value": pauses[generation] * 1000},
+						"gc.collected": {"value": collected[generation]},
+					},
+					"timestamp": timestamp,
+					"tags": {"generation": str(generation)},
+				}
+			)
+
+
+def _slope(points):
+	"""Least squares slope of (x, y) points"""
+	count = len(points)
+	mean_x = sum(x for x, _y in points) / count
+	mean_y = sum(y for _x, y in points) / count
+	variance = sum((x - mean_x) ** 2 for x, _y in points)
+	if not variance:
+		return 0.0
+	return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+class MemoryMetricSet(MetricSet):
+	"""
+	Worker RSS and its trend, and per-route memory growth of measured requests
+
+	The trend is the least squares slope of the RSS over the last
+	TREND_POINTS collections, in bytes per hour; a worker whose trend stays
+	positive under steady traffic is leaking. Per route, each collection
+	sends the measured request count and the mean and max RSS delta, and
+	the mean allocations still alive at the end of the requests traced with
+	tracemalloc.
+	"""
+
+	TREND_POINTS = 60
+
+	def __init__(self, registry):
+		super().__init__(registry)
+		self.tracker = MemoryTracker()
+		self._rss = deque(maxlen=self.TREND_POINTS)
+
+	def before_collect(self):
+		rss = current_rss()
+		if rss is None:
+			return
+		self._rss.append((time.monotonic() / 3600, rss))
+		self.gauge("memory.rss.bytes").val = rss
+		if len(self._rss) >= 3:
+			self.gauge("memory.rss.trend.bytes_per_hour").val = _slope(self._rss)
+
+	def collect(self):
+		yield from super().collect()
+
+		timestamp = int(time.time() * 1000000)
+		for route, (requests, rss_sum, rss_max, traced, allocated) in self.tracker.collect().items():
+			samples = {"route.memory.requests": {"value": requests}}
+			if rss_max is not None:
+				samples["route.memory.rss_delta.mean.bytes"] = {"value": rss_sum / requests, "type": "gauge"}
+				samples["route.memory.rss_delta.max.bytes"] = {"value": rss_max, "type": "gauge"}
+			if traced:
+				samples["route.memory.allocated.mean.bytes"] = {"value": allocated / traced, "type": "gauge"}
+
+			yield self.before_yield(
+				{
+					"samples": samples,
+					"timestamp": timestamp,
+					"tags": {"route": route},
+					"transaction": {"name": route, "type": "request"},
+				}
+			)
+
+
+def register_metricset(client, metricset_class):
+	"""Register a metric set on the client, returning None if metrics are unavailable"""
+	try:
+		metricset = client.metrics.register(metricset_class)
+	except Exception as e:
+		logger.warning(f"Failed to register {metricset_class.__name__}, its metrics are not sent: {e}")
+		return None
+	if metricset is None:
+		# Older agents do not hand the instance back
+		logger.warning(f"elastic-apm returned no {metricset_class.__name__}, its metrics are not sent")
+	return metricset
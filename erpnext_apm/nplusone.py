@@ -0,0 +1,209 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Online N+1 query and repeated get_doc detection
+
+Each transaction keeps a small counter table keyed by SQL fingerprint and
+by (doctype, name) for frappe.get_doc. The first `threshold` calls of a key
+are recorded as usual; the ones after that are folded into one aggregated
+"N+1" span, emitted when the transaction ends, that carries the count and
+total time of the folded calls and the call site of the first of them.
+"""
+
+import functools
+import logging
+import os
+import sys
+import time
+
+import elasticapm
+
+from erpnext_apm.state import current_state
+
+logger = logging.getLogger(__name__)
+
+# Frames from these paths are skipped when looking for the call site
+_INTERNAL_PATHS = tuple(
+	os.path.join(*parts)
+	for parts in (
+		("erpnext_apm", ""),
+		("frappe", "database", ""),
+		("frappe", "query_builder", ""),
+		("frappe", "model", "db_query.py"),
+		("frappe", "__init__.py"),
+		("elasticapm", ""),
+	)
+)
+
+_threshold = 0
+_max_patterns = 256
+_db_type = "mariadb"
+
+
+def configure(threshold=10, max_patterns=256, db_type="mariadb"):
+	"""Set the detection threshold (0 disables) and the per-transaction table size"""
+	global _threshold, _max_patterns, _db_type
+	_threshold = threshold
+	_max_patterns = max_patterns
+	_db_type = db_type
+
+
+def _call_site():
+	"""Return "path:line in function" for the first frame outside Frappe's DB layer"""
+	frame = sys._getframe(2)
+	while frame is not None:
+		filename = frame.f_code.co_filename
+		if not any(path in filename for path in _INTERNAL_PATHS):
+			marker = filename.find(f"{os.sep}apps{os.sep}")
+			if marker >= 0:
+				filename = filename[marker + 6 :]
+			return f"{filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+		frame = frame.f_back
+	return "unknown"
+
+
+class Pattern:
+	"""Counter for one fingerprint or (doctype, name) key"""
+
+	__slots__ = ("aggregated_count", "aggregated_time", "call_site", "count", "start")
+
+	def __init__(self):
+		self.count = 0
+		self.aggregated_count = 0
+		self.aggregated_time = 0.0
+		self.start = None
+		self.call_site = None
+
+	def aggregate(self, duration):
+		"""Fold one call past the threshold into the aggregated span"""
+		if self.start is None:
+			self.start = time.time() - duration
+		self.aggregated_count += 1
+		self.aggregated_time += duration
+
+
+class NPlusOneDetector:
+	"""Per-transaction counter table"""
+
+	__slots__ = ("fetches", "queries")
+
+	def __init__(self):
+		self.queries = {}
+		self.fetches = {}
+
+	def _track(self, table, key):
+		"""Count a call; return its pattern if the call is past the threshold and is to be folded"""
+		pattern = table.get(key)
+		if pattern is None:
+			if len(table) >= _max_patterns:
+				return None
+			pattern = table[key] = Pattern()
+
+		pattern.count += 1
+		if pattern.count <= _threshold:
+			return None
+		if pattern.call_site is None:
+			pattern.call_site = _call_site()
+		return pattern
+
+	def emit(self):
+		"""Record one aggregated span per detected pattern and return transaction labels"""
+		detected = 0
+		worst = None
+
+		for (fingerprint, signature), pattern in self.queries.items():
+			if not pattern.aggregated_count:
+				continue
+			detected += 1
+			if worst is None or pattern.aggregated_count > worst.aggregated_count:
+				worst = pattern
+			# ORM calls are tracked under their span name, with no statement
+			extra = {"db": {"type": "sql", "statement": fingerprint}} if fingerprint != signature else None
+			with elasticapm.capture_span(
+				f"N+1: {signature}",
+				span_type="db",
+				span_subtype=_db_type,
+				span_action="query",
+				extra=extra,
+				labels={"n_plus_one_count": pattern.aggregated_count, "call_site": pattern.call_site},
+				start=pattern.start,
+				duration=pattern.aggregated_time,
+				leaf=True,
+			):
+				pass
+
+		for (doctype, name), pattern in self.fetches.items():
+			if not pattern.aggregated_count:
+				continue
+			detected += 1
+			if worst is None or pattern.aggregated_count > worst.aggregated_count:
+				worst = pattern
+			with elasticapm.capture_span(
+				f"N+1: get_doc {doctype}",
+				span_type="app",
+				span_subtype="frappe",
+				span_action="get_doc",
+				labels={"n_plus_one_count": pattern.aggregated_count, "call_site": pattern.call_site, "docname": name},
+				start=pattern.start,
+				duration=pattern.aggregated_time,
+			):
+				pass
+
+		if not detected:
+			return {}
+		return {"n_plus_one_patterns": detected, "n_plus_one_call_site": worst.call_site}
+
+
+def track_query(state, fingerprint, signature):
+	"""
+	Count a query for the transaction
+
+	Returns the pattern once the fingerprint has crossed the threshold, in
+	which case the caller should time the call into it instead of recording
+	an individual span.
+	"""
+	if not _threshold:
+		return None
+
+	detector = state.detector
+	if detector is None:
+		detector = state.detector = NPlusOneDetector()
+	return detector._track(detector.queries, (fingerprint, signature))
+
+
+def _wrap_get_doc(original):
+	@functools.wraps(original)
+	def get_doc(*args, **kwargs):
+		state = current_state()
+		if state is None or not _threshold or len(args) < 2 or not isinstance(args[1], str):
+			return original(*args, **kwargs)
+
+		detector = state.detector
+		if detector is None:
+			detector = state.detector = NPlusOneDetector()
+
+		pattern = detector._track(detector.fetches, (args[0], args[1]))
+		started = time.perf_counter()
+		try:
+			return original(*args, **kwargs)
+		finally:
+			if pattern is not None:
+				pattern.aggregate(time.perf_counter() - started)
+
+	get_doc._erpnext_apm_patched = True
+	return get_doc
+
+
+def install_get_doc_tracking():
+	"""Patch frappe.get_doc to count repeated (doctype, name) fetches"""
+	try:
+		import frappe
+	except ImportError:
+		return False
+
+	if getattr(frappe.get_doc, "_erpnext_apm_patched", False):
+		return True
+
+	frappe.get_doc = _wrap_get_doc(frappe.get_doc)
+	return True
@@ -0,0 +1,195 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Bounded event pipeline between the tracer and the agent's transport
+
+Span and transaction events are appended to a fixed-size per-process buffer
+and handed to the transport in batches by a background thread, when a batch
+is full or the flush interval has passed. Request threads only ever take a
+short lock to append; they never wait for serialization or the network.
+
+When the buffer is full an event is dropped according to the drop policy:
+"drop_oldest" evicts the oldest buffered event, "drop_unsampled" first
+evicts events of unsampled transactions (which carry no spans) and only
+then the oldest. Batches are held back while the transport's own queue is
+full, so events are dropped - and counted - here rather than silently
+inside the agent.
+
+The pipeline is installed as the innermost stage of the tracer's queue
+function, directly in front of the client's queue.
+"""
+
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION = "transaction"
+
+DROP_OLDEST = "drop_oldest"
+DROP_UNSAMPLED = "drop_unsampled"
+DROP_POLICIES = (DROP_OLDEST, DROP_UNSAMPLED)
+
+
+def _transport_has_room(client, count):
+	"""Whether the agent's transport queue can take `count` more events"""
+	try:
+		queue = client._transport._event_queue
+	except AttributeError:
+		return True
+	return not queue.maxsize or queue.qsize() + count <= queue.maxsize
+
+
+class EventPipeline:
+	"""
+	Per-worker ring buffer with batched, non-blocking hand-off
+
+	`queue_func` receives the events on the flush thread; `has_room(count)`
+	tells whether the next stage can take a batch without dropping it.
+	"""
+
+	def __init__(
+		self,
+		queue_func,
+		has_room=None,
+		capacity=2048,
+		batch_size=256,
+		flush_interval_ms=1000,
+		drop_policy=DROP_UNSAMPLED,
+	):
+		if drop_policy not in DROP_POLICIES:
+			raise ValueError(f"Unknown drop policy {drop_policy!r}, expected one of {DROP_POLICIES}")
+
+		self._queue_func = queue_func
+		self._has_room = has_room
+		self.capacity = max(int(capacity), 1)
+		self.batch_size = max(int(batch_size), 1)
+		self.flush_interval = max(flush_interval_ms, 1) / 1000
+		self.drop_policy = drop_policy
+
+		self._events = deque()
+		# Unsampled transaction events, evicted first under DROP_UNSAMPLED
+		self._unsampled = deque()
+		self._lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._thread = None
+		self._pid = None
+		self._closed = False
+
+		self.enqueued = 0
+		self.flushed = 0
+		self.dropped = 0
+		self.dropped_unsampled = 0
+		self.held_back = 0
+
+	def __call__(self, event_type, data, flush=False):
+		if self._pid != os.getpid():
+			self._start()
+
+		unsampled = (
+			self.drop_policy == DROP_UNSAMPLED and event_type == TRANSACTION and not data.get("sampled", True)
+		)
+
+		with self._lock:
+			if len(self._events) + len(self._unsampled) >= self.capacity:
+				if self._unsampled:
+					self._unsampled.popleft()
+					self.dropped_unsampled += 1
+				elif self._events:
+					self._events.popleft()
+				self.dropped += 1
+
+			(self._unsampled if unsampled else self._events).append((event_type, data))
+			self.enqueued += 1
+			pending = len(self._events) + len(self._unsampled)
+
+		if flush or pending >= self.batch_size:
+			self._wakeup.set()
+
+	def _start(self):
+		"""Start the flush thread for this process (again, after a fork)"""
+		with self._lock:
+			if self._pid == os.getpid():
+				return
+			self._pid = os.getpid()
+			self._wakeup = threading.Event()
+			self._thread = threading.Thread(target=self._run, name="erpnext_apm event pipeline", daemon=True)
+			self._thread.start()
+
+	def _take(self):
+		with self._lock:
+			batch = []
+			while self._events and len(batch) < self.batch_size:
+				batch.append(self._events.popleft())
+			while self._unsampled and len(batch) < self.batch_size:
+				batch.append(self._unsampled.popleft())
+			return batch
+
+	def _pending(self):
+		return len(self._events) + len(self._unsampled)
+
+	def _drain(self):
+		"""Hand buffered events on in batches while the next stage has room"""
+		while self._pending():
+			if self._has_room is not None and not self._has_room(min(self._pending(), self.batch_size)):
+				self.held_back += 1
+				return
+
+			batch = self._take()
+			for event_type, data in batch:
+				try:
+					self._queue_func(event_type, data)
+				except Exception as e:
+					logger.debug(f"Failed to hand {event_type} event to the transport: {e}")
+			self.flushed += len(batch)
+
+	def _run(self):
+		while not self._closed:
+			self._wakeup.wait(self.flush_interval)
+			self._wakeup.clear()
+			try:
+				self._drain()
+			except Exception as e:
+				logger.debug(f"Event pipeline flush failed: {e}")
+
+	def flush(self):
+		"""Hand on what is buffered now, from the calling thread"""
+		self._drain()
+
+	def close(self):
+		"""Stop the flush thread and hand on what is left"""
+		# Events copied into a forked child belong to the parent's client
+		if self._pid != os.getpid():
+			return
+		self._closed = True
+		self._wakeup.set()
+		self._thread.join(self.flush_interval)
+		self._drain()
+
+	def stats(self):
+		"""Return event counters and buffer usage"""
+		return {
+			"enqueued": self.enqueued,
+			"flushed": self.flushed,
+			"dropped": self.dropped,
+			"dropped_unsampled": self.dropped_unsampled,
+			"held_back": self.held_back,
+			"buffered": self._pending(),
+			"capacity": self.capacity,
+		}
+
+
+def install_event_pipeline(client, **kwargs):
+	"""Install an EventPipeline in front of the client's tracer queue"""
+	pipeline = EventPipeline(
+		client.tracer.queue_func, has_room=lambda count: _transport_has_room(client, count), **kwargs
+	)
+	client.tracer.queue_func = pipeline
+	# Registered after the client's own atexit handler, so it runs first
+	atexit.register(pipeline.close)
+	logger.info(f"APM event pipeline enabled (capacity {pipeline.capacity}, {pipeline.drop_policy})")
+	return pipeline
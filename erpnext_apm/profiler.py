@@ -0,0 +1,283 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Sampling profiler for web requests
+
+A background thread wakes up PROFILER_HZ times a second, takes
+sys._current_frames() and folds the stack of every thread that is serving
+a request into a tuple of "module.function" labels, cut at the innermost
+PROFILER_MAX_DEPTH frames. Threads that are not in a request are never
+walked, so the cost depends on the number of requests in flight, not on the
+number of threads, and a thread still in the frame it was in at the last
+tick - typically waiting on the database - is not walked again.
+
+Samples are counted per request while it runs. When it ends they are added
+to the aggregates of its route template, and a slow transaction gets its
+own top stacks attached as custom context. Every PROFILER_EXPORT_INTERVAL
+seconds the aggregates are written to PROFILER_DIR/<pid>.folded in the
+folded-stack format of flamegraph.pl and speedscope, one line per stack
+with the route as the root frame:
+
+	python -m erpnext_apm.profiler <PROFILER_DIR> ["GET /api/method/<method>"]
+
+prints the stacks of all workers summed, for the given route or all of them.
+"""
+
+import glob
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from erpnext_apm.histograms import OVERFLOW_ROUTE
+
+logger = logging.getLogger(__name__)
+
+TRUNCATED = "<truncated>"
+# Stacks attached to a slow transaction
+TOP_STACKS = 20
+
+
+class _Request:
+	"""Samples of one request in flight"""
+
+	__slots__ = ("frame", "route", "samples", "stack")
+
+	def __init__(self, route):
+		self.route = route
+		self.samples = Counter()
+		# Innermost frame at the last tick, held until the next one, and its folded stack
+		self.frame = None
+		self.stack = None
+
+
+class StackProfiler:
+	"""Samples the stacks of the threads serving requests and aggregates them per route"""
+
+	def __init__(
+		self,
+		hz=100,
+		slow_threshold_ms=2000,
+		max_depth=32,
+		max_stacks=1000,
+		max_routes=500,
+		directory=None,
+		export_interval=60,
+	):
+		self.hz = max(float(hz), 1.0)
+		self.interval = 1.0 / self.hz
+		self.slow_threshold = slow_threshold_ms / 1000 if slow_threshold_ms else None
+		self.max_depth = max_depth
+		self.max_stacks = max_stacks
+		self.max_routes = max_routes
+		self.directory = directory
+		self.export_interval = export_interval
+
+		# Thread ident -> _Request; only written by the request threads
+		self._active = {}
+		self._labels = {}
+		self._lock = threading.Lock()
+		self._routes = {}
+		self.ticks = 0
+		self.samples = 0
+		self.busy = 0.0
+		self._thread = None
+		self._stopped = threading.Event()
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name="erpnext_apm profiler", daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+
+	def enter(self, route):
+		"""Start sampling the calling thread for a request of `route`"""
+		self._active[threading.get_ident()] = _Request(route)
+
+	def exit(self):
+		"""Stop sampling the calling thread; return its samples, added to the route aggregates"""
+		request = self._active.pop(threading.get_ident(), None)
+		if request is None or not request.samples:
+			return None
+		# The sampler may still be counting into it; dict() copies in one step
+		samples = Counter(dict(request.samples))
+
+		with self._lock:
+			stacks = self._routes.get(request.route)
+			if stacks is None:
+				route = request.route if len(self._routes) < self.max_routes else OVERFLOW_ROUTE
+				stacks = self._routes.setdefault(route, Counter())
+			for stack, count in samples.items():
+				if stack not in stacks and len(stacks) >= self.max_stacks:
+					stack = (TRUNCATED,)
+				stacks[stack] += count
+		return samples
+
+	def is_slow(self, duration):
+		return self.slow_threshold is not None and duration >= self.slow_threshold
+
+	def summarize(self, samples):
+		"""Return the top stacks of a request's samples as custom context"""
+		return {
+			"hz": self.hz,
+			"samples": sum(samples.values()),
+			"stacks": [f"{';'.join(stack)} {count}" for stack, count in samples.most_common(TOP_STACKS)],
+		}
+
+	def _label(self, code, module):
+		label = self._labels.get(code)
+		if label is None:
+			label = f"{module}.{getattr(code, 'co_qualname', code.co_name)}"
+			if len(self._labels) < 65536:
+				self._labels[code] = label
+		return label
+
+	def _fold(self, frame):
+		"""Return the stack of a frame as labels, outermost first, cut at max_depth innermost frames"""
+		# Runs with the GIL held by the sampler, so every frame walked is time
+		# taken from the request threads
+		labels = self._labels
+		stack = []
+		for _ in range(self.max_depth):
+			if frame is None:
+				break
+			code = frame.f_code
+			label = labels.get(code)
+			if label is None:
+				label = self._label(code, frame.f_globals.get("__name__", "?"))
+			stack.append(label)
+			frame = frame.f_back
+		stack.reverse()
+		return tuple(stack)
+
+	def sample(self):
+		"""Take one sample of every thread serving a request"""
+		active = self._active
+		if not active:
+			return
+		frames = sys._current_frames()
+		for ident, request in list(active.items()):
+			frame = frames.get(ident)
+			if frame is None:
+				continue
+			# A thread still in the same frame as at the last tick (waiting on
+			# the database, a lock or the network) is still in the same stack
+			if frame is not request.frame:
+				request.frame = frame
+				request.stack = self._fold(frame)
+			request.samples[request.stack] += 1
+			self.samples += 1
+		del frames
+
+	def _run(self):
+		next_tick = time.monotonic()
+		next_export = next_tick + self.export_interval
+		while not self._stopped.is_set():
+			next_tick += self.interval
+			started = time.perf_counter()
+			try:
+				self.sample()
+			except Exception as e:
+				logger.debug(f"Profiler sample failed: {e}")
+			self.ticks += 1
+			self.busy += time.perf_counter() - started
+
+			now = time.monotonic()
+			if self.directory and now >= next_export:
+				next_export = now + self.export_interval
+				self.export()
+			if next_tick < now:
+				# Fell behind (GIL held by a request); skip the missed ticks
+				next_tick = now
+			self._stopped.wait(next_tick - now)
+
+	def folded(self):
+		"""Return the aggregated stacks as folded-stack lines, with the route as root frame"""
+		with self._lock:
+			routes = {route: dict(stacks) for route, stacks in self._routes.items()}
+		lines = []
+		for route, stacks in routes.items():
+			root = route.replace(";", ",")
+			for stack, count in stacks.items():
+				lines.append(f"{root};{';'.join(stack)} {count}")
+		return lines
+
+	def export(self):
+		"""Write the aggregates to this worker's folded file"""
+		path = os.path.join(self.directory, f"{os.getpid()}.folded")
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+				f.write("\n".join(self.folded()))
+			os.replace(f"{path}.tmp", path)
+		except OSError as e:
+			logger.debug(f"Failed to export profile to {path}: {e}")
+
+	def stats(self):
+		return {
+			"hz": self.hz,
+			"ticks": self.ticks,
+			"samples": self.samples,
+			"in_flight": len(self._active),
+			"routes": len(self._routes),
+			"busy_ms": round(self.busy * 1000, 1),
+		}
+
+
+def merge_folded(directory, route=None):
+	"""Sum the folded files of all workers, optionally for one route only"""
+	totals = Counter()
+	prefix = f"{route.replace(';', ',')};" if route else None
+	for path in glob.glob(os.path.join(directory, "*.folded")):
+		try:
+			with open(path, encoding="utf-8") as f:
+				lines = f.read().splitlines()
+		except OSError:
+			continue
+		for line in lines:
+			stack, _sep, count = line.rpartition(" ")
+			if not stack or (prefix and not stack.startswith(prefix)):
+				continue
+			try:
+				totals[stack] += int(count)
+			except ValueError:
+				continue
+	return totals
+
+
+def install_profiler(config):
+	"""Start a sampling profiler thread for this worker"""
+	if not hasattr(sys, "_current_frames"):
+		logger.warning("sys._current_frames() is not available, APM profiler disabled")
+		return None
+
+	profiler = StackProfiler(
+		hz=config.get("PROFILER_HZ", 100),
+		slow_threshold_ms=config.get("SLOW_THRESHOLD_MS", 2000),
+		max_depth=config.get("PROFILER_MAX_DEPTH", 32),
+		max_stacks=config.get("PROFILER_MAX_STACKS", 1000),
+		max_routes=config.get("MAX_TRANSACTION_NAMES", 500),
+		directory=config.get("PROFILER_DIR"),
+		export_interval=config.get("PROFILER_EXPORT_INTERVAL", 60),
+	)
+	profiler.start()
+	logger.info(f"APM profiler sampling at {profiler.hz:g} Hz")
+	return profiler
+
+
+def main(argv=None):
+	argv = sys.argv[1:] if argv is None else argv
+	if not argv:
+		print("usage: python -m erpnext_apm.profiler <PROFILER_DIR> [route]", file=sys.stderr)
+		return 2
+	for stack, count in sorted(merge_folded(argv[0], argv[1] if len(argv) > 1 else None).items()):
+		print(f"{stack} {count}")
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,491 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Prometheus exposition of the web workers' request and agent metrics
+
+Each web worker counts its requests into a small memory-mapped file of its
+own in PROMETHEUS_DIR: per-route request, error and latency bucket
+counters, the number of requests in flight, the time requests waited for a
+worker behind the front proxy, and the agent's pipeline,
+transport, breaker and spool counters (copied at most once a second, on
+requests). A scrape reads every file in the directory and sums them, so
+any worker can answer for the whole gunicorn pool, and its cost depends on
+the number of series, never on the traffic.
+
+A worker holds an flock on its file for life. Files whose lock is free
+belong to workers that have exited: their counters are still summed so
+totals never go down, their gauges are not. The next worker to start takes
+such a file over and keeps counting from where it stopped.
+
+File layout, all values little endian u64:
+
+	header (64 bytes): magic "EAPMPRM\\0", version, bucket count,
+	                   max routes, routes used, pid, 2 reserved
+	worker values: one per WORKER_FIELDS
+	queue time: duration sum in us, then one count per bucket and +Inf
+	route names: max routes * 128 bytes, utf-8, NUL padded
+	route counters: max routes * (3 + buckets + 1): requests, errors,
+	                duration sum in us, then one count per bucket and +Inf
+"""
+
+import errno
+import fcntl
+import glob
+import hmac
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from erpnext_apm.histograms import OVERFLOW_ROUTE
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"EAPMPRM\0"
+VERSION = 2
+HEADER_SIZE = 64
+NAME_SIZE = 128
+
+_HEADER = struct.Struct("<8s7Q")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds, the Prometheus client defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Per-worker values; counters carry on when a file is taken over, gauges
+# only count for live workers
+WORKER_COUNTERS = (
+	"pipeline_enqueued",
+	"pipeline_flushed",
+	"pipeline_dropped",
+	"pipeline_dropped_unsampled",
+	"pipeline_held_back",
+	"breaker_trips",
+	"breaker_shed",
+	"spool_dropped",
+)
+WORKER_GAUGES = ("in_flight", "pipeline_buffered", "transport_queued", "breaker_open", "spool_batches")
+WORKER_FIELDS = WORKER_GAUGES + WORKER_COUNTERS
+
+# Header values, as indexes into the file viewed as u64s
+_USED = 4
+_PID = 5
+
+_FIELD_INDEX = {name: HEADER_SIZE // 8 + i for i, name in enumerate(WORKER_FIELDS)}
+IN_FLIGHT = _FIELD_INDEX["in_flight"]
+
+SYNC_INTERVAL = 1.0
+
+# worker field, metric name, type, help
+_WORKER_METRICS = (
+	("in_flight", "http_requests_in_flight", "gauge", "Requests being served"),
+	("pipeline_buffered", "pipeline_buffered_events", "gauge", "Events waiting in the event pipeline"),
+	("pipeline_enqueued", "pipeline_enqueued_events_total", "counter", "Events put into the event pipeline"),
+	("pipeline_flushed", "pipeline_flushed_events_total", "counter", "Events handed to the agent transport"),
+	("pipeline_dropped", "pipeline_dropped_events_total", "counter", "Events dropped by a full event pipeline"),
+	(
+		"pipeline_dropped_unsampled",
+		"pipeline_dropped_unsampled_events_total",
+		"counter",
+		"Unsampled transaction events dropped by a full event pipeline",
+	),
+	("pipeline_held_back", "pipeline_held_back_total", "counter", "Flushes held back by a full transport queue"),
+	("transport_queued", "transport_queued_events", "gauge", "Events in the agent transport queue"),
+	("breaker_open", "breaker_open_workers", "gauge", "Workers whose circuit breaker is not closed"),
+	("breaker_trips", "breaker_trips_total", "counter", "Times a circuit breaker opened"),
+	("breaker_shed", "breaker_shed_requests_total", "counter", "Requests passed through by an open breaker"),
+	("spool_batches", "spool_batches", "gauge", "Event batches waiting in the disk spool"),
+	("spool_dropped", "spool_dropped_batches_total", "counter", "Event batches dropped by a full disk spool"),
+)
+
+
+class MetricsFileInUse(Exception):
+	"""The metrics file is locked by a live worker"""
+
+
+# Index of the queue time block
+QUEUE = HEADER_SIZE // 8 + len(WORKER_FIELDS)
+
+
+def _layout(bucket_count, max_routes):
+	"""Return (route names offset, route counters index, route width, file size)"""
+	names_at = (QUEUE + 1 + bucket_count) * 8
+	width = 3 + bucket_count
+	routes_at = names_at + max_routes * NAME_SIZE
+	return names_at, routes_at // 8, width, routes_at + max_routes * width * 8
+
+
+def _try_lock(fd, operation=fcntl.LOCK_EX):
+	try:
+		fcntl.flock(fd, operation | fcntl.LOCK_NB)
+	except OSError as e:
+		if e.errno in (errno.EAGAIN, errno.EACCES):
+			return False
+		raise
+	return True
+
+
+class WorkerMetrics:
+	"""One worker's request and agent counters, kept in a memory-mapped file"""
+
+	def __init__(self, directory, max_routes=500, stats=None):
+		self.directory = directory
+		self.max_routes = max(int(max_routes), 1)
+		self.bounds = LATENCY_BUCKETS
+		self._stats = stats
+		self._next_sync = 0.0
+		self._lock = threading.Lock()
+		self._slots = {}
+		self._base = dict.fromkeys(WORKER_COUNTERS, 0)
+		self.port = None
+
+		self._names_at, self._routes_at, self._width, self._size = _layout(len(self.bounds) + 1, self.max_routes)
+		os.makedirs(directory, exist_ok=True)
+		if not self._adopt():
+			self._create()
+
+		self._values = memoryview(self._mm).cast("Q")
+		for name in WORKER_GAUGES:
+			self._values[_FIELD_INDEX[name]] = 0
+		self._values[_PID] = os.getpid()
+
+	def _adopt(self):
+		"""Take over the file of a worker that has exited, if there is one"""
+		for path in glob.glob(os.path.join(self.directory, "*.prom")):
+			try:
+				fd = os.open(path, os.O_RDWR)
+			except OSError:
+				continue
+			try:
+				if not _try_lock(fd) or os.fstat(fd).st_size != self._size:
+					os.close(fd)
+					continue
+				magic, version, buckets, max_routes, used, _pid, _r1, _r2 = _HEADER.unpack(
+					os.pread(fd, _HEADER.size, 0)
+				)
+			except OSError:
+				os.close(fd)
+				continue
+			if (magic, version, buckets, max_routes) != (MAGIC, VERSION, len(self.bounds) + 1, self.max_routes):
+				os.close(fd)
+				continue
+
+			self.path, self._fd = path, fd
+			self._mm = mmap.mmap(fd, self._size)
+			for slot in range(min(used, self.max_routes)):
+				start = self._names_at + slot * NAME_SIZE
+				name = self._mm[start : start + NAME_SIZE].rstrip(b"\0").decode("utf-8", "ignore")
+				self._slots[name] = slot
+			for name in WORKER_COUNTERS:
+				self._base[name] = struct.unpack_from("<Q", self._mm, _FIELD_INDEX[name] * 8)[0]
+			logger.debug(f"Took over APM metrics file {path}")
+			return True
+		return False
+
+	def _create(self):
+		# Locked under a temporary name so no other worker can take it over first
+		path = os.path.join(self.directory, f"{os.getpid()}.prom")
+		temp = f"{path}.tmp"
+		self._fd = os.open(temp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+		if not _try_lock(self._fd):
+			os.close(self._fd)
+			raise MetricsFileInUse(temp)
+		os.ftruncate(self._fd, self._size)
+		self._mm = mmap.mmap(self._fd, self._size)
+		_HEADER.pack_into(self._mm, 0, MAGIC, VERSION, len(self.bounds) + 1, self.max_routes, 0, os.getpid(), 0, 0)
+		os.rename(temp, path)
+		self.path = path
+
+	def _slot(self, route):
+		"""Return the counter slot of a route, adding it if there is room"""
+		slot = self._slots.get(route)
+		if slot is not None:
+			return slot
+
+		used = len(self._slots)
+		if used >= self.max_routes - 1 and route != OVERFLOW_ROUTE:
+			return self._slot(OVERFLOW_ROUTE)
+
+		name = route.encode("utf-8")[:NAME_SIZE]
+		start = self._names_at + used * NAME_SIZE
+		self._mm[start : start + len(name)] = name
+		# Published after the name, so readers never see a half-written one
+		self._values[_USED] = used + 1
+		self._slots[route] = used
+		return used
+
+	def begin(self):
+		"""Count a request in flight"""
+		with self._lock:
+			self._values[IN_FLIGHT] += 1
+
+	def end(self, route, duration, error=False):
+		"""Count a finished request of `duration` seconds"""
+		bucket = bisect_left(self.bounds, duration)
+		now = time.monotonic()
+		with self._lock:
+			values = self._values
+			if values[IN_FLIGHT]:
+				values[IN_FLIGHT] -= 1
+			base = self._routes_at + self._slot(route) * self._width
+			values[base] += 1
+			if error:
+				values[base + 1] += 1
+			values[base + 2] += int(duration * 1000000)
+			values[base + 3 + bucket] += 1
+
+		if now >= self._next_sync:
+			self._next_sync = now + SYNC_INTERVAL
+			self.sync()
+
+	def queued(self, duration):
+		"""Count a request that waited `duration` seconds for the worker"""
+		bucket = bisect_left(self.bounds, duration)
+		with self._lock:
+			self._values[QUEUE] += int(duration * 1000000)
+			self._values[QUEUE + 1 + bucket] += 1
+
+	def sync(self):
+		"""Copy the agent stats into the file"""
+		if self._stats is None:
+			return
+		try:
+			stats = self._stats()
+		except Exception as e:
+			logger.debug(f"Failed to read APM agent stats: {e}")
+			return
+
+		with self._lock:
+			for name, value in stats.items():
+				self._values[_FIELD_INDEX[name]] = self._base.get(name, 0) + max(int(value), 0)
+
+	def stats(self):
+		return {"path": self.path, "routes": len(self._slots), "max_routes": self.max_routes, "port": self.port}
+
+
+def _read_file(path):
+	"""Return (live, worker values, queue time counters, {route: counters}) of a metrics file, or None"""
+	try:
+		fd = os.open(path, os.O_RDONLY)
+	except OSError:
+		return None
+	try:
+		data = os.read(fd, os.fstat(fd).st_size)
+		# A free lock means the worker has exited; probing with a shared lock
+		# never blocks a live worker
+		live = not _try_lock(fd, fcntl.LOCK_SH)
+	finally:
+		os.close(fd)
+
+	if len(data) < HEADER_SIZE:
+		return None
+	magic, version, buckets, max_routes, used, pid, _r1, _r2 = _HEADER.unpack_from(data)
+	if magic != MAGIC or version != VERSION or buckets != len(LATENCY_BUCKETS) + 1:
+		return None
+	names_at, routes_at, width, size = _layout(buckets, max_routes)
+	if len(data) != size:
+		return None
+
+	values = array("Q")
+	values.frombytes(data)
+	workers = {name: values[index] for name, index in _FIELD_INDEX.items()}
+	workers["pid"] = pid
+	queue = values[QUEUE : QUEUE + 1 + buckets]
+	routes = {}
+	for slot in range(min(used, max_routes)):
+		start = names_at + slot * NAME_SIZE
+		name = data[start : start + NAME_SIZE].rstrip(b"\0").decode("utf-8", "ignore")
+		base = routes_at + slot * width
+		routes[name] = values[base : base + width]
+	return live, workers, queue, routes
+
+
+def read_workers(directory):
+	"""Return the worker values of each metrics file, with its pid and whether the worker is live"""
+	workers = []
+	for path in sorted(glob.glob(os.path.join(directory, "*.prom"))):
+		result = _read_file(path)
+		if result is not None:
+			live, values, _queue, _routes = result
+			workers.append({"live": live, **values})
+	return workers
+
+
+def _escape(value):
+	return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(directory, prefix="erpnext_apm"):
+	"""Render the summed metrics of all worker files in the Prometheus text format"""
+	width = 3 + len(LATENCY_BUCKETS) + 1
+	routes = {}
+	workers = dict.fromkeys(WORKER_FIELDS, 0)
+	queue = [0] * (width - 2)
+	live_workers = 0
+
+	for path in sorted(glob.glob(os.path.join(directory, "*.prom"))):
+		result = _read_file(path)
+		if result is None:
+			continue
+		live, values, file_queue, file_routes = result
+		for i, value in enumerate(file_queue):
+			queue[i] += value
+		live_workers += live
+		for name in WORKER_COUNTERS:
+			workers[name] += values[name]
+		if live:
+			for name in WORKER_GAUGES:
+				workers[name] += values[name]
+		for route, counters in file_routes.items():
+			totals = routes.get(route)
+			if totals is None:
+				totals = routes[route] = [0] * width
+			for i, value in enumerate(counters):
+				totals[i] += value
+
+	lines = []
+
+	def header(name, kind, help_text):
+		lines.append(f"# HELP {prefix}_{name} {help_text}")
+		lines.append(f"# TYPE {prefix}_{name} {kind}")
+
+	header("workers", "gauge", "Live web workers reporting metrics")
+	lines.append(f"{prefix}_workers {live_workers}")
+
+	for field, name, kind, help_text in _WORKER_METRICS:
+		header(name, kind, help_text)
+		lines.append(f"{prefix}_{name} {workers[field]}")
+
+	bounds = [f"{bound:g}" for bound in LATENCY_BUCKETS] + ["+Inf"]
+
+	name = f"{prefix}_http_request_queue_seconds"
+	header("http_request_queue_seconds", "histogram", "Time requests waited for a worker behind the front proxy")
+	cumulative = 0
+	for bound, count in zip(bounds, queue[1:], strict=True):
+		cumulative += count
+		lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+	lines.append(f"{name}_sum {queue[0] / 1000000}")
+	lines.append(f"{name}_count {cumulative}")
+
+	labels = {route: f'route="{_escape(route)}"' for route in routes}
+
+	header("http_requests_total", "counter", "Requests served, by route")
+	for route, totals in routes.items():
+		lines.append(f"{prefix}_http_requests_total{{{labels[route]}}} {totals[0]}")
+
+	header("http_request_errors_total", "counter", "Requests that raised or returned a 5xx, by route")
+	for route, totals in routes.items():
+		lines.append(f"{prefix}_http_request_errors_total{{{labels[route]}}} {totals[1]}")
+
+	name = f"{prefix}_http_request_duration_seconds"
+	header("http_request_duration_seconds", "histogram", "Request latency, by route")
+	for route, totals in routes.items():
+		cumulative = 0
+		for bound, count in zip(bounds, totals[3:], strict=True):
+			cumulative += count
+			lines.append(f'{name}_bucket{{{labels[route]},le="{bound}"}} {cumulative}')
+		lines.append(f"{name}_sum{{{labels[route]}}} {totals[2] / 1000000}")
+		lines.append(f"{name}_count{{{labels[route]}}} {cumulative}")
+
+	lines.append("")
+	return "\n".join(lines)
+
+
+def serve_metrics(environ, start_response, directory, token):
+	"""Answer a WSGI request for the metrics, given the right bearer token"""
+	authorization = environ.get("HTTP_AUTHORIZATION", "")
+	if not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+		start_response("401 Unauthorized", [("Content-Type", "text/plain"), ("WWW-Authenticate", "Bearer")])
+		return [b"Unauthorized\n"]
+
+	body = render(directory).encode("utf-8")
+	start_response("200 OK", [("Content-Type", CONTENT_TYPE), ("Content-Length", str(len(body)))])
+	return [body]
+
+
+class _MetricsServer(ThreadingHTTPServer):
+	"""Shares its port with the other workers, any of which can answer"""
+
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def server_bind(self):
+		if hasattr(socket, "SO_REUSEPORT"):
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+		super().server_bind()
+
+
+def start_metrics_server(directory, port, host="0.0.0.0"):
+	"""Serve /metrics on a separate port from a background thread"""
+
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.path.split("?", 1)[0] != "/metrics":
+				self.send_error(404)
+				return
+			body = render(directory).encode("utf-8")
+			self.send_response(200)
+			self.send_header("Content-Type", CONTENT_TYPE)
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	server = _MetricsServer((host, port), Handler)
+	thread = threading.Thread(target=server.serve_forever, name="erpnext_apm metrics server", daemon=True)
+	thread.start()
+	return server
+
+
+def _agent_stats(runtime):
+	"""Current agent pipeline, transport, breaker and spool counters"""
+	stats = {}
+	if runtime.pipeline is not None:
+		pipeline = runtime.pipeline.stats()
+		stats["pipeline_enqueued"] = pipeline["enqueued"]
+		stats["pipeline_flushed"] = pipeline["flushed"]
+		stats["pipeline_dropped"] = pipeline["dropped"]
+		stats["pipeline_dropped_unsampled"] = pipeline["dropped_unsampled"]
+		stats["pipeline_held_back"] = pipeline["held_back"]
+		stats["pipeline_buffered"] = pipeline["buffered"]
+	try:
+		stats["transport_queued"] = runtime.client._transport._event_queue.qsize()
+	except (AttributeError, NotImplementedError):
+		pass
+	if runtime.breaker is not None:
+		breaker = runtime.breaker.stats()
+		stats["breaker_open"] = int(breaker["state"] != "closed")
+		stats["breaker_trips"] = breaker["trips"]
+		stats["breaker_shed"] = breaker["shed"]
+	if runtime.spool is not None:
+		spool = runtime.spool.spool.stats()
+		stats["spool_batches"] = spool["batches"]
+		stats["spool_dropped"] = spool["dropped"]
+	return stats
+
+
+def install_prometheus(runtime, directory, max_routes=500, port=0, host="0.0.0.0"):
+	"""Count this worker's requests into its metrics file, and serve them on `port`"""
+	try:
+		metrics = WorkerMetrics(directory, max_routes=max_routes, stats=lambda: _agent_stats(runtime))
+	except (OSError, MetricsFileInUse) as e:
+		logger.warning(f"Could not open an APM metrics file in {directory}: {e}")
+		return None
+	if port:
+		try:
+			start_metrics_server(directory, port, host)
+			metrics.port = port
+		except OSError as e:
+			logger.warning(f"Could not serve APM metrics on port {port}: {e}")
+	logger.info(f"APM Prometheus metrics in {metrics.path}")
+	return metrics
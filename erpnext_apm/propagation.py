@@ -0,0 +1,86 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Trace context propagation from web requests into enqueued jobs
+
+frappe.enqueue is patched to add the active transaction's traceparent to the
+job kwargs under TRACEPARENT_KEY. The before_job hook pops it back out before
+the job method runs and continues the trace from it, so a submit-then-process
+flow shows up as a single trace.
+
+The patch covers the whole process, but Frappe hooks are per site: on a
+multi-site bench only the sites that have erpnext_apm installed run
+before_job. The key is only added for jobs of those sites, as the method of
+any other site's job would be called with an argument it does not take.
+"""
+
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_KEY = "_apm_traceparent"
+
+
+def _site_pops_trace_parent():
+	"""Whether a job enqueued now for the current site reaches before_job to pop the key"""
+	import frappe
+
+	# Jobs run inline during migrations never reach before_job
+	if frappe.flags.in_migrate:
+		return False
+	return "erpnext_apm" in frappe.get_installed_apps()
+
+
+def _wrap_enqueue(original):
+	from elasticapm.traces import execution_context
+
+	@functools.wraps(original)
+	def enqueue(method, *args, **kwargs):
+		# Jobs run inline (now=True) never reach before_job either
+		transaction = execution_context.get_transaction()
+		if transaction is not None and not kwargs.get("now") and TRACEPARENT_KEY not in kwargs:
+			try:
+				if _site_pops_trace_parent():
+					kwargs[TRACEPARENT_KEY] = transaction.trace_parent.to_string()
+			except Exception as e:
+				logger.debug(f"Failed to attach traceparent to job: {e}")
+
+		return original(method, *args, **kwargs)
+
+	enqueue._erpnext_apm_patched = True
+	return enqueue
+
+
+def install_enqueue_propagation():
+	"""Patch frappe.utils.background_jobs.enqueue to carry the traceparent"""
+	try:
+		import frappe.utils.background_jobs as background_jobs
+	except ImportError:
+		return False
+
+	if getattr(background_jobs.enqueue, "_erpnext_apm_patched", False):
+		return True
+
+	# frappe.enqueue looks this up on every call, so patching the module covers both
+	background_jobs.enqueue = _wrap_enqueue(background_jobs.enqueue)
+	return True
+
+
+def pop_trace_parent(kwargs):
+	"""Remove the propagated traceparent from job kwargs and parse it"""
+	if not kwargs:
+		return None
+
+	value = kwargs.pop(TRACEPARENT_KEY, None)
+	if not value:
+		return None
+
+	try:
+		from elasticapm.utils.disttracing import TraceParent
+
+		return TraceParent.from_string(value)
+	except Exception as e:
+		logger.debug(f"Invalid propagated traceparent {value!r}: {e}")
+		return None
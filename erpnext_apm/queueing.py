@@ -0,0 +1,61 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Request queueing time from front-proxy headers
+
+nginx (proxy_set_header X-Request-Start "t=${msec}";) and most load
+balancers stamp the time a request arrived in X-Request-Start or
+X-Queue-Start. The time from that stamp to the middleware picking the
+request up is time spent waiting for a free gunicorn worker.
+
+The stamp is an epoch time, with or without a "t=" prefix, in seconds
+(nginx's ${msec}, "1700000000.123"), milliseconds, microseconds or
+nanoseconds; the unit is told from its magnitude.
+"""
+
+# WSGI environ keys, in order of preference
+REQUEST_START_KEYS = ("HTTP_X_REQUEST_START", "HTTP_X_QUEUE_START")
+
+# Stamps further in the future than this are clock skew gone wrong
+MAX_SKEW = 1.0
+# Longer waits than this are bogus stamps rather than queueing
+MAX_QUEUE_TIME = 3600.0
+
+
+def parse_request_start(value):
+	"""Return the epoch seconds of a request start stamp, or None if it cannot be read"""
+	value = value.strip()
+	if value.startswith("t="):
+		value = value[2:]
+	try:
+		start = float(value)
+	except ValueError:
+		return None
+
+	if start >= 1e17:
+		return start / 1e9
+	if start >= 1e14:
+		return start / 1e6
+	if start >= 1e11:
+		return start / 1e3
+	return start
+
+
+def request_start(environ):
+	"""Return the epoch seconds the front proxy received the request at, or None"""
+	for key in REQUEST_START_KEYS:
+		value = environ.get(key)
+		if value:
+			return parse_request_start(value)
+	return None
+
+
+def queue_time(start, now):
+	"""Return the seconds between a request start stamp and `now`, or None if implausible"""
+	if start is None:
+		return None
+	waited = now - start
+	if waited < -MAX_SKEW or waited > MAX_QUEUE_TIME:
+		return None
+	return max(waited, 0.0)
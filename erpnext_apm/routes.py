@@ -0,0 +1,126 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Route normalization for transaction names
+
+Frappe URLs embed document names (/api/resource/Sales Invoice/SINV-00123,
+/app/item/ITEM-42), so naming transactions after the raw path creates one
+transaction name per document. This module maps Frappe URL shapes to route
+templates and caps the number of distinct names a worker can produce.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+# Template used once the distinct name cap has been reached
+OVERFLOW_TEMPLATE = "/<other>"
+
+# Path segments that look like generated identifiers (numbers, naming series, hashes)
+_ID_SEGMENT_RE = re.compile(r"^(?:\d+|[A-Za-z]*[-.]?\d[\w.-]*|[0-9a-f]{10,})$")
+
+
+def _generic_template(segments):
+	"""Replace identifier-like segments of an arbitrary path"""
+	return "/" + "/".join("<id>" if _ID_SEGMENT_RE.match(segment) else segment for segment in segments)
+
+
+def normalize_path(path):
+	"""
+	Map a request path to its route template
+
+	- /api/resource/<doctype>/<name>   -> /api/resource/Sales Invoice/<name>
+	- /api/method/<dotted.path>        -> /api/method/frappe.client.get_list
+	- /api/v2/document/<doctype>/<name> -> /api/v2/document/Item/<name>
+	- /app/<doctype>/<name>            -> /app/item/<name>
+	- /assets/..., /files/..., /private/files/... -> /assets/*, /files/*, /private/files/*
+	"""
+	segments = [segment for segment in path.split("/") if segment]
+	if not segments:
+		return "/"
+
+	head = segments[0]
+	count = len(segments)
+
+	if head == "api" and count > 1:
+		kind = segments[1]
+		if kind == "resource":
+			if count > 3:
+				return f"/api/resource/{segments[2]}/<name>"
+			return "/" + "/".join(segments)
+		if kind == "method" and count > 2:
+			return f"/api/method/{segments[2]}"
+		if kind == "v2" and count > 2:
+			if segments[2] == "document" and count > 4:
+				return f"/api/v2/document/{segments[3]}/<name>" + ("/<method>" if count > 5 else "")
+			if segments[2] == "method" and count > 3:
+				return "/api/v2/method/" + "/".join(segments[3:5])
+			return "/" + "/".join(segments[:4])
+		return _generic_template(segments)
+
+	if head in ("app", "desk"):
+		if count > 2:
+			return f"/{head}/{segments[1]}/<name>"
+		return "/" + "/".join(segments)
+
+	if head in ("assets", "files"):
+		return f"/{head}/*"
+
+	if head == "private" and count > 1 and segments[1] == "files":
+		return "/private/files/*"
+
+	return _generic_template(segments)
+
+
+class RouteNormalizer:
+	"""
+	Memoizing route normalizer with a hard cap on distinct templates
+
+	Raw paths are kept in an LRU so a repeated path costs one dict lookup.
+	Once `max_names` distinct templates have been seen, new templates are
+	reported as OVERFLOW_TEMPLATE instead.
+	"""
+
+	def __init__(self, cache_size=4096, max_names=500):
+		self.cache_size = cache_size
+		self.max_names = max_names
+		self.overflowed = 0
+		self._cache = OrderedDict()
+		self._names = set()
+		self._lock = threading.Lock()
+
+	def normalize(self, path):
+		"""Return the (possibly overflowed) route template for a raw path"""
+		template = self._cache.get(path)
+		if template is not None:
+			try:
+				self._cache.move_to_end(path)
+			except KeyError:
+				# Evicted by another thread in between
+				pass
+			return template
+
+		template = normalize_path(path)
+
+		with self._lock:
+			if template not in self._names:
+				if len(self._names) >= self.max_names:
+					self.overflowed += 1
+					template = OVERFLOW_TEMPLATE
+				else:
+					self._names.add(template)
+
+			self._cache[path] = template
+			if len(self._cache) > self.cache_size:
+				self._cache.popitem(last=False)
+
+		return template
+
+	def stats(self):
+		"""Return cache and cardinality counters"""
+		return {
+			"cached_paths": len(self._cache),
+			"distinct_names": len(self._names),
+			"overflowed": self.overflowed,
+		}
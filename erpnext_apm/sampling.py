@@ -0,0 +1,132 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Head sampling for the WSGI middleware
+
+The decision is made per request, before a transaction is started:
+- each route template gets a sample rate from the first matching rule
+- sampled requests must also fit in a per-worker transactions-per-second budget
+  and, on a multi-site bench, in a budget of their site, so one site's
+  traffic cannot use up the worker's budget for the others
+- requests that were not sampled but turn out to be errors or slow are kept anyway
+"""
+
+import random
+import threading
+import time
+from fnmatch import fnmatchcase
+
+
+class TokenBucket:
+	"""
+	Token bucket limiting how many transactions a worker starts per second
+
+	A rate of 0 (or less) disables the limit.
+	"""
+
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.capacity = float(burst if burst is not None else max(self.rate, 1.0))
+		self.tokens = self.capacity
+		self._last = time.monotonic()
+		self._lock = threading.Lock()
+
+	def take(self):
+		"""Take one token, returning False if the budget is exhausted"""
+		if self.rate <= 0:
+			return True
+
+		with self._lock:
+			now = time.monotonic()
+			self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+			self._last = now
+			if self.tokens < 1.0:
+				return False
+			self.tokens -= 1.0
+			return True
+
+
+class Sampler:
+	"""
+	Per-route head sampler with a transactions-per-second budget
+
+	`route_rates` is a sequence of (pattern, rate) pairs matched in order
+	against the route template with fnmatch; the first match wins and
+	unmatched templates use `default_rate`. The resolved rate is memoized
+	per template, which is bounded by the route normalizer's name cap.
+
+	With `site_max_tps` set, each site also gets a bucket of its own, taken
+	from before the worker's. Buckets are created on a site's first request;
+	their number is bounded by the site resolver's cap.
+	"""
+
+	def __init__(
+		self, default_rate=1.0, route_rates=(), max_tps=0, slow_threshold_ms=2000, keep_errors=True, site_max_tps=0
+	):
+		self.default_rate = default_rate
+		self.route_rates = tuple(route_rates)
+		self.bucket = TokenBucket(max_tps)
+		self.site_max_tps = site_max_tps
+		self._site_buckets = {}
+		self._site_lock = threading.Lock()
+		self.slow_threshold = slow_threshold_ms / 1000.0 if slow_threshold_ms > 0 else None
+		self.keep_errors = keep_errors
+		self._rates = {}
+
+		self.sampled = 0
+		self.unsampled = 0
+		self.promoted = 0
+		self.site_throttled = 0
+
+	def rate_for(self, template):
+		"""Return the sample rate configured for a route template"""
+		rate = self._rates.get(template)
+		if rate is None:
+			rate = self.default_rate
+			for pattern, pattern_rate in self.route_rates:
+				if fnmatchcase(template, pattern):
+					rate = pattern_rate
+					break
+			self._rates[template] = rate
+		return rate
+
+	def _site_bucket(self, site):
+		bucket = self._site_buckets.get(site)
+		if bucket is None:
+			with self._site_lock:
+				bucket = self._site_buckets.get(site)
+				if bucket is None:
+					bucket = self._site_buckets[site] = TokenBucket(self.site_max_tps)
+		return bucket
+
+	def should_sample(self, template, site=None):
+		"""Decide up front whether to start a transaction for this request"""
+		rate = self.rate_for(template)
+		if rate >= 1.0 or (rate > 0.0 and random.random() < rate):
+			if site is not None and self.site_max_tps > 0 and not self._site_bucket(site).take():
+				self.site_throttled += 1
+			elif self.bucket.take():
+				self.sampled += 1
+				return True
+
+		self.unsampled += 1
+		return False
+
+	def keep_reason(self, status_code, duration, failed=False):
+		"""Return why an unsampled request must be kept anyway, or None"""
+		if self.keep_errors and (failed or (status_code is not None and status_code >= 500)):
+			return "error"
+		if self.slow_threshold is not None and duration >= self.slow_threshold:
+			return "slow"
+		return None
+
+	def stats(self):
+		"""Return sampling decision counters"""
+		return {
+			"sampled": self.sampled,
+			"unsampled": self.unsampled,
+			"promoted": self.promoted,
+			"site_throttled": self.site_throttled,
+			"sites": len(self._site_buckets),
+		}
@@ -0,0 +1,174 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Scheduler tick instrumentation
+
+Patches frappe.utils.scheduler so each tick of `bench schedule` is recorded
+as a "scheduler" transaction, with one child span per site and one per
+scheduled method actually enqueued. Tick duration, overruns and the RQ
+queue backlog are also reported as metrics, to show which sites or events
+make the scheduler fall behind.
+"""
+
+import functools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_installed = False
+
+# Per-tick counters, only touched by the scheduler's single loop thread
+_tick = None
+
+
+class _Tick:
+	__slots__ = ("jobs_enqueued", "sites")
+
+	def __init__(self):
+		self.sites = 0
+		self.jobs_enqueued = 0
+
+
+def _queue_backlog():
+	"""Return the number of jobs waiting in each RQ queue"""
+	try:
+		from frappe.utils.background_jobs import get_queue, get_queues_timeout
+
+		return {queue: get_queue(queue).count for queue in get_queues_timeout()}
+	except Exception as e:
+		logger.debug(f"Failed to read queue backlog: {e}")
+		return {}
+
+
+def _tick_interval():
+	try:
+		import frappe
+
+		return int(frappe.get_conf().get("scheduler_tick_interval") or 60)
+	except Exception:
+		return 60
+
+
+def _wrap_enqueue_events_for_all_sites(original):
+	@functools.wraps(original)
+	def enqueue_events_for_all_sites(*args, **kwargs):
+		global _tick
+
+		from erpnext_apm.bootstrap import get_runtime
+
+		runtime = get_runtime()
+		if runtime is None:
+			return original(*args, **kwargs)
+
+		import elasticapm
+
+		from erpnext_apm.state import end_state, start_state
+
+		client, metricset = runtime.client, runtime.scheduler_metrics
+		transaction = client.begin_transaction("scheduler")
+		if transaction is None:
+			return original(*args, **kwargs)
+
+		_tick = tick = _Tick()
+		start_state()
+		started = time.perf_counter()
+		try:
+			return original(*args, **kwargs)
+		except Exception:
+			client.capture_exception()
+			elasticapm.set_transaction_result("error", override=False)
+			raise
+		finally:
+			duration = time.perf_counter() - started
+			_tick = None
+
+			backlog = _queue_backlog()
+			interval = _tick_interval()
+			if metricset is not None:
+				metricset.record_tick(duration, interval, tick.sites, tick.jobs_enqueued, backlog)
+
+			state = end_state()
+			labels = state.finish() if state is not None else {}
+			labels.update(
+				sites=tick.sites,
+				jobs_enqueued=tick.jobs_enqueued,
+				overrun=duration > interval,
+				**{f"backlog_{queue}": length for queue, length in backlog.items()},
+			)
+			elasticapm.label(**labels)
+			elasticapm.set_transaction_result("success", override=False)
+			client.end_transaction("scheduler tick")
+
+	return enqueue_events_for_all_sites
+
+
+def _wrap_enqueue_events_for_site(original):
+	@functools.wraps(original)
+	def enqueue_events_for_site(site, *args, **kwargs):
+		tick = _tick
+		if tick is None:
+			return original(site, *args, **kwargs)
+
+		import elasticapm
+
+		tick.sites += 1
+		with elasticapm.capture_span(f"site {site}", span_type="scheduler", span_subtype="site", labels={"site": site}):
+			return original(site, *args, **kwargs)
+
+	return enqueue_events_for_site
+
+
+def _wrap_job_type_enqueue(original):
+	@functools.wraps(original)
+	def enqueue(self, *args, **kwargs):
+		tick = _tick
+		if tick is None:
+			return original(self, *args, **kwargs)
+
+		start = time.time()
+		started = time.perf_counter()
+		enqueued = original(self, *args, **kwargs)
+		if enqueued:
+			import elasticapm
+
+			# Only enqueued events get a span; the rest were not due or still queued
+			tick.jobs_enqueued += 1
+			with elasticapm.capture_span(
+				f"enqueue {self.method}",
+				span_type="scheduler",
+				span_subtype="event",
+				span_action="enqueue",
+				labels={"frequency": self.frequency},
+				start=start,
+				duration=time.perf_counter() - started,
+			):
+				pass
+		return enqueued
+
+	return enqueue
+
+
+def install_scheduler_instrumentation():
+	"""Patch the Frappe scheduler loop (idempotent)"""
+	global _installed
+
+	if _installed:
+		return True
+
+	try:
+		import frappe.utils.scheduler as scheduler
+		from frappe.core.doctype.scheduled_job_type.scheduled_job_type import ScheduledJobType
+	except ImportError as e:
+		logger.debug(f"Frappe scheduler not available ({e}), skipping scheduler instrumentation")
+		return False
+
+	# start_scheduler looks these up as module globals on every tick
+	scheduler.enqueue_events_for_all_sites = _wrap_enqueue_events_for_all_sites(scheduler.enqueue_events_for_all_sites)
+	scheduler.enqueue_events_for_site = _wrap_enqueue_events_for_site(scheduler.enqueue_events_for_site)
+	ScheduledJobType.enqueue = _wrap_job_type_enqueue(ScheduledJobType.enqueue)
+
+	_installed = True
+	logger.info("Frappe scheduler instrumentation installed")
+	return True
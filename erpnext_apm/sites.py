@@ -0,0 +1,74 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Site resolution for multi-tenant benches
+
+A bench serves many sites from the same workers. Frappe picks the site of a
+request from the X-Frappe-Site-Name header, or else from the Host header
+without its port; the middleware does the same before the request reaches
+Frappe, so the site can drive head sampling and label the transaction.
+
+The header value is memoized per raw value, so a repeated host costs one
+dict lookup. Host headers are client controlled: once `max_sites` distinct
+sites have been seen, new ones are reported as OVERFLOW_SITE.
+"""
+
+import threading
+
+# Site used once the distinct site cap has been reached
+OVERFLOW_SITE = "<other>"
+
+
+def site_name(host):
+	"""Strip the port from a Host header value"""
+	if host.startswith("["):
+		# IPv6 literal, [::1]:8000
+		return host.split("]", 1)[0] + "]"
+	return host.split(":", 1)[0]
+
+
+class SiteResolver:
+	"""Memoizing site resolver with a hard cap on distinct sites"""
+
+	def __init__(self, max_sites=200, cache_size=1024):
+		self.max_sites = max_sites
+		self.cache_size = cache_size
+		self.overflowed = 0
+		self._cache = {}
+		self._sites = set()
+		self._lock = threading.Lock()
+
+	def resolve(self, environ):
+		"""Return the site a request is for, or None if it names none"""
+		header = environ.get("HTTP_X_FRAPPE_SITE_NAME")
+		host = header or environ.get("HTTP_HOST") or environ.get("SERVER_NAME")
+		if not host:
+			return None
+
+		site = self._cache.get(host)
+		if site is not None:
+			return site
+
+		site = host if header else site_name(host)
+		with self._lock:
+			if site not in self._sites:
+				if len(self._sites) >= self.max_sites:
+					self.overflowed += 1
+					site = OVERFLOW_SITE
+				else:
+					self._sites.add(site)
+
+			# Stop memoizing rather than evict; misses only cost the split
+			if len(self._cache) < self.cache_size:
+				self._cache[host] = site
+
+		return site
+
+	def stats(self):
+		"""Return cache and cardinality counters"""
+		return {
+			"cached_hosts": len(self._cache),
+			"distinct_sites": len(self._sites),
+			"overflowed": self.overflowed,
+		}
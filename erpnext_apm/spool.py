@@ -0,0 +1,377 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Disk spool for event batches the APM server could not take
+
+Each worker owns a fixed-size ring file, memory-mapped and locked with
+flock for the life of the process. The batches are the transport's own
+request bodies (gzip-compressed NDJSON with metadata), so they can be
+replayed byte for byte. A batch is spooled when a send fails, and without
+trying while the circuit breaker is open. A background replayer drains the
+file at a rate limit once the breaker is closed, and also adopts files
+left behind by workers that have exited (their lock is free).
+
+File layout, all integers little endian:
+
+	header (64 bytes): magic "EAPMSPL\\0", u16 version, u16 reserved,
+	                   u64 capacity, u64 head, u64 tail
+	data (capacity bytes): ring of records, each u32 length, u32 crc32,
+	                       then the payload; records wrap around the end
+
+head and tail are logical offsets that only grow; the position in the ring
+is offset % capacity. A record is written in full before tail is moved past
+it, so a crash mid-write loses at most that batch. When the ring is full
+the oldest batches are dropped.
+"""
+
+import errno
+import fcntl
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from erpnext_apm.sampling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"EAPMSPL\0"
+VERSION = 1
+HEADER_SIZE = 64
+
+_HEADER = struct.Struct("<8sHHQQQ")
+_RECORD = struct.Struct("<II")
+
+
+class SpooledError(Exception):
+	"""
+	Raised from the transport's send after a batch went to the spool
+
+	`cause` is the send failure, or None if the batch was spooled without
+	trying because the circuit breaker is open.
+	"""
+
+	def __init__(self, cause=None):
+		super().__init__(f"Event batch spooled to disk ({cause or 'circuit breaker open'})")
+		self.cause = cause
+
+
+class SpoolInUse(Exception):
+	"""The spool file is locked by a live process"""
+
+
+class RingSpool:
+	"""Fixed-size, memory-mapped ring file of length-prefixed batches"""
+
+	def __init__(self, path, capacity=None):
+		self.path = path
+		self._lock = threading.Lock()
+		self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+		try:
+			fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except OSError as e:
+			os.close(self._fd)
+			if e.errno in (errno.EAGAIN, errno.EACCES):
+				raise SpoolInUse(path)
+			raise
+
+		size = os.fstat(self._fd).st_size
+		existing = self._read_header(size)
+		if existing is None:
+			if capacity is None:
+				os.close(self._fd)
+				raise ValueError(f"{path} is not a spool file")
+			self.capacity = int(capacity)
+			os.ftruncate(self._fd, HEADER_SIZE + self.capacity)
+			self._mm = mmap.mmap(self._fd, HEADER_SIZE + self.capacity)
+			self.head = self.tail = 0
+			self._write_header()
+		else:
+			self.capacity, self.head, self.tail = existing
+			self._mm = mmap.mmap(self._fd, HEADER_SIZE + self.capacity)
+
+		self.batches = self._count()
+		self.appended = 0
+		self.replayed = 0
+		self.dropped = 0
+		self.corrupt = 0
+
+	def _read_header(self, size):
+		if size < HEADER_SIZE:
+			return None
+		header = os.pread(self._fd, _HEADER.size, 0)
+		magic, version, _reserved, capacity, head, tail = _HEADER.unpack(header)
+		if magic != MAGIC or version != VERSION or size != HEADER_SIZE + capacity:
+			return None
+		if not head <= tail <= head + capacity:
+			head = tail = 0
+		return capacity, head, tail
+
+	def _write_header(self):
+		_HEADER.pack_into(self._mm, 0, MAGIC, VERSION, 0, self.capacity, self.head, self.tail)
+
+	def _read(self, offset, length):
+		start = HEADER_SIZE + offset % self.capacity
+		first = min(length, HEADER_SIZE + self.capacity - start)
+		data = self._mm[start : start + first]
+		if first < length:
+			data += self._mm[HEADER_SIZE : HEADER_SIZE + length - first]
+		return data
+
+	def _write(self, offset, data):
+		start = HEADER_SIZE + offset % self.capacity
+		first = min(len(data), HEADER_SIZE + self.capacity - start)
+		self._mm[start : start + first] = data[:first]
+		if first < len(data):
+			self._mm[HEADER_SIZE : HEADER_SIZE + len(data) - first] = data[first:]
+
+	def _count(self):
+		"""Count complete records, cutting the ring at the first bad length"""
+		count, offset = 0, self.head
+		while offset < self.tail:
+			if self.tail - offset < _RECORD.size:
+				break
+			length, _crc = _RECORD.unpack(self._read(offset, _RECORD.size))
+			if offset + _RECORD.size + length > self.tail:
+				break
+			offset += _RECORD.size + length
+			count += 1
+		if offset != self.tail:
+			self.tail = offset
+			self._write_header()
+		return count
+
+	def append(self, payload):
+		"""Append a batch, dropping the oldest ones if the ring is full"""
+		size = _RECORD.size + len(payload)
+		if size > self.capacity:
+			self.dropped += 1
+			return False
+
+		with self._lock:
+			while self.capacity - (self.tail - self.head) < size:
+				length, _crc = _RECORD.unpack(self._read(self.head, _RECORD.size))
+				self._advance(self.head, length)
+				self.dropped += 1
+
+			self._write(self.tail, _RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+			# Only now is the record part of the ring
+			self.tail += size
+			self._write_header()
+			self.batches += 1
+			self.appended += 1
+		return True
+
+	def peek(self):
+		"""Return (offset, payload) of the oldest batch, or None"""
+		with self._lock:
+			while self.head < self.tail:
+				offset = self.head
+				length, crc = _RECORD.unpack(self._read(offset, _RECORD.size))
+				payload = self._read(offset + _RECORD.size, length)
+				if zlib.crc32(payload) == crc:
+					return offset, payload
+				self.corrupt += 1
+				self._advance(offset, length)
+			return None
+
+	def _advance(self, offset, length):
+		if self.head == offset:
+			# A corrupt length cannot move head past tail
+			self.head = min(self.head + _RECORD.size + length, self.tail)
+			self.batches = max(self.batches - 1, 0) if self.head < self.tail else 0
+			self._write_header()
+
+	def commit(self, offset, payload):
+		"""Remove a batch returned by peek() once it has been replayed"""
+		with self._lock:
+			# It may have been dropped to make room in the meantime
+			self._advance(offset, len(payload))
+		self.replayed += 1
+
+	def close(self, remove_if_empty=True):
+		with self._lock:
+			empty = self.head == self.tail
+			self._mm.close()
+			if remove_if_empty and empty:
+				try:
+					os.unlink(self.path)
+				except OSError:
+					pass
+			os.close(self._fd)
+
+	def stats(self):
+		"""Return batch counters and ring usage"""
+		return {
+			"path": self.path,
+			"batches": self.batches,
+			"bytes_used": self.tail - self.head,
+			"capacity": self.capacity,
+			"appended": self.appended,
+			"replayed": self.replayed,
+			"dropped": self.dropped,
+			"corrupt": self.corrupt,
+		}
+
+
+def _should_spool(exception):
+	"""Whether a failed send is worth keeping (server unreachable or overloaded)"""
+	# A 4xx other than 429 (reported as "Temporarily rate limited") rejects
+	# the batch itself; replaying it would not help
+	return not str(exception).startswith("HTTP 4")
+
+
+def read_spools(directory):
+	"""Return the usage of each spool file in `directory` and whether its worker is live"""
+	spools = []
+	for path in sorted(glob.glob(os.path.join(directory, "*.spool"))):
+		try:
+			fd = os.open(path, os.O_RDONLY)
+		except OSError:
+			continue
+		try:
+			header = os.pread(fd, _HEADER.size, 0)
+			# A shared lock is only refused while the owner holds its own
+			try:
+				fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+				live = False
+			except OSError as e:
+				if e.errno not in (errno.EAGAIN, errno.EACCES):
+					raise
+				live = True
+		finally:
+			os.close(fd)
+
+		if len(header) < _HEADER.size:
+			continue
+		magic, version, _reserved, capacity, head, tail = _HEADER.unpack(header)
+		if magic != MAGIC or version != VERSION:
+			continue
+		spools.append({"path": path, "live": live, "bytes_used": tail - head, "capacity": capacity})
+	return spools
+
+
+class SpoolReplayer:
+	"""Drains the worker's spool, and spools left by exited workers, at a rate limit"""
+
+	def __init__(self, spool, send, directory, rate=5, breaker=None, adopt_interval=60):
+		self.spool = spool
+		self._send = send
+		self.directory = directory
+		self._bucket = TokenBucket(rate, burst=1)
+		self._interval = 1 / rate if rate > 0 else 0
+		self.breaker = breaker
+		self._adopt_interval = adopt_interval
+		self._adopted = []
+		self._next_adopt = 0.0
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="erpnext_apm spool replayer", daemon=True)
+		self._thread.start()
+
+	def _adopt(self):
+		"""Take over spool files whose owner has exited"""
+		own = os.path.abspath(self.spool.path)
+		known = {own, *(os.path.abspath(spool.path) for spool in self._adopted)}
+		for path in glob.glob(os.path.join(self.directory, "*.spool")):
+			if os.path.abspath(path) in known:
+				continue
+			try:
+				spool = RingSpool(path)
+			except (SpoolInUse, ValueError, OSError):
+				continue
+			if spool.batches:
+				logger.info(f"Replaying {spool.batches} APM batches left in {path}")
+				self._adopted.append(spool)
+			else:
+				spool.close()
+
+	def _next(self):
+		"""Return (spool, offset, payload) of the next batch to replay"""
+		for spool in (self.spool, *self._adopted):
+			entry = spool.peek()
+			if entry is not None:
+				return (spool, *entry)
+		return None
+
+	def _replay_one(self):
+		entry = self._next()
+		if entry is None:
+			return False
+
+		spool, offset, payload = entry
+		try:
+			self._send(payload)
+		except Exception as e:
+			logger.debug(f"Spool replay failed: {e}")
+			if self.breaker is not None:
+				self.breaker.record_failure()
+			return False
+
+		spool.commit(offset, payload)
+		if self.breaker is not None:
+			self.breaker.record_success()
+		if spool is not self.spool and not spool.batches:
+			self._adopted.remove(spool)
+			spool.close()
+		return True
+
+	def _run(self):
+		while not self._stop.is_set():
+			now = time.monotonic()
+			if now >= self._next_adopt:
+				self._next_adopt = now + self._adopt_interval
+				try:
+					self._adopt()
+				except Exception as e:
+					logger.debug(f"Failed to adopt spool files: {e}")
+
+			replayed = False
+			if (self.breaker is None or self.breaker.state == "closed") and self._bucket.take():
+				try:
+					replayed = self._replay_one()
+				except Exception as e:
+					logger.debug(f"Spool replay failed: {e}")
+
+			self._stop.wait(self._interval if replayed else 1.0)
+
+	def close(self):
+		self._stop.set()
+		self._thread.join(5)
+		for spool in self._adopted:
+			spool.close()
+		self.spool.close()
+
+
+def install_spool(client, directory, size_mb=64, replay_rate=5, breaker=None):
+	"""Spool the transport's failed batches to a ring file for this process"""
+	import atexit
+
+	os.makedirs(directory, exist_ok=True)
+	path = os.path.join(directory, f"{os.getpid()}.spool")
+	spool = RingSpool(path, capacity=int(size_mb * 1024 * 1024))
+
+	transport = client._transport
+	send = transport.send
+
+	def spooling_send(data, forced_flush=False, **kwargs):
+		if breaker is not None and not breaker.allow():
+			spool.append(bytes(data))
+			raise SpooledError()
+		try:
+			return send(data, forced_flush=forced_flush, **kwargs)
+		except Exception as e:
+			if not _should_spool(e):
+				raise
+			spool.append(bytes(data))
+			raise SpooledError(e)
+
+	transport.send = spooling_send
+	replayer = SpoolReplayer(spool, send, directory, rate=replay_rate, breaker=breaker)
+	atexit.register(replayer.close)
+	logger.info(f"APM disk spool enabled at {path} ({size_mb} MB)")
+	return replayer
@@ -4,117 +4,42 @@
 """
 Startup module for APM initialization
 
-This module wraps the Frappe WSGI application with Elastic APM middleware.
-It's called both at module import time (via hooks.py) and via the after_migrate hook.
+Kept as the target of the after_migrate hook; it delegates to
+erpnext_apm.bootstrap, which wraps the WSGI application once per process
+and creates the client lazily after fork.
 """
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Track if we've already set up APM
-_apm_setup_done = False
-_apm_initialization_attempted = False
-
 
 def setup_apm():
 	"""
 	Setup APM instrumentation
-	
-	This function is called:
-	1. At module import time (via hooks.py import)
-	2. Via the after_migrate hook (as fallback)
-	
-	It initializes APM and wraps the WSGI application.
+
+	Called via the after_migrate hook. Idempotent: it wraps the WSGI
+	application and installs the library patches once per process.
 	"""
-	global _apm_setup_done
-	
-	if _apm_setup_done:
-		return
-	
 	try:
-		from erpnext_apm.apm import init_apm, get_client
-		from erpnext_apm.wsgi import wrap_application
-		
-		# Initialize APM client - force re-initialization if needed
-		client = init_apm(force=True)
-		if not client:
-			logger.error("APM client initialization failed - check environment variables and logs")
-			# Try one more time without force
-			client = init_apm(force=False)
-			if not client:
-				logger.error("APM client still None after retry")
-				_apm_setup_done = True
-				return
-		
-		logger.info(f"APM client initialized in startup: {client}")
-		
-		# Wrap the WSGI application
-		# This must be done after frappe.app.application is defined
-		try:
-			# Import frappe.app to get access to the application
-			import frappe.app as frappe_app
-			
-			# Wrap the application if it exists
-			if hasattr(frappe_app, "application"):
-				original_app = frappe_app.application
-				wrapped_app = wrap_application(original_app)
-				
-				if wrapped_app != original_app:
-					frappe_app.application = wrapped_app
-					logger.info("APM instrumentation setup complete - WSGI application wrapped")
-				else:
-					logger.warning("WSGI wrapping returned original application - check client initialization")
-			else:
-				logger.warning("frappe.app.application not found, APM WSGI wrapping skipped")
-		
-		except ImportError as e:
-			logger.warning(f"Could not import frappe.app: {e}. APM WSGI wrapping skipped.")
-		except Exception as e:
-			logger.error(f"Failed to wrap WSGI application: {e}", exc_info=True)
-		
-		_apm_setup_done = True
-		
+		from erpnext_apm.bootstrap import setup
+
+		setup()
 	except Exception as e:
 		logger.error(f"Failed to setup APM: {e}", exc_info=True)
 		# Don't crash the application if APM setup fails
-		_apm_setup_done = True  # Mark as done to avoid retry loops
 
 
 def ensure_apm_initialized():
 	"""
-	Ensure APM is initialized - called via before_request hook
-	
-	This is a fallback to ensure APM is set up even if module-level
-	initialization didn't work. It only runs once per process.
+	Ensure APM is set up for a web process
+
+	No longer registered as a before_request hook; kept so sites whose
+	cached hooks still list it keep working until the cache is cleared.
 	"""
-	global _apm_initialization_attempted
-	
-	# Only try once per process
-	if _apm_initialization_attempted:
-		return
-	
-	_apm_initialization_attempted = True
-	
-	# Try to patch the application
 	try:
-		from erpnext_apm.app_patcher import patch_application
-		patch_application()
+		from erpnext_apm.bootstrap import setup
+
+		setup(role="web")
 	except Exception as e:
 		logger.debug(f"ensure_apm_initialized failed: {e}")
-	
-	# Also try setup_apm if not done
-	if not _apm_setup_done:
-		try:
-			setup_apm()
-		except Exception as e:
-			logger.debug(f"setup_apm in ensure_apm_initialized failed: {e}")
-
-
-# Try to setup APM at module import time
-# This ensures it runs early, even if after_migrate hasn't run
-try:
-	setup_apm()
-except Exception:
-	# Silently fail at import time - setup_apm will be called again via hook
-	pass
@@ -0,0 +1,70 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Per-transaction state shared by the instrumentation
+
+The WSGI middleware starts a TransactionState together with each recorded
+transaction. Instrumented calls look it up to attribute their cost to the
+transaction; when there is no state (no transaction, or the request was not
+sampled) they stay out of the way.
+"""
+
+import contextvars
+
+_current_state = contextvars.ContextVar("erpnext_apm_transaction_state", default=None)
+
+
+class TransactionState:
+	"""Counters collected while a transaction is active"""
+
+	__slots__ = ("db_count", "db_time", "detector", "gc_count", "gc_time", "queue_time")
+
+	def __init__(self):
+		self.db_count = 0
+		self.db_time = 0.0
+		self.gc_count = 0
+		self.gc_time = 0.0
+		# Seconds the request waited for a worker, when the front proxy stamped it
+		self.queue_time = None
+		# N+1 counter table, created on the first tracked query
+		self.detector = None
+
+	def labels(self):
+		"""Return the transaction labels derived from the collected counters"""
+		labels = {}
+		if self.db_count:
+			labels["db_query_count"] = self.db_count
+			labels["db_time_ms"] = round(self.db_time * 1000, 3)
+		if self.queue_time is not None:
+			labels["queue_time_ms"] = round(self.queue_time * 1000, 3)
+		if self.gc_count:
+			labels["gc_collections"] = self.gc_count
+			labels["gc_pause_ms"] = round(self.gc_time * 1000, 3)
+		return labels
+
+	def finish(self):
+		"""Emit deferred spans and return all labels for the ending transaction"""
+		labels = self.labels()
+		if self.detector is not None:
+			labels.update(self.detector.emit())
+		return labels
+
+
+def start_state():
+	"""Start collecting state for the transaction beginning in this context"""
+	state = TransactionState()
+	_current_state.set(state)
+	return state
+
+
+def current_state():
+	"""Return the state of the active transaction, or None"""
+	return _current_state.get()
+
+
+def end_state():
+	"""Stop collecting state and return what was collected"""
+	state = _current_state.get()
+	_current_state.set(None)
+	return state
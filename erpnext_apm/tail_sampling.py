@@ -0,0 +1,149 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Tail sampling for requests rejected by the head sampler
+
+Instead of being skipped, those requests are traced with their span events
+held in a per-transaction buffer. When the transaction ends the middleware
+decides whether it is worth sending (slow, failed, or a probabilistic keep);
+kept buffers are handed to the agent in order, the rest are discarded.
+
+The sampler is installed as the tracer's queue function, so every span and
+transaction event passes through it on the way to the agent's transport.
+"""
+
+import logging
+import random
+import threading
+
+logger = logging.getLogger(__name__)
+
+SPAN = "span"
+TRANSACTION = "transaction"
+
+
+class _Buffer:
+	"""Span events and keep decision for one in-flight transaction"""
+
+	__slots__ = ("events", "keep", "overflowed")
+
+	def __init__(self):
+		self.events = []
+		self.keep = None
+		self.overflowed = 0
+
+
+class TailSampler:
+	"""
+	Per-worker tail sampling buffer
+
+	Memory is bounded by `max_spans` events per transaction and
+	`max_buffered_spans` events across all in-flight transactions of the
+	worker; spans beyond either limit are counted and discarded.
+	"""
+
+	def __init__(
+		self,
+		queue_func,
+		latency_threshold_ms=2000,
+		keep_rate=0.0,
+		max_spans=500,
+		max_buffered_spans=20000,
+	):
+		self.queue_func = queue_func
+		self.latency_threshold = latency_threshold_ms / 1000.0 if latency_threshold_ms > 0 else None
+		self.keep_rate = keep_rate
+		self.max_spans = max_spans
+		self.max_buffered_spans = max_buffered_spans
+
+		self._buffers = {}
+		self._buffered_spans = 0
+		self._lock = threading.Lock()
+
+		self.kept = 0
+		self.dropped = 0
+		self.spans_overflowed = 0
+
+	def start(self, transaction_id):
+		"""Start buffering span events for a transaction"""
+		self._buffers[transaction_id] = _Buffer()
+
+	def is_buffered(self, transaction_id):
+		"""Return True if the transaction's events are being buffered"""
+		return transaction_id in self._buffers
+
+	def decide(self, transaction_id, duration, result):
+		"""Decide, right before the transaction ends, whether it will be sent"""
+		buffer = self._buffers.get(transaction_id)
+		if buffer is None:
+			return True
+
+		keep = (
+			result in ("error", "server_error")
+			or (self.latency_threshold is not None and duration >= self.latency_threshold)
+			or (self.keep_rate > 0.0 and random.random() < self.keep_rate)
+		)
+		buffer.keep = keep
+		return keep
+
+	def discard(self, transaction_id):
+		"""Drop whatever is still buffered once the transaction has ended"""
+		buffer = self._buffers.pop(transaction_id, None)
+		if buffer is not None:
+			self._release(buffer, kept=False)
+
+	def _release(self, buffer, kept):
+		with self._lock:
+			self._buffered_spans -= len(buffer.events)
+			if kept:
+				self.kept += 1
+			else:
+				self.dropped += 1
+
+	def __call__(self, event_type, data, flush=False):
+		if event_type == SPAN:
+			buffer = self._buffers.get(data.get("transaction_id"))
+			if buffer is not None:
+				with self._lock:
+					if len(buffer.events) >= self.max_spans or self._buffered_spans >= self.max_buffered_spans:
+						buffer.overflowed += 1
+						self.spans_overflowed += 1
+						return
+					self._buffered_spans += 1
+				buffer.events.append(data)
+				return
+
+		elif event_type == TRANSACTION:
+			buffer = self._buffers.pop(data.get("id"), None)
+			if buffer is not None:
+				if not buffer.keep:
+					self._release(buffer, kept=False)
+					return
+
+				for span in buffer.events:
+					self.queue_func(SPAN, span)
+				if buffer.overflowed:
+					data.setdefault("span_count", {})
+					data["span_count"]["dropped"] = data["span_count"].get("dropped", 0) + buffer.overflowed
+				self._release(buffer, kept=True)
+
+		self.queue_func(event_type, data, flush)
+
+	def stats(self):
+		"""Return kept/dropped transaction counters and buffer usage"""
+		return {
+			"kept": self.kept,
+			"dropped": self.dropped,
+			"spans_overflowed": self.spans_overflowed,
+			"in_flight": len(self._buffers),
+			"buffered_spans": self._buffered_spans,
+		}
+
+
+def install_tail_sampler(client, **kwargs):
+	"""Install a TailSampler in front of the client's tracer queue"""
+	sampler = TailSampler(client.tracer.queue_func, **kwargs)
+	client.tracer.queue_func = sampler
+	logger.info("Tail sampling enabled for unsampled requests")
+	return sampler
@@ -116,6 +116,19 @@ def verify_apm_setup():
 		import traceback
 		traceback.print_exc()
 	
+	# 7. Bootstrap diagnostics for this process
+	print("\n7. Process Bootstrap:")
+	try:
+		from erpnext_apm.bootstrap import boot_info
+		info = boot_info()
+		print(f"   PID: {info['pid']}")
+		print(f"   Client created in this process: {info['client'] and info['client_pid'] == info['pid']}")
+		print(f"   Boot time: {info['boot_time_ms']} ms")
+		print(f"   Forks since import: {info['forks']}")
+		print(f"   Threads: {info['threads']} ({len(info['agent_threads'])} agent: {', '.join(info['agent_threads']) or 'none'})")
+	except Exception as e:
+		print(f"   ✗ Error reading bootstrap info: {e}")
+	
 	print("\n" + "=" * 60)
 	print("Verification Complete")
 	print("=" * 60)
@@ -0,0 +1,197 @@
+# Copyright (c) 2024
+# License: MIT
+
+"""
+Watchdog for stuck web requests
+
+A request only reaches the APM server when it ends, so one that is killed
+by the gunicorn timeout leaves no trace of what it was doing. The
+middleware registers every request here when it starts (one dict store,
+keyed by thread) and removes it when it ends. A background thread looks at
+the registered requests every WATCHDOG_INTERVAL_MS; when one has been
+running for longer than the next of WATCHDOG_THRESHOLDS_MS, it takes the
+stack of the request's thread from sys._current_frames() and sends, right
+away:
+
+- a partial transaction of type "request.stuck", named after the request,
+  in the request's trace and lasting as long as the request so far
+- a RequestStuck error on it, whose stack trace is the request's stack
+
+Each threshold is reported at most once per request.
+"""
+
+import logging
+import sys
+import threading
+import time
+import types
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_TYPE = "request.stuck"
+
+
+class RequestStuck(Exception):
+	"""A request ran past a watchdog threshold"""
+
+
+class _Watched:
+	"""A registered request; `next` is only touched by the watchdog thread"""
+
+	__slots__ = ("name", "next", "start", "started", "transaction")
+
+	def __init__(self, name, transaction):
+		self.name = name
+		self.start = time.time()
+		self.started = time.perf_counter()
+		self.transaction = transaction
+		self.next = 0
+
+
+def _traceback(frame):
+	"""Build a traceback from a live frame, outermost frame first"""
+	frames = []
+	while frame is not None:
+		frames.append(frame)
+		frame = frame.f_back
+
+	tb = None
+	for frame in frames:
+		tb = types.TracebackType(tb, frame, frame.f_lasti, frame.f_lineno)
+	return tb
+
+
+class Watchdog:
+	"""Reports the stacks of requests that run past the thresholds"""
+
+	def __init__(self, client, thresholds_ms=(10000, 60000), interval_ms=1000, breaker=None, pipeline=None):
+		self.client = client
+		self.thresholds = tuple(sorted(t / 1000 for t in thresholds_ms if t > 0))
+		self.interval = max(interval_ms, 10) / 1000
+		self.breaker = breaker
+		self.pipeline = pipeline
+
+		# Thread ident -> _Watched; only written by the request threads
+		self._requests = {}
+		self._stopped = threading.Event()
+		self._thread = None
+		self.reported = 0
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name="erpnext_apm watchdog", daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+
+	def register(self, name, transaction=None):
+		"""Watch the request running on the calling thread"""
+		self._requests[threading.get_ident()] = _Watched(name, transaction)
+
+	def unregister(self):
+		"""Stop watching the calling thread"""
+		self._requests.pop(threading.get_ident(), None)
+
+	def check(self):
+		"""Report the requests that crossed a threshold since the last check"""
+		if not self._requests:
+			return
+
+		now = time.perf_counter()
+		frames = None
+		for ident, request in list(self._requests.items()):
+			elapsed = now - request.started
+			crossed = request.next
+			while crossed < len(self.thresholds) and elapsed >= self.thresholds[crossed]:
+				crossed += 1
+			if crossed == request.next:
+				continue
+			request.next = crossed
+
+			if frames is None:
+				frames = sys._current_frames()
+			frame = frames.get(ident)
+			# Gone between the two looks, or the thread went on to another request
+			if frame is None or self._requests.get(ident) is not request:
+				continue
+			self._report(request, frame, elapsed, self.thresholds[crossed - 1])
+		frames = None
+
+	def _report(self, request, frame, elapsed, threshold):
+		if self.breaker is not None and not self.breaker.allow():
+			return
+
+		import elasticapm
+
+		trace_parent = None
+		if request.transaction is not None:
+			try:
+				trace_parent = request.transaction.trace_parent.copy_from(span_id=request.transaction.id)
+			except Exception:
+				pass
+
+		message = f"{request.name} still running after {elapsed:.1f}s (watchdog threshold {threshold:g}s)"
+		exc_info = (RequestStuck, RequestStuck(message), _traceback(frame))
+		try:
+			transaction = self.client.begin_transaction(TRANSACTION_TYPE, trace_parent=trace_parent, start=request.start)
+			if transaction is None:
+				return
+			elasticapm.set_transaction_name(request.name, override=False)
+			elasticapm.label(
+				stuck_elapsed_ms=round(elapsed * 1000), watchdog_threshold_ms=round(threshold * 1000)
+			)
+			self.client.capture_exception(exc_info=exc_info, handled=False)
+			elasticapm.set_transaction_result("stuck", override=False)
+			self.client.end_transaction(request.name, duration=elapsed)
+			self.reported += 1
+		except Exception as e:
+			logger.debug(f"Failed to report stuck request {request.name}: {e}")
+			return
+		finally:
+			exc_info = None
+
+		# The worker may be killed any moment now; do not wait for the next batch
+		try:
+			if self.pipeline is not None:
+				self.pipeline.flush()
+			self.client._transport.flush()
+		except Exception as e:
+			logger.debug(f"Failed to flush stuck request report: {e}")
+
+		logger.warning(message)
+
+	def _run(self):
+		while not self._stopped.wait(self.interval):
+			try:
+				self.check()
+			except Exception as e:
+				logger.debug(f"Watchdog check failed: {e}")
+
+	def stats(self):
+		return {
+			"thresholds_s": list(self.thresholds),
+			"in_flight": len(self._requests),
+			"reported": self.reported,
+		}
+
+
+def install_watchdog(runtime):
+	"""Start a watchdog thread for this worker's requests"""
+	if not hasattr(sys, "_current_frames"):
+		logger.warning("sys._current_frames() is not available, APM watchdog disabled")
+		return None
+
+	config = runtime.config
+	watchdog = Watchdog(
+		runtime.client,
+		thresholds_ms=config.get("WATCHDOG_THRESHOLDS_MS", (10000, 60000)),
+		interval_ms=config.get("WATCHDOG_INTERVAL_MS", 1000),
+		# With the disk spool the breaker only diverts batches, reports go on
+		breaker=runtime.breaker if runtime.spool is None else None,
+		pipeline=runtime.pipeline,
+	)
+	if not watchdog.thresholds:
+		return None
+	watchdog.start()
+	logger.info(f"APM watchdog reporting requests running past {', '.join(f'{t:g}s' for t in watchdog.thresholds)}")
+	return watchdog
@@ -7,82 +7,458 @@ WSGI middleware wrapper for Elastic APM
 
 import logging
 import sys
+import time
+from datetime import timedelta
+
+import elasticapm
+from elasticapm.utils import get_url_dict
+from elasticapm.utils.wsgi import get_current_url, get_environ, get_headers
+
+from erpnext_apm.apm import DEFAULT_CAPTURE_ENVIRON, DEFAULT_CAPTURE_HEADERS, DEFAULT_SAMPLE_RATES
+from erpnext_apm.bootstrap import get_runtime
+from erpnext_apm.prometheus import serve_metrics
+from erpnext_apm.queueing import queue_time, request_start
+from erpnext_apm.routes import RouteNormalizer
+from erpnext_apm.sampling import Sampler
+from erpnext_apm.sites import SiteResolver
+from erpnext_apm.state import end_state, start_state
 
 logger = logging.getLogger(__name__)
 
 
+def _resolve_header_keys(header_names):
+	"""Map HTTP header names to the WSGI environ keys they are stored under"""
+	keys = []
+	for name in header_names:
+		key = name.upper().replace("-", "_")
+		if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+			key = f"HTTP_{key}"
+		keys.append((key, name))
+	return tuple(keys)
+
+
+def _result_for_status(status_code):
+	"""Map an HTTP status code to a transaction result"""
+	if status_code < 400:
+		return "success"
+	elif status_code < 500:
+		return "client_error"
+	return "server_error"
+
+
 class ElasticAPMWSGI:
 	"""
 	WSGI middleware that captures transactions and exceptions for Elastic APM
-	
+
 	This wraps the Frappe WSGI application and automatically:
-	- Starts a transaction for each HTTP request
+	- Starts a transaction for each HTTP request, named after its route template
 	- Captures request context (method, URL, headers)
 	- Captures exceptions
+	- Attaches per-transaction database query count and time as labels,
+	  and folds N+1 query patterns into aggregated spans
 	- Ends the transaction with proper result
+
+	In the default "lazy" capture mode the request context is only built for
+	sampled transactions, right before they are sent, from header and environ
+	allowlists resolved once here at wrap time.
+
+	Requests that the head sampler rejects run without a transaction; only
+	their duration and status are tracked so errors and slow requests can
+	still be reported after the fact. With tail sampling enabled they are
+	traced into a bounded buffer instead and only sent if they turn out to
+	be slow or failing.
+
+	The latency of every request, sampled or not, is also counted into
+	per-route histograms that are sent as metrics, and, with the Prometheus
+	exporter on, into the worker's metrics file. With the profiler on, the
+	request's thread is sampled while it runs and slow transactions get
+	their top stacks attached. Every request is registered with the
+	watchdog, which reports the stack of requests that run for too long.
+	In memory tracking mode a fraction of requests is measured for RSS and
+	allocation growth, aggregated per route.
+
+	Requests in flight are counted per worker, without locks, for the
+	concurrency and utilization metrics.
+
+	When the front proxy stamps X-Request-Start or X-Queue-Start, the time
+	the request waited for a worker is counted into a per-worker histogram,
+	and a traced request's transaction starts at the stamp with a
+	"request queue" span covering the wait.
+
+	On a multi-site bench each request is resolved to its site the way
+	Frappe does it, from X-Frappe-Site-Name or the Host header; the site
+	labels the transaction and can have a sampling budget of its own.
+
+	While the circuit breaker is open requests are passed straight through,
+	only counted into the histograms and metrics file.
 	"""
-	
-	def __init__(self, application, client):
+
+	_erpnext_apm_patched = True
+
+	def __init__(self, application, config=None):
 		self.application = application
-		self.client = client
-	
+		# Bound on the first request from the process' runtime, see _bind()
+		self.client = None
+		self.tail = None
+		self.breaker = None
+		self.histograms = None
+		self.prometheus = None
+		self.profiler = None
+		self.watchdog = None
+		self.memory = None
+		self.queue_histogram = None
+		self.concurrency = None
+		self._runtime = None
+
+		config = config or {}
+		self.capture_context = config.get("CAPTURE_CONTEXT", "lazy")
+		self._header_keys = _resolve_header_keys(config.get("CAPTURE_HEADERS", DEFAULT_CAPTURE_HEADERS))
+		self._environ_keys = tuple(config.get("CAPTURE_ENVIRON", DEFAULT_CAPTURE_ENVIRON))
+		# The in-app metrics path is only served to scrapers holding the token
+		self._metrics_path = config.get("PROMETHEUS_PATH") if config.get("PROMETHEUS_TOKEN") else None
+		self._metrics_token = config.get("PROMETHEUS_TOKEN")
+		self._queue_time_enabled = config.get("QUEUE_TIME", True)
+		self.routes = RouteNormalizer(
+			cache_size=config.get("ROUTE_CACHE_SIZE", 4096),
+			max_names=config.get("MAX_TRANSACTION_NAMES", 500),
+		)
+		self.sampler = Sampler(
+			default_rate=config.get("SAMPLE_RATE", 1.0),
+			route_rates=config.get("SAMPLE_RATES", DEFAULT_SAMPLE_RATES),
+			max_tps=config.get("MAX_TPS", 0),
+			slow_threshold_ms=config.get("SLOW_THRESHOLD_MS", 2000),
+			keep_errors=config.get("KEEP_ERRORS", True),
+			site_max_tps=config.get("SITE_MAX_TPS", 0),
+		)
+		self.sites = SiteResolver(max_sites=config.get("MAX_SITES", 200)) if config.get("SITE_TAGGING", True) else None
+
+	def _bind(self, runtime):
+		"""Use the client and tail sampler of this process' runtime"""
+		self._runtime = runtime
+		self.client = runtime.client
+		self.tail = runtime.tail
+		# With the disk spool the breaker only diverts batches, tracing goes on
+		self.breaker = runtime.breaker if runtime.spool is None else None
+		self.histograms = runtime.route_latency.histograms if runtime.route_latency is not None else None
+		self.prometheus = runtime.prometheus
+		self.profiler = runtime.profiler
+		self.watchdog = runtime.watchdog
+		self.memory = runtime.memory.tracker if runtime.memory is not None else None
+		self.queue_histogram = runtime.queue_time.histogram if runtime.queue_time is not None else None
+		self.concurrency = runtime.concurrency.tracker if runtime.concurrency is not None else None
+
+	def _begin_request(self, transaction_name, transaction=None):
+		"""Count a request in flight, for every request later passed to _record()"""
+		if self.watchdog is not None:
+			self.watchdog.register(transaction_name, transaction)
+		if self.concurrency is not None:
+			self.concurrency.begin()
+		if self.prometheus is not None:
+			self.prometheus.begin()
+		if self.profiler is not None:
+			self.profiler.enter(transaction_name)
+		if self.memory is not None:
+			self.memory.begin()
+
+	def _queue_time(self, environ):
+		"""Return (stamp, seconds waited) of a request stamped by the front proxy, or (None, None)"""
+		start = request_start(environ)
+		waited = queue_time(start, time.time())
+		if waited is None:
+			return None, None
+
+		if self.queue_histogram is not None:
+			self.queue_histogram.record(waited)
+		if self.prometheus is not None:
+			self.prometheus.queued(waited)
+		return start, waited
+
+	def _queue_span(self, transaction, start, waited):
+		"""Record the time a traced request waited for a worker as its first span"""
+		try:
+			span = transaction.begin_span("request queue", "app", span_subtype="queue", start=start, auto_activate=False)
+			if hasattr(span, "frames"):
+				span.frames = None
+			span.end(duration=timedelta(seconds=waited))
+		except Exception as e:
+			logger.debug(f"Failed to record request queue span: {e}")
+
+	def _record(self, transaction_name, duration, error):
+		"""
+		Count a finished request into the latency histograms and metrics file
+
+		Returns the profiler samples and the MemoryUsage of the request, None
+		for either if it was not profiled or measured.
+		"""
+		if self.watchdog is not None:
+			self.watchdog.unregister()
+		if self.concurrency is not None:
+			self.concurrency.end()
+		if self.histograms is not None:
+			self.histograms.record(transaction_name, duration)
+		if self.prometheus is not None:
+			self.prometheus.end(transaction_name, duration, error)
+		samples = self.profiler.exit() if self.profiler is not None else None
+		usage = self.memory.end(transaction_name) if self.memory is not None else None
+		return samples, usage
+
+	def _build_request_context(self, environ):
+		"""Build the request context from the precomputed allowlists"""
+		headers = {}
+		for key, name in self._header_keys:
+			value = environ.get(key)
+			if value is not None:
+				headers[name] = value
+
+		env = {}
+		for key in self._environ_keys:
+			value = environ.get(key)
+			if value is not None:
+				env[key] = value
+
+		return {
+			"method": environ.get("REQUEST_METHOD", "GET"),
+			"url": get_url_dict(get_current_url(environ)),
+			"headers": headers,
+			"env": env,
+		}
+
+	def _build_full_request_context(self, environ):
+		"""Build the request context from every header and environ key"""
+		return {
+			"method": environ.get("REQUEST_METHOD", "GET"),
+			"url": get_url_dict(get_current_url(environ)),
+			"headers": dict(get_headers(environ)),
+			"env": dict(get_environ(environ)),
+		}
+
+	def _capture_request_context(self, environ, transaction):
+		"""Attach the lazy request context, only if the transaction will be sent"""
+		if self.capture_context != "lazy" or transaction is None or not transaction.is_sampled:
+			return
+
+		try:
+			elasticapm.set_context(self._build_request_context(environ), "request")
+		except Exception as e:
+			logger.debug(f"Failed to set request context: {e}")
+
+	def _capture_exception(self, environ, transaction, exc_info):
+		"""Capture an exception with the request context attached"""
+		self._capture_request_context(environ, transaction)
+		self.client.capture_exception(exc_info=exc_info)
+		elasticapm.set_transaction_result("error", override=True)
+
+	def _end_transaction(self, environ, transaction, transaction_name, capture_context=True, duration=None):
+		"""End the transaction, building the lazy request context first"""
+		state = end_state()
+
+		# A late transaction (duration given) was already counted as unsampled
+		elapsed = None
+		if transaction is not None and duration is None:
+			elapsed = time.perf_counter() - transaction.start_time
+			# The transaction starts at the proxy's stamp; latency is counted from the app
+			if state is not None and state.queue_time is not None:
+				elapsed = max(elapsed - state.queue_time, 0.0)
+			samples, usage = self._record(transaction_name, elapsed, transaction.result in ("error", "server_error"))
+			if samples and transaction.is_sampled and self.profiler.is_slow(elapsed):
+				try:
+					elasticapm.set_custom_context({"profile": self.profiler.summarize(samples)})
+				except Exception as e:
+					logger.debug(f"Failed to attach profile: {e}")
+			if usage is not None and transaction.is_sampled:
+				try:
+					elasticapm.label(**usage.labels())
+					if usage.top_sites:
+						elasticapm.set_custom_context({"memory": {"top_sites": usage.top_sites}})
+				except Exception as e:
+					logger.debug(f"Failed to attach memory usage: {e}")
+
+		tail = self.tail
+		if tail is not None and elapsed is not None and tail.is_buffered(transaction.id):
+			# Decide now so the request context is only built for kept transactions
+			if not tail.decide(transaction.id, elapsed, transaction.result):
+				capture_context = False
+
+		if capture_context:
+			self._capture_request_context(environ, transaction)
+
+		if state is not None and transaction is not None:
+			labels = state.finish()
+			if labels:
+				elasticapm.label(**labels)
+
+		self.client.end_transaction(transaction_name, duration=duration)
+
+		if tail is not None and transaction is not None:
+			tail.discard(transaction.id)
+
+	def _promote(self, environ, transaction_name, start, duration, status_code, reason, exc_info=None):
+		"""Report an unsampled request that turned out to be an error or slow"""
+		if self.breaker is not None and not self.breaker.allow():
+			return
+
+		self.sampler.promoted += 1
+
+		try:
+			transaction = self.client.begin_transaction("request", start=start)
+			elasticapm.set_transaction_name(transaction_name, override=False)
+			elasticapm.label(sampling_reason=reason)
+			site = self.sites.resolve(environ) if self.sites is not None else None
+			if site is not None:
+				elasticapm.label(site=site)
+
+			if self.capture_context == "eager":
+				elasticapm.set_context(lambda: self._build_full_request_context(environ), "request")
+
+			if exc_info:
+				self._capture_exception(environ, transaction, exc_info)
+			elif status_code is not None:
+				elasticapm.set_transaction_result(_result_for_status(status_code), override=False)
+
+			self._end_transaction(
+				environ, transaction, transaction_name, capture_context=not exc_info, duration=duration
+			)
+		except Exception as e:
+			logger.debug(f"Failed to report unsampled request: {e}")
+
+	def _call_unsampled(self, environ, start_response, method, template):
+		"""Run a request without a transaction, keeping it only if it fails or is slow"""
+		start = time.time()
+		started = time.perf_counter()
+		status_code = None
+		self._begin_request(f"{method} {template}")
+
+		def unsampled_start_response(status, response_headers_list, exc_info=None):
+			nonlocal status_code
+			status_code = int(status.split()[0]) if status else 500
+			return start_response(status, response_headers_list, exc_info)
+
+		try:
+			response = self.application(environ, unsampled_start_response)
+		except Exception:
+			exc_info = sys.exc_info()
+			duration = time.perf_counter() - started
+			self._record(f"{method} {template}", duration, True)
+			if self.sampler.keep_errors:
+				self._promote(environ, f"{method} {template}", start, duration, status_code, "error", exc_info)
+			exc_info = None
+			raise
+
+		duration = time.perf_counter() - started
+		self._record(f"{method} {template}", duration, status_code is not None and status_code >= 500)
+		reason = self.sampler.keep_reason(status_code, duration)
+		if reason:
+			self._promote(environ, f"{method} {template}", start, duration, status_code, reason)
+
+		return response
+
+	def _call_untraced(self, environ, start_response, method, template):
+		"""Run a request with no APM work beyond counting its duration"""
+		if (
+			self.histograms is None
+			and self.prometheus is None
+			and self.profiler is None
+			and self.watchdog is None
+			and self.memory is None
+			and self.concurrency is None
+		):
+			return self.application(environ, start_response)
+
+		started = time.perf_counter()
+		status_code = None
+		self._begin_request(f"{method} {template}")
+
+		def untraced_start_response(status, response_headers_list, exc_info=None):
+			nonlocal status_code
+			status_code = int(status.split()[0]) if status else 500
+			return start_response(status, response_headers_list, exc_info)
+
+		try:
+			response = self.application(environ, untraced_start_response)
+		except Exception:
+			self._record(f"{method} {template}", time.perf_counter() - started, True)
+			raise
+
+		error = status_code is not None and status_code >= 500
+		self._record(f"{method} {template}", time.perf_counter() - started, error)
+		return response
+
 	def __call__(self, environ, start_response):
+		# The client is created on the first request in each worker process
+		runtime = get_runtime()
+		if runtime is None:
+			return self.application(environ, start_response)
+		if runtime is not self._runtime:
+			self._bind(runtime)
+
 		# Extract request information
 		method = environ.get("REQUEST_METHOD", "GET")
 		path = environ.get("PATH_INFO", "/")
-		
+		if path == self._metrics_path and self.prometheus is not None:
+			return serve_metrics(environ, start_response, self.prometheus.directory, self._metrics_token)
+		template = self.routes.normalize(path)
+		site = self.sites.resolve(environ) if self.sites is not None else None
+
+		queue_start = waited = None
+		if self._queue_time_enabled:
+			queue_start, waited = self._queue_time(environ)
+
+		# Head sampling - unsampled requests skip the transaction entirely,
+		# unless tail sampling wants them traced into its buffer
+		buffered = False
+		if not self.sampler.should_sample(template, site):
+			if self.tail is None:
+				return self._call_unsampled(environ, start_response, method, template)
+			buffered = True
+
+		# Pass-through while the circuit breaker is open
+		if self.breaker is not None and not self.breaker.allow():
+			return self._call_untraced(environ, start_response, method, template)
+
 		# Start transaction
-		transaction_name = f"{method} {path}"
+		transaction_name = f"{method} {template}"
 		transaction_type = "request"
-		
-		transaction = self.client.begin_transaction(transaction_type)
-		
+
+		transaction = self.client.begin_transaction(transaction_type, start=queue_start)
+		if transaction is not None:
+			self._begin_request(transaction_name, transaction)
+			state = start_state()
+			if queue_start is not None:
+				state.queue_time = waited
+				self._queue_span(transaction, queue_start, waited)
+			if buffered:
+				self.tail.start(transaction.id)
+
 		# Set transaction name
-		self.client.set_transaction_name(transaction_name, override=False)
-		
-		# Set request context
-		try:
-			from elasticapm.utils.wsgi import get_current_url, get_headers, get_environ
-			
-			url = get_current_url(environ)
-			headers = dict(get_headers(environ))
-			env = dict(get_environ(environ))
-			
-			self.client.set_context(
-				"request",
-				{
-					"method": method,
-					"url": url,
-					"headers": headers,
-					"env": env,
-				}
-			)
-		except Exception as e:
-			logger.debug(f"Failed to set request context: {e}")
-		
+		elasticapm.set_transaction_name(transaction_name, override=False)
+		if site is not None:
+			elasticapm.label(site=site)
+
+		# In eager mode the full request context is copied up front
+		if self.capture_context == "eager":
+			try:
+				elasticapm.set_context(lambda: self._build_full_request_context(environ), "request")
+			except Exception as e:
+				logger.debug(f"Failed to set request context: {e}")
+
 		# Track response
 		status_code = None
 		response_headers = []
-		
+
 		def custom_start_response(status, response_headers_list, exc_info=None):
 			nonlocal status_code, response_headers
 			status_code = int(status.split()[0]) if status else 500
 			response_headers = response_headers_list
-			
+
 			# Set transaction result based on status code
-			if status_code < 400:
-				self.client.set_transaction_result("success", override=False)
-			elif status_code < 500:
-				self.client.set_transaction_result("client_error", override=False)
-			else:
-				self.client.set_transaction_result("server_error", override=False)
-			
+			elasticapm.set_transaction_result(_result_for_status(status_code), override=False)
+
 			return start_response(status, response_headers_list, exc_info)
-		
+
 		# Execute the application
 		try:
 			response = self.application(environ, custom_start_response)
-			
+
 			# Handle response (can be list or generator)
 			if isinstance(response, list):
 				# List response - end transaction after returning
@@ -90,37 +466,36 @@ class ElasticAPMWSGI:
 					return response
 				finally:
 					# End transaction
-					self.client.end_transaction(transaction_name, transaction_type)
+					self._end_transaction(environ, transaction, transaction_name)
 			else:
 				# Generator response - wrap it to handle exceptions and end transaction
 				def response_wrapper():
+					context_captured = False
 					try:
-						for chunk in response:
-							yield chunk
+						yield from response
 					except Exception:
 						exc_info = sys.exc_info()
-						self.client.capture_exception(exc_info=exc_info)
-						self.client.set_transaction_result("error", override=True)
+						self._capture_exception(environ, transaction, exc_info)
+						context_captured = True
 						exc_info = None
 						raise
 					finally:
 						# End transaction
-						self.client.end_transaction(transaction_name, transaction_type)
-				
+						self._end_transaction(
+							environ, transaction, transaction_name, capture_context=not context_captured
+						)
+
 				return response_wrapper()
-		
+
 		except Exception:
 			exc_info = sys.exc_info()
-			
-			# Capture exception
-			self.client.capture_exception(exc_info=exc_info)
-			
-			# Set transaction result to error
-			self.client.set_transaction_result("error", override=True)
-			
+
+			# Capture exception and set transaction result to error
+			self._capture_exception(environ, transaction, exc_info)
+
 			# End transaction
-			self.client.end_transaction(transaction_name, transaction_type)
-			
+			self._end_transaction(environ, transaction, transaction_name, capture_context=False)
+
 			exc_info = None
 			raise
 
@@ -128,30 +503,26 @@ class ElasticAPMWSGI:
 def wrap_application(application):
 	"""
 	Wrap the Frappe WSGI application with Elastic APM middleware
-	
+
 	This function should be called once at startup to instrument all HTTP requests
 	"""
-	from erpnext_apm.apm import get_client, is_apm_enabled
-	
+	from erpnext_apm.apm import get_config, is_apm_enabled
+
 	if not is_apm_enabled():
 		logger.debug("APM is disabled, skipping WSGI wrapping")
 		return application
-	
-	client = get_client()
-	if not client:
-		logger.debug("APM client not initialized, skipping WSGI wrapping")
+
+	if isinstance(application, ElasticAPMWSGI):
+		logger.debug("Application already wrapped with APM")
 		return application
-	
+
 	try:
 		# Wrap the application with our custom WSGI middleware
-		wrapped_app = ElasticAPMWSGI(application, client)
-		
-		logger.info(
-			f"Frappe WSGI application wrapped with Elastic APM middleware. "
-			f"Client: {client}, Service: {client.config.service_name if client else 'None'}"
-		)
+		wrapped_app = ElasticAPMWSGI(application, get_config())
+
+		logger.info("Frappe WSGI application wrapped with Elastic APM middleware")
 		return wrapped_app
-		
+
 	except Exception as e:
 		logger.error(f"Failed to wrap WSGI application with APM: {e}", exc_info=True)
 		# Return original application if wrapping fails
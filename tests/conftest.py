@@ -0,0 +1,74 @@
+"""
+Shared fixtures: a local APM intake and process runtimes built against it
+
+make_runtime() goes through the same create_client() / _install_stages()
+path as a real worker, with ERPNEXT_APM_* settings passed as keyword
+arguments, and installs the runtime as the process' runtime for the test.
+"""
+
+import gc
+
+import pytest
+
+from tests.intake import Intake
+
+
+@pytest.fixture
+def intake():
+	intake = Intake()
+	yield intake
+	intake.close()
+
+
+@pytest.fixture
+def apm_env(monkeypatch, intake, tmp_path):
+	"""Point the agent at the local intake, with nothing running in the background"""
+	monkeypatch.setenv("ELASTIC_APM_SERVICE_NAME", "erpnext-apm-tests")
+	monkeypatch.setenv("ELASTIC_APM_SERVER_URL", intake.url)
+	monkeypatch.setenv("ELASTIC_APM_CENTRAL_CONFIG", "false")
+	monkeypatch.setenv("ELASTIC_APM_CLOUD_PROVIDER", "none")
+	monkeypatch.setenv("ELASTIC_APM_METRICS_INTERVAL", "0ms")
+	monkeypatch.setenv("ELASTIC_APM_API_REQUEST_TIME", "10s")
+	monkeypatch.setenv("ERPNEXT_APM_CONCURRENCY_DIR", str(tmp_path / "concurrency"))
+	monkeypatch.setenv("ERPNEXT_APM_WATCHDOG", "false")
+	return monkeypatch
+
+
+def close_runtime(runtime):
+	"""Stop everything a runtime started in this process"""
+	from erpnext_apm import gc_pauses
+
+	if runtime.watchdog is not None:
+		runtime.watchdog.stop()
+	if runtime.pipeline is not None:
+		runtime.pipeline.close()
+	if runtime.gc is not None and runtime.gc.monitor in gc.callbacks:
+		gc.callbacks.remove(runtime.gc.monitor)
+		gc_pauses._callback = None
+	runtime.client.close()
+
+
+@pytest.fixture
+def make_runtime(apm_env):
+	"""Build the process runtime for a role, with ERPNEXT_APM_<NAME> settings as keywords"""
+	from erpnext_apm import bootstrap
+	from erpnext_apm.apm import create_client, get_config
+
+	runtimes = []
+
+	def make(role="web", **settings):
+		for name, value in settings.items():
+			apm_env.setenv(f"ERPNEXT_APM_{name}", str(value).lower() if isinstance(value, bool) else str(value))
+		apm_env.setattr(bootstrap, "_role", role)
+
+		client = create_client()
+		runtime = bootstrap.Runtime(client, get_config())
+		runtimes.append(runtime)
+		bootstrap._install_stages(runtime)
+		apm_env.setattr(bootstrap, "_runtime", runtime)
+		apm_env.setattr(bootstrap, "_attempted", True)
+		return runtime
+
+	yield make
+	for runtime in runtimes:
+		close_runtime(runtime)
@@ -0,0 +1,109 @@
+"""
+Local stand-in for the APM server's intake API
+
+Accepts the agent's gzip-compressed NDJSON batches on /intake/v2/events and
+keeps the decoded events, so tests can drive the real HTTP transport end to
+end. While `failing` is set every batch is answered with a 503, and every
+batch is answered only after `delay` seconds.
+"""
+
+import gzip
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INTAKE_PATH = "/intake/v2/events"
+
+
+class _Handler(BaseHTTPRequestHandler):
+	def log_message(self, format, *args):
+		pass
+
+	def _reply(self, status, body=b"{}"):
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		# Server information, fetched once by the agent
+		self._reply(200, json.dumps({"version": "8.15.0"}).encode())
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		intake = self.server.intake
+		if intake.delay:
+			time.sleep(intake.delay)
+		if not self.path.startswith(INTAKE_PATH):
+			self._reply(404)
+			return
+		if intake.failing:
+			intake.rejected += 1
+			self._reply(503, b'{"error": "unavailable"}')
+			return
+
+		if self.headers.get("Content-Encoding") == "gzip":
+			body = gzip.decompress(body)
+		events = [json.loads(line) for line in body.splitlines() if line.strip()]
+		with intake.lock:
+			intake.batches.append(body)
+			intake.received.extend(events)
+		self._reply(202, b"")
+
+
+class _Server(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+		# An agent that gave up waiting (a work horse that exited) is not an error
+		if not isinstance(sys.exc_info()[1], ConnectionError):
+			super().handle_error(request, client_address)
+
+
+class Intake:
+	"""An HTTP intake on a free local port, recording what the agent sends"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.batches = []
+		self.received = []
+		self.failing = False
+		self.delay = 0
+		self.rejected = 0
+		self._server = _Server(("127.0.0.1", 0), _Handler)
+		self._server.intake = self
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+		self._thread.start()
+
+	@property
+	def url(self):
+		host, port = self._server.server_address
+		return f"http://{host}:{port}"
+
+	def events(self, kind):
+		"""Return the received events of one kind ("transaction", "span", "error", ...)"""
+		with self.lock:
+			return [event[kind] for event in self.received if kind in event]
+
+	def wait_for(self, kind, count=1, timeout=10):
+		"""Wait until at least `count` events of `kind` arrived, and return them"""
+		deadline = time.monotonic() + timeout
+		while True:
+			events = self.events(kind)
+			if len(events) >= count or time.monotonic() >= deadline:
+				return events
+			time.sleep(0.02)
+
+	def close(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+
+def flush(runtime):
+	"""Hand everything a runtime buffered to the transport and wait until it was sent"""
+	if runtime.pipeline is not None:
+		runtime.pipeline.flush()
+	runtime.client._transport.flush()
@@ -0,0 +1,116 @@
+"""
+Bootstrap: process roles from the command line, and one runtime per process
+across forks
+"""
+
+import json
+import os
+import subprocess
+import sys
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from erpnext_apm import bootstrap
+from tests.intake import flush
+
+BENCH_HELPER = "/home/frappe/frappe-bench/apps/frappe/frappe/utils/bench_helper.py"
+
+
+@pytest.mark.parametrize(
+	"argv, role",
+	[
+		(["/home/frappe/frappe-bench/env/bin/gunicorn", "-b", "127.0.0.1:8000", "frappe.app:application"], "web"),
+		([BENCH_HELPER, "frappe", "serve", "--port", "8000"], "web"),
+		([BENCH_HELPER, "frappe", "worker", "--queue", "short,default"], "worker"),
+		([BENCH_HELPER, "frappe", "--site", "worker", "worker-pool"], "worker"),
+		([BENCH_HELPER, "frappe", "schedule"], "scheduler"),
+		([BENCH_HELPER, "frappe", "--site", "site1.local", "migrate"], "cli"),
+		([BENCH_HELPER, "frappe"], "cli"),
+		(["/usr/bin/python3", "-c", "pass"], None),
+		([], None),
+	],
+)
+def test_detect_process_role(argv, role):
+	assert bootstrap.detect_process_role(argv) == role
+
+
+def test_forked_web_worker_builds_its_own_runtime(make_runtime):
+	runtime = make_runtime(role="web")
+	forks = bootstrap._forks
+
+	pid = os.fork()
+	if pid == 0:
+		inherited = bootstrap._runtime is not None or bootstrap._attempted
+		os._exit(1 if inherited or bootstrap._forks != forks + 1 else 0)
+	_pid, status = os.waitpid(pid, 0)
+
+	assert os.waitstatus_to_exitcode(status) == 0
+	# The parent keeps its own
+	assert bootstrap._runtime is runtime
+	assert bootstrap.get_client() is runtime.client
+
+
+SETUP = """
+import json, sys
+from erpnext_apm import bootstrap
+active = bootstrap.setup(role=sys.argv[1])
+print(json.dumps([active, bootstrap._role, "elasticapm" in sys.modules]))
+"""
+
+
+@pytest.mark.parametrize(
+	"hint, roles, expected",
+	[
+		("worker", None, [True, "worker", False]),
+		("scheduler", None, [True, "scheduler", False]),
+		("worker", "web", [False, "worker", False]),
+	],
+)
+def test_setup_does_not_import_the_agent(hint, roles, expected):
+	env = {name: value for name, value in os.environ.items() if not name.startswith(("ERPNEXT_APM_", "ELASTIC_APM_"))}
+	env.update(ELASTIC_APM_SERVICE_NAME="erpnext-apm-tests", ELASTIC_APM_SERVER_URL="http://127.0.0.1:8200")
+	if roles is not None:
+		env["ERPNEXT_APM_PROCESS_ROLES"] = roles
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	output = subprocess.run(
+		[sys.executable, "-c", SETUP, hint], cwd=root, env=env, capture_output=True, text=True, check=True
+	).stdout
+	assert json.loads(output.splitlines()[-1]) == expected
+
+
+def _application(environ, start_response):
+	start_response("200 OK", [("Content-Type", "text/plain")])
+	return [b"ok"]
+
+
+def _get(application, path="/api/method/ping"):
+	environ = {}
+	setup_testing_defaults(environ)
+	environ["PATH_INFO"] = path
+	return b"".join(application(environ, lambda status, headers, exc_info=None: None))
+
+
+def test_stand_in_builds_the_middleware_on_its_first_call(make_runtime, intake):
+	from erpnext_apm.wsgi import ElasticAPMWSGI
+
+	runtime = make_runtime(role="web")
+	application = bootstrap.DeferredElasticAPMWSGI(_application)
+	assert application._middleware is None
+
+	assert _get(application) == b"ok"
+	middleware = application._middleware
+	assert isinstance(middleware, ElasticAPMWSGI)
+	assert _get(application) == b"ok"
+	assert application._middleware is middleware
+
+	flush(runtime)
+	assert len(intake.wait_for("transaction", 2)) == 2
+
+
+def test_stand_in_passes_requests_through_without_a_runtime(monkeypatch):
+	monkeypatch.setattr(bootstrap, "_runtime", None)
+	monkeypatch.setattr(bootstrap, "_attempted", True)
+	application = bootstrap.DeferredElasticAPMWSGI(_application)
+	assert _get(application) == b"ok"
+	assert application._middleware is _application
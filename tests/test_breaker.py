@@ -0,0 +1,99 @@
+"""
+Circuit breaker: opening on consecutive failures, the half-open probe and
+the state the web workers publish for check_apm
+"""
+
+import os
+
+import pytest
+
+from erpnext_apm import breaker as breaker_module
+from erpnext_apm.breaker import CircuitBreaker
+from erpnext_apm.prometheus import read_workers
+
+
+class Clock:
+	def __init__(self):
+		self.now = 500.0
+
+	def __call__(self):
+		return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	clock = Clock()
+	monkeypatch.setattr(breaker_module.time, "monotonic", clock)
+	return clock
+
+
+def _trip(breaker):
+	for _ in range(breaker.failure_threshold):
+		breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(clock):
+	breaker = CircuitBreaker(failure_threshold=3, backoff_ms=1000)
+	breaker.record_failure()
+	breaker.record_failure()
+	breaker.record_success()
+	breaker.record_failure()
+	assert breaker.state == "closed"
+
+	_trip(breaker)
+	assert breaker.state == "open"
+	assert not breaker.allow()
+	assert breaker.stats()["shed"] == 1
+	assert breaker.stats()["trips"] == 1
+
+
+def test_half_open_probe_closes_or_reopens_with_a_longer_backoff(clock):
+	half_opened = []
+	breaker = CircuitBreaker(
+		failure_threshold=1, backoff_ms=1000, max_backoff_ms=3000, on_half_open=lambda: half_opened.append(1)
+	)
+	_trip(breaker)
+
+	clock.now += 1
+	# One probe, and nothing else until its result is in
+	assert breaker.allow()
+	assert not breaker.allow()
+	assert (breaker.state, len(half_opened)) == ("half_open", 1)
+
+	breaker.record_failure()
+	assert (breaker.state, breaker.backoff) == ("open", 2)
+	clock.now += 2
+	assert breaker.allow()
+	breaker.record_failure()
+	# Capped at max_backoff_ms
+	assert breaker.backoff == 3
+
+	clock.now += 3
+	assert breaker.allow()
+	breaker.record_success()
+	assert (breaker.state, breaker.backoff) == ("closed", 1)
+	assert breaker.allow()
+
+
+def test_probe_without_a_result_counts_as_failed(clock):
+	breaker = CircuitBreaker(failure_threshold=1, backoff_ms=1000, probe_timeout_ms=5000)
+	_trip(breaker)
+	clock.now += 1
+	assert breaker.allow()
+
+	clock.now += 5
+	assert not breaker.allow()
+	assert breaker.state == "open"
+	assert breaker.trips == 2
+
+
+def test_workers_publish_their_breaker_state(make_runtime, tmp_path):
+	directory = str(tmp_path / "metrics")
+	runtime = make_runtime(role="web", PROMETHEUS=True, PROMETHEUS_DIR=directory, BREAKER_FAILURES=2)
+	_trip(runtime.breaker)
+	runtime.breaker.allow()
+	runtime.prometheus.sync()
+
+	(worker,) = read_workers(directory)
+	assert worker["live"] and worker["pid"] == os.getpid()
+	assert (worker["breaker_open"], worker["breaker_trips"], worker["breaker_shed"]) == (1, 1, 1)
@@ -0,0 +1,48 @@
+"""
+Status command: it must still report when the setup it diagnoses is broken,
+and say whose pipeline and breaker state it prints
+"""
+
+import os
+
+import pytest
+
+from check_apm import check_status
+from erpnext_apm.prometheus import WorkerMetrics
+
+
+@pytest.fixture
+def unset(monkeypatch):
+	monkeypatch.delenv("ELASTIC_APM_SERVICE_NAME", raising=False)
+	monkeypatch.delenv("ELASTIC_APM_SERVER_URL", raising=False)
+	return monkeypatch
+
+
+def test_missing_required_variables_are_reported(unset, capsys):
+	check_status()
+	out = capsys.readouterr().out
+	assert "ELASTIC_APM_SERVICE_NAME: NOT SET" in out
+	assert "ELASTIC_APM_SERVER_URL: NOT SET" in out
+	assert "Check complete!" in out
+
+
+def test_state_of_this_process_is_labelled_as_such(unset, capsys, tmp_path):
+	unset.setenv("ERPNEXT_APM_PROMETHEUS", "true")
+	unset.setenv("ERPNEXT_APM_PROMETHEUS_DIR", str(tmp_path))
+	check_status()
+	out = capsys.readouterr().out
+	assert "NOT of the web workers" in out
+	assert "6. Circuit Breaker (this bench execute process):" in out
+
+
+def test_workers_state_is_read_from_their_metrics_files(unset, capsys, tmp_path):
+	unset.setenv("ERPNEXT_APM_PROMETHEUS", "true")
+	unset.setenv("ERPNEXT_APM_PROMETHEUS_DIR", str(tmp_path))
+	metrics = WorkerMetrics(str(tmp_path), stats=lambda: {"breaker_open": 1, "breaker_trips": 3})
+	metrics.sync()
+
+	check_status()
+	out = capsys.readouterr().out
+	assert "6. Circuit Breaker:" in out
+	assert "✗ Open in 1 of 1 live workers" in out
+	assert f"pid {os.getpid()}: open, trips 3" in out
@@ -0,0 +1,133 @@
+"""
+Concurrency tracking: in-flight requests and utilization of a worker, the
+pool figures reported by the lowest live slot, and slots of exited workers
+taken over by the next worker
+"""
+
+import json
+import os
+import time
+
+import pytest
+
+from erpnext_apm.concurrency import ConcurrencyTracker, worker_threads
+
+
+def test_worker_threads_from_the_gunicorn_command_line():
+	assert worker_threads(["gunicorn", "--threads", "4"], {}) == 4
+	assert worker_threads(["gunicorn", "--threads=8"], {}) == 8
+	assert worker_threads(["gunicorn"], {"GUNICORN_CMD_ARGS": "--workers 2 --threads 3"}) == 3
+	assert worker_threads(["gunicorn", "--threads", "many"], {}) == 1
+	assert worker_threads(["gunicorn"], {}) == 1
+
+
+def test_worker_figures_and_its_own_pool(tmp_path):
+	tracker = ConcurrencyTracker(str(tmp_path), capacity=2)
+	tracker.begin()
+	time.sleep(0.05)
+	tracker.end()
+	tracker.begin()
+
+	worker, pool = tracker.collect()
+	assert (worker["in_flight"], worker["peak"], worker["capacity"]) == (1, 1, 2)
+	assert 0 < worker["utilization"] <= 1
+	assert (pool["workers"], pool["in_flight"], pool["peak"], pool["capacity"]) == (1, 1, 1, 2)
+	# The peak starts over from what is in flight
+	tracker.end()
+	assert tracker.collect()[0]["peak"] == 1
+	assert tracker.stats()["in_flight"] == 0
+
+
+def test_metricset_sends_worker_and_pool_scopes(make_runtime):
+	runtime = make_runtime(WORKER_THREADS=4)
+	runtime.concurrency.tracker.begin()
+	metricsets = list(runtime.concurrency.collect())
+	runtime.concurrency.tracker.end()
+
+	assert [metricset["tags"]["scope"] for metricset in metricsets] == ["worker", "pool"]
+	samples = metricsets[1]["samples"]
+	assert samples["concurrency.capacity"]["value"] == 4
+	assert samples["concurrency.in_flight"]["value"] == 1
+
+
+class _Worker:
+	"""A tracker in a forked child, driven over a pipe; the children share their parent's file"""
+
+	def __init__(self, directory, capacity=2):
+		commands, self._commands = os.pipe()
+		self._replies, replies = os.pipe()
+		self.pid = os.fork()
+		if self.pid == 0:
+			os.close(self._commands)
+			os.close(self._replies)
+			self._serve(directory, capacity, commands, replies)
+		os.close(commands)
+		os.close(replies)
+		self._commands = os.fdopen(self._commands, "w", buffering=1)
+		self._replies = os.fdopen(self._replies)
+		self.slot = json.loads(self._replies.readline())
+
+	@staticmethod
+	def _serve(directory, capacity, commands, replies):
+		try:
+			tracker = ConcurrencyTracker(directory, capacity=capacity)
+			with os.fdopen(commands) as commands, os.fdopen(replies, "w", buffering=1) as replies:
+				replies.write(f"{json.dumps(tracker.slot)}\n")
+				for command in commands:
+					# Exits mid-request if told to, without ending it
+					if command.strip() == "exit":
+						break
+					replies.write(f"{json.dumps(getattr(tracker, command.strip())())}\n")
+		finally:
+			os._exit(0)
+
+	def call(self, command):
+		self._commands.write(f"{command}\n")
+		return json.loads(self._replies.readline())
+
+	def exit(self):
+		if self.pid is None:
+			return
+		self._commands.write("exit\n")
+		self._commands.close()
+		self._replies.close()
+		os.waitpid(self.pid, 0)
+		self.pid = None
+
+
+@pytest.fixture
+def workers(tmp_path):
+	started = []
+
+	def start():
+		worker = _Worker(str(tmp_path))
+		started.append(worker)
+		return worker
+
+	yield start
+	for worker in started:
+		worker.exit()
+
+
+def test_slot_of_an_exited_worker_is_taken_over(workers):
+	first, second = workers(), workers()
+	assert (first.slot, second.slot) == (0, 1)
+	first.call("begin")
+	second.call("begin")
+
+	# The lowest live slot reports for the pool
+	_worker, pool = first.call("collect")
+	assert (pool["workers"], pool["in_flight"], pool["capacity"]) == (2, 2, 4)
+	assert second.call("collect")[1] is None
+
+	# Exiting mid-request leaves a count behind that no longer counts
+	first.exit()
+	_worker, pool = second.call("collect")
+	assert (pool["workers"], pool["in_flight"], pool["capacity"]) == (1, 1, 2)
+
+	# The next worker starts in the free slot, with its figures cleared
+	third = workers()
+	assert third.slot == 0
+	_worker, pool = third.call("collect")
+	assert (pool["workers"], pool["in_flight"]) == (2, 1)
+	assert second.call("collect")[1] is None
@@ -0,0 +1,113 @@
+"""
+Database spans: SQL fingerprints and the patched Database methods
+"""
+
+import re
+
+import pytest
+
+from erpnext_apm import db, nplusone
+from erpnext_apm.state import end_state, start_state
+from tests.intake import flush
+
+
+@pytest.mark.parametrize(
+	"query, fingerprint",
+	[
+		(
+			"select name from `tabItem` where item_code = 'ITEM-1' and qty > 10",
+			"select name from `tabItem` where item_code = ? and qty > ?",
+		),
+		(
+			"SELECT *\n  FROM `tabSales Invoice`\n WHERE name IN ('A', 'B', 'C')",
+			"SELECT * FROM `tabSales Invoice` WHERE name IN (...)",
+		),
+		(
+			"update `tabBin` set actual_qty = %(qty)s where item_code = %s",
+			"update `tabBin` set actual_qty = ? where item_code = ?",
+		),
+		("select 'it''s', -1.5e3 from dual", "select ?, ? from dual"),
+		# MariaDB takes double quotes as a string too
+		(
+			'select name from `tabItem` where item_code = "ITEM-1" and descr = "say \\"hi\\"" or x = "a""b"',
+			"select name from `tabItem` where item_code = ? and descr = ? or x = ?",
+		),
+		("""select "it's", 'say "hi"' from dual""", "select ?, ? from dual"),
+		# Digits inside identifiers are not literals
+		("select col1 from `tab2fa`", "select col1 from `tab2fa`"),
+	],
+)
+def test_fingerprint(query, fingerprint):
+	assert db._fingerprint_sql(query)[0] == fingerprint
+
+
+def test_double_quotes_are_identifiers_on_postgres():
+	fingerprint, _name = db._fingerprint_sql("""select "name" from "tabItem" where name = 'x'""", "postgresql")
+	assert fingerprint == """select "name" from "tabItem" where name = ?"""
+
+
+def test_span_name_is_the_signature_and_a_digest_of_the_fingerprint():
+	_fingerprint, name = db._fingerprint_sql("select name from `tabItem` where name = 'x'")
+	assert re.fullmatch(r"SELECT FROM tabItem \[[0-9a-f]{8}\]", name)
+	# The same query with other values gets the same name, another query on the table another one
+	assert db._fingerprint_sql('select name from `tabItem` where name = "y"')[1] == name
+	assert db._fingerprint_sql("select item_name from `tabItem` where name = 'x'")[1] != name
+
+
+class FakeDatabase:
+	def __init__(self):
+		self.queries = []
+
+	def sql(self, query, values=None):
+		self.queries.append(query)
+		return [("ITEM-1",)]
+
+	def get_value(self, doctype, filters=None, fieldname="name"):
+		return "ITEM-1"
+
+
+@pytest.fixture
+def database(monkeypatch):
+	monkeypatch.setattr(nplusone, "_threshold", 0)
+	monkeypatch.setattr(FakeDatabase, "sql", db._wrap_sql(FakeDatabase.sql, "mariadb"))
+	monkeypatch.setattr(FakeDatabase, "get_value", db._wrap_orm_call(FakeDatabase.get_value, "mariadb", "get_value"))
+	return FakeDatabase()
+
+
+def test_calls_outside_a_transaction_are_not_counted(database):
+	assert database.sql("select 1") == [("ITEM-1",)]
+	assert database.queries == ["select 1"]
+
+
+def test_calls_in_a_transaction_record_spans_and_labels(make_runtime, intake, database):
+	import elasticapm
+
+	runtime = make_runtime()
+	runtime.client.begin_transaction("request")
+	start_state()
+	database.sql("select name from `tabItem` where item_code = 'ITEM-1'")
+	database.get_value("Item", {"item_code": "ITEM-1"})
+	labels = end_state().finish()
+	elasticapm.label(**labels)
+	runtime.client.end_transaction("GET /app/item/<name>", "success")
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert transaction["context"]["tags"]["db_query_count"] == 1
+	spans = {span["name"]: span for span in intake.wait_for("span", 2)}
+	sql = spans[db.fingerprint_sql("select name from `tabItem` where item_code = 'ITEM-1'", "mariadb")[1]]
+	assert (sql["type"], sql["subtype"], sql["action"]) == ("db", "mariadb", "query")
+	assert sql["context"]["db"]["statement"] == "select name from `tabItem` where item_code = ?"
+	assert spans["frappe.db.get_value Item"]["action"] == "get_value"
+
+
+def test_double_quoted_values_make_one_query_pattern(database, monkeypatch):
+	monkeypatch.setattr(nplusone, "_threshold", 3)
+	state = start_state()
+	try:
+		for index in range(5):
+			database.sql(f'select name from `tabItem` where item_code = "ITEM-{index}"')
+	finally:
+		end_state()
+	(pattern,) = state.detector.queries.values()
+	assert (pattern.count, pattern.aggregated_count) == (5, 2)
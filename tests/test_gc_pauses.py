@@ -0,0 +1,76 @@
+"""
+Garbage collector pauses: per-generation histograms, the labels on the
+transaction whose thread triggered a collection, and replacing the
+callback of a parent worker
+"""
+
+import gc
+
+from erpnext_apm import gc_pauses
+from erpnext_apm.gc_pauses import GcMonitor, install_gc_monitor
+from erpnext_apm.state import end_state, start_state
+
+
+def test_collections_are_counted_per_generation():
+	monitor = GcMonitor()
+	monitor("start", {"generation": 0})
+	monitor("stop", {"generation": 0, "collected": 5})
+	monitor("start", {"generation": 2})
+	monitor("stop", {"generation": 2, "collected": 1})
+	# A stop without its start, from before the callback was installed
+	monitor("stop", {"generation": 1, "collected": 9})
+
+	histograms, pauses, collected = monitor.collect()
+	assert [sum(counts) for counts in histograms] == [1, 0, 1]
+	assert collected == [5, 0, 1]
+	assert pauses[1] == 0.0 and pauses[0] >= 0.0
+	assert [sum(counts) for counts in monitor.collect()[0]] == [0, 0, 0]
+
+
+def test_pauses_are_added_to_the_running_transaction():
+	monitor = GcMonitor()
+	state = start_state()
+	try:
+		monitor("start", {"generation": 1})
+		monitor("stop", {"generation": 1, "collected": 0})
+		monitor("start", {"generation": 0})
+		monitor("stop", {"generation": 0, "collected": 0})
+	finally:
+		end_state()
+
+	assert state.gc_count == 2
+	labels = state.finish()
+	assert labels["gc_collections"] == 2
+	assert labels["gc_pause_ms"] == round(state.gc_time * 1000, 3)
+
+
+def test_install_replaces_the_previous_monitor(monkeypatch):
+	monkeypatch.setattr(gc_pauses, "_callback", None)
+	parent, child = GcMonitor(), GcMonitor()
+	try:
+		install_gc_monitor(parent)
+		install_gc_monitor(child)
+		assert parent not in gc.callbacks
+		assert gc.callbacks.count(child) == 1
+	finally:
+		for monitor in (parent, child):
+			if monitor in gc.callbacks:
+				gc.callbacks.remove(monitor)
+
+
+def test_metricset_reports_the_generations_that_ran(make_runtime):
+	runtime = make_runtime()
+	# No automatic collections in between
+	gc.disable()
+	try:
+		runtime.gc.monitor.collect()
+		gc.collect(1)
+	finally:
+		gc.enable()
+
+	metricsets = list(runtime.gc.collect())
+	assert [metricset["tags"]["generation"] for metricset in metricsets] == ["1"]
+	samples = metricsets[0]["samples"]
+	assert samples["gc.collections"]["value"] == 1
+	assert samples["gc.pause.us"]["counts"] == [1]
+	assert samples["gc.pause.total.ms"]["value"] >= 0
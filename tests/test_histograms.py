@@ -0,0 +1,107 @@
+"""
+Log-linear histograms: bucket boundaries, quantiles and the route cap, and
+the route latency metric set built on them
+"""
+
+import logging
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from erpnext_apm.histograms import (
+	BUCKET_COUNT,
+	LINEAR_LIMIT,
+	MAX_VALUE,
+	OVERFLOW_ROUTE,
+	Histogram,
+	RouteHistograms,
+	bucket_bounds,
+	bucket_index,
+	percentiles,
+)
+
+
+def test_every_value_falls_inside_its_bucket():
+	values = list(range(LINEAR_LIMIT + 64)) + [random.Random(7).randrange(MAX_VALUE) for _ in range(5000)]
+	for value in [*values, MAX_VALUE]:
+		lower, upper = bucket_bounds(bucket_index(value))
+		assert lower <= value < upper
+
+
+def test_buckets_are_contiguous_and_never_wider_than_a_sixteenth():
+	previous_upper = 0
+	for index in range(BUCKET_COUNT):
+		lower, upper = bucket_bounds(index)
+		assert lower == previous_upper
+		assert upper - lower <= max(lower / 16, 1)
+		previous_upper = upper
+	# Anything longer goes in the last bucket
+	assert bucket_index(MAX_VALUE * 10) == BUCKET_COUNT - 1
+
+
+@pytest.mark.parametrize("quantile", [0.5, 0.9, 0.95, 0.99])
+def test_quantiles_are_within_the_bucket_resolution(quantile):
+	rng = random.Random(42)
+	durations = sorted(int(rng.lognormvariate(10, 1.2)) for _ in range(20000))
+	counts = [0] * BUCKET_COUNT
+	for duration in durations:
+		counts[bucket_index(duration)] += 1
+
+	(estimate,) = percentiles(counts, (quantile,))
+	exact = durations[round(quantile * len(durations)) - 1]
+	assert abs(estimate - exact) <= exact / 16
+
+
+def test_percentiles_of_nothing():
+	assert percentiles([0] * BUCKET_COUNT, (0.5, 0.99)) is None
+
+
+def test_collect_starts_over():
+	histogram = Histogram()
+	histogram.record(0.25)
+	histogram.record(0.000010)
+	counts = histogram.collect()
+	assert sum(counts) == 2
+	assert counts[bucket_index(10)] == 1
+	assert sum(histogram.collect()) == 0
+
+
+def test_routes_past_the_cap_share_one_histogram():
+	histograms = RouteHistograms(max_routes=2)
+	for route in ("GET /app/item", "GET /app/user", "GET /app/todo", "GET /app/note"):
+		histograms.record(route, 0.1)
+	histograms.record("GET /app/item", 0.2)
+
+	routes = histograms.collect()
+	assert sorted(routes) == sorted(["GET /app/item", "GET /app/user", OVERFLOW_ROUTE])
+	assert sum(routes[OVERFLOW_ROUTE]) == 2
+	assert sum(routes["GET /app/item"]) == 2
+	assert len(histograms) == 0
+
+
+def test_route_latency_metricset_sends_quantiles_per_route(make_runtime):
+	metricset = make_runtime().route_latency
+	for duration in (0.010, 0.020, 0.030, 1.0):
+		metricset.histograms.record("GET /app/item", duration)
+
+	(data,) = list(metricset.collect())
+	samples = data["samples"]
+	assert data["tags"] == {"route": "GET /app/item"}
+	assert samples["route.requests"]["value"] == 4
+	assert sum(samples["route.duration.us"]["counts"]) == 4
+	assert 19 <= samples["route.duration.p50.ms"]["value"] <= 21
+	assert 960 <= samples["route.duration.p99.ms"]["value"] <= 1040
+
+
+def test_register_metricset_warns_when_nothing_comes_back(caplog):
+	from erpnext_apm.metrics import RouteLatencyMetricSet, register_metricset
+
+	def failing(metricset_class):
+		raise RuntimeError("metrics disabled")
+
+	caplog.set_level(logging.WARNING, logger="erpnext_apm.metrics")
+	for register in (lambda metricset_class: None, failing):
+		client = SimpleNamespace(metrics=SimpleNamespace(register=register))
+		assert register_metricset(client, RouteLatencyMetricSet) is None
+	assert [record.levelno for record in caplog.records] == [logging.WARNING, logging.WARNING]
@@ -0,0 +1,105 @@
+"""
+Background jobs: RQ runs each job in a forked work horse that leaves
+through os._exit(), so the job's transaction must be sent before that
+"""
+
+import os
+import time
+
+import pytest
+
+from erpnext_apm import bootstrap, jobs
+from tests.conftest import close_runtime
+from tests.intake import flush
+
+
+@pytest.fixture
+def worker(monkeypatch):
+	"""This process as an RQ worker that has already run setup()"""
+	monkeypatch.setattr(bootstrap, "_setup_done", True)
+	monkeypatch.setattr(bootstrap, "_active", True)
+	monkeypatch.setattr(bootstrap, "_role", "worker")
+
+
+def _work_horse(method):
+	"""Run one job the way an RQ work horse does and return its exit code"""
+	pid = os.fork()
+	if pid == 0:
+		code = 1
+		try:
+			os.setsid()
+			jobs.before_job(method=method, kwargs={})
+			jobs.after_job(method=method)
+			# Still the worker's runtime, not one built for the job
+			code = 0 if bootstrap._runtime.pid == os.getppid() else 2
+		finally:
+			os._exit(code)
+	_pid, status = os.waitpid(pid, 0)
+	return os.waitstatus_to_exitcode(status)
+
+
+def test_work_horse_sends_its_job_before_exiting(worker, make_runtime, intake):
+	make_runtime(role="worker")
+	assert _work_horse("erpnext.stock.reorder_item.reorder_item") == 0
+
+	(transaction,) = intake.wait_for("transaction")
+	assert transaction["type"] == "job"
+	assert transaction["name"] == "erpnext.stock.reorder_item.reorder_item"
+	assert transaction["result"] == "success"
+
+
+def test_worker_builds_its_runtime_before_the_first_horse(worker, apm_env, intake):
+	apm_env.setattr(bootstrap, "_runtime", None)
+	apm_env.setattr(bootstrap, "_attempted", False)
+	try:
+		assert _work_horse("frappe.email.queue.flush") == 0
+		runtime = bootstrap._runtime
+		assert runtime is not None and runtime.pid == os.getpid()
+	finally:
+		if bootstrap._runtime is not None:
+			close_runtime(bootstrap._runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert transaction["name"] == "frappe.email.queue.flush"
+	# The worker itself sent nothing of the job
+	assert runtime.pipeline.stats()["enqueued"] == 0
+
+
+def test_work_horse_does_not_wait_long_for_a_slow_apm_server(worker, make_runtime, intake):
+	make_runtime(role="worker", JOB_FLUSH_TIMEOUT_MS=50)
+	intake.delay = 2
+
+	started = time.monotonic()
+	assert _work_horse("erpnext.stock.reorder_item.reorder_item") == 0
+	assert time.monotonic() - started < 1
+
+
+def test_failing_job_is_reported_as_an_error(worker, make_runtime, intake):
+	runtime = make_runtime(role="worker")
+	method = "erpnext.accounts.utils.repost_gle"
+	jobs.before_job(method=method, kwargs={})
+	try:
+		raise ValueError("Account is frozen")
+	except ValueError:
+		# Where Frappe's execute_job calls the after_job hooks
+		jobs.after_job(method=method)
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert transaction["result"] == "error"
+	(error,) = intake.wait_for("error")
+	assert error["exception"]["message"] == "ValueError: Account is frozen"
+	assert error["transaction_id"] == transaction["id"]
+
+
+def test_job_without_a_traceparent_starts_its_own_trace(worker, make_runtime, intake):
+	# As every job of a site without erpnext_apm, had its before_job run
+	runtime = make_runtime(role="worker")
+	kwargs = {"doc": "X"}
+	jobs.before_job(method="frappe.email.queue.flush", kwargs=kwargs)
+	jobs.after_job(method="frappe.email.queue.flush", kwargs=kwargs)
+	flush(runtime)
+
+	assert kwargs == {"doc": "X"}
+	(transaction,) = intake.wait_for("transaction")
+	assert "parent_id" not in transaction
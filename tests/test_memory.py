@@ -0,0 +1,108 @@
+"""
+Memory tracking: what a measured request allocated and did to the RSS,
+the per-route aggregates, and the labels on the request's transaction
+"""
+
+import tracemalloc
+from wsgiref.util import setup_testing_defaults
+
+from erpnext_apm.histograms import OVERFLOW_ROUTE
+from erpnext_apm.memory import TOP_SITES_MIN_BYTES, MemoryTracker
+from tests.intake import flush
+
+ROUTE = "GET /api/method/frappe.desk.reportview.get"
+
+# Kept alive past end() so they count as allocated by the request
+_retained = []
+
+
+def _allocate(size):
+	_retained.append(bytearray(size))
+
+
+def test_measured_request_reports_its_allocations_and_top_sites():
+	tracker = MemoryTracker(sample_rate=1)
+	tracker.begin()
+	assert tracemalloc.is_tracing()
+	_allocate(2 * TOP_SITES_MIN_BYTES)
+	usage = tracker.end(ROUTE)
+	_retained.clear()
+
+	assert not tracemalloc.is_tracing()
+	assert usage.allocated >= 2 * TOP_SITES_MIN_BYTES
+	assert usage.peak >= usage.allocated
+	assert usage.rss_delta is not None
+	assert "test_memory.py" in usage.top_sites[0]
+	labels = usage.labels()
+	assert labels["mem_alloc_kb"] >= 2048
+	assert set(labels) == {"mem_rss_delta_kb", "mem_alloc_kb", "mem_alloc_peak_kb"}
+
+
+def test_requests_not_picked_are_not_measured():
+	tracker = MemoryTracker(sample_rate=0)
+	tracker.begin()
+	assert not tracemalloc.is_tracing()
+	assert tracker.end(ROUTE) is None
+	assert tracker.collect() == {}
+
+
+def test_tracemalloc_started_elsewhere_is_left_alone():
+	tracker = MemoryTracker(sample_rate=1)
+	tracemalloc.start()
+	try:
+		tracker.begin()
+		usage = tracker.end(ROUTE)
+		assert tracemalloc.is_tracing()
+	finally:
+		tracemalloc.stop()
+	# Only the RSS is measured
+	assert usage.allocated is None
+	assert "mem_alloc_kb" not in usage.labels()
+
+
+def test_routes_past_the_limit_are_pooled():
+	tracker = MemoryTracker(sample_rate=1, tracemalloc_enabled=False, max_routes=1)
+	for route in (ROUTE, ROUTE, "GET /app/item", "GET /app/user"):
+		tracker.begin()
+		tracker.end(route)
+
+	routes = tracker.collect()
+	assert sorted(routes) == sorted([ROUTE, OVERFLOW_ROUTE])
+	assert routes[ROUTE][0] == 2
+	assert routes[OVERFLOW_ROUTE][0] == 2
+	# Nothing traced with tracemalloc
+	assert routes[ROUTE][3] == 0
+	assert tracker.measured == 4
+	assert tracker.collect() == {}
+
+
+def _app(environ, start_response):
+	_allocate(64 * 1024)
+	start_response("200 OK", [("Content-Type", "text/plain")])
+	return [b"ok"]
+
+
+def test_middleware_labels_measured_requests_and_reports_per_route(make_runtime, intake):
+	from erpnext_apm.wsgi import ElasticAPMWSGI
+
+	runtime = make_runtime(MEMORY_TRACKING=True, MEMORY_SAMPLE_RATE=1)
+	middleware = ElasticAPMWSGI(_app, runtime.config)
+	environ = {"PATH_INFO": "/api/method/frappe.desk.reportview.get", "REQUEST_METHOD": "GET"}
+	setup_testing_defaults(environ)
+	assert b"".join(middleware(environ, lambda status, headers, exc_info=None: None)) == b"ok"
+	_retained.clear()
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction", 1)
+	tags = transaction["context"]["tags"]
+	assert tags["mem_alloc_kb"] >= 64
+	assert "mem_rss_delta_kb" in tags
+
+	runtime.memory.before_collect()
+	metricsets = list(runtime.memory.collect())
+	(gauges,) = [metricset for metricset in metricsets if "memory.rss.bytes" in metricset["samples"]]
+	assert gauges["samples"]["memory.rss.bytes"]["value"] > 0
+	(route,) = [metricset for metricset in metricsets if "route.memory.requests" in metricset["samples"]]
+	assert route["tags"]["route"] == transaction["name"]
+	assert route["samples"]["route.memory.requests"]["value"] == 1
+	assert route["samples"]["route.memory.allocated.mean.bytes"]["value"] >= 64 * 1024
@@ -0,0 +1,116 @@
+"""
+N+1 detection: repeated queries and get_doc fetches folded into one span
+"""
+
+import elasticapm
+import pytest
+
+from erpnext_apm import db, nplusone
+from erpnext_apm.state import end_state, start_state
+from tests.intake import flush
+
+THRESHOLD = 5
+
+
+@pytest.fixture(autouse=True)
+def detection(monkeypatch):
+	monkeypatch.setattr(nplusone, "_threshold", THRESHOLD)
+	monkeypatch.setattr(nplusone, "_max_patterns", 256)
+
+
+def test_track_query_hands_back_the_pattern_past_the_threshold():
+	state = start_state()
+	try:
+		patterns = [nplusone.track_query(state, "select ?", "SELECT") for _ in range(THRESHOLD + 2)]
+	finally:
+		end_state()
+	assert patterns[:THRESHOLD] == [None] * THRESHOLD
+	assert patterns[THRESHOLD] is patterns[THRESHOLD + 1] is not None
+	assert patterns[THRESHOLD].count == THRESHOLD + 2
+	assert __file__.rsplit("/", 1)[-1] in patterns[THRESHOLD].call_site
+
+
+def test_pattern_table_is_bounded(monkeypatch):
+	monkeypatch.setattr(nplusone, "_max_patterns", 2)
+	detector = nplusone.NPlusOneDetector()
+	for key in ("a", "b", "c"):
+		for _ in range(THRESHOLD + 1):
+			detector._track(detector.queries, key)
+	assert list(detector.queries) == ["a", "b"]
+
+
+def test_detection_off_tracks_nothing(monkeypatch):
+	monkeypatch.setattr(nplusone, "_threshold", 0)
+	state = start_state()
+	try:
+		assert nplusone.track_query(state, "select ?", "SELECT") is None
+		assert state.detector is None
+	finally:
+		end_state()
+
+
+class FakeDatabase:
+	def sql(self, query, values=None):
+		return []
+
+
+def _get_doc(doctype, name):
+	return {"doctype": doctype, "name": name}
+
+
+def test_queries_and_fetches_are_folded_past_the_same_threshold(monkeypatch):
+	monkeypatch.setattr(FakeDatabase, "sql", db._wrap_sql(FakeDatabase.sql, "mariadb"))
+	get_doc = nplusone._wrap_get_doc(_get_doc)
+	database = FakeDatabase()
+	state = start_state()
+	try:
+		for _ in range(THRESHOLD):
+			database.sql("select name from `tabCompany`")
+			get_doc("Company", "Acme")
+		# Up to the threshold nothing is folded and there is no pattern to report
+		assert state.detector.emit() == {}
+		database.sql("select name from `tabCompany`")
+		get_doc("Company", "Acme")
+	finally:
+		end_state()
+
+	(query,) = state.detector.queries.values()
+	(fetch,) = state.detector.fetches.values()
+	assert (query.count, query.aggregated_count) == (THRESHOLD + 1, 1)
+	assert (fetch.count, fetch.aggregated_count) == (THRESHOLD + 1, 1)
+
+
+def test_repeated_queries_and_fetches_become_aggregated_spans(make_runtime, intake, monkeypatch):
+	monkeypatch.setattr(FakeDatabase, "sql", db._wrap_sql(FakeDatabase.sql, "mariadb"))
+	get_doc = nplusone._wrap_get_doc(_get_doc)
+	database = FakeDatabase()
+
+	runtime = make_runtime()
+	runtime.client.begin_transaction("request")
+	start_state()
+	for index in range(THRESHOLD * 3):
+		database.sql(f"select qty from `tabBin` where item_code = 'ITEM-{index}'")
+		get_doc("Company", "Acme")
+	# Under the threshold: no pattern
+	database.sql("select name from `tabUser`")
+	labels = end_state().finish()
+	elasticapm.label(**labels)
+	runtime.client.end_transaction("POST /api/method/make_invoices", "success")
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert transaction["context"]["tags"]["n_plus_one_patterns"] == 2
+	assert "test_nplusone.py" in transaction["context"]["tags"]["n_plus_one_call_site"]
+
+	spans = {span["name"]: span for span in intake.events("span")}
+	(query,) = [span for name, span in spans.items() if name.startswith("N+1: SELECT FROM tabBin")]
+	# The folded calls only, the ones the span's duration covers
+	assert query["context"]["tags"]["n_plus_one_count"] == THRESHOLD * 2
+	assert query["context"]["db"]["statement"] == "select qty from `tabBin` where item_code = ?"
+	fetch = spans["N+1: get_doc Company"]
+	assert fetch["context"]["tags"]["n_plus_one_count"] == THRESHOLD * 2
+	assert fetch["context"]["tags"]["docname"] == "Acme"
+	assert not any(name.startswith("N+1: SELECT FROM tabUser") for name in spans)
+	# The calls up to the threshold were sent as spans of their own
+	sent = [span for span in intake.events("span") if span["name"].startswith("SELECT FROM tabBin")]
+	assert sum(span.get("composite", {}).get("count", 1) for span in sent) == THRESHOLD
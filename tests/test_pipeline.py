@@ -0,0 +1,105 @@
+"""
+Event pipeline: bounded buffer, drop policies and batched hand-off
+"""
+
+import threading
+import time
+
+import pytest
+
+from erpnext_apm.pipeline import DROP_OLDEST, DROP_UNSAMPLED, EventPipeline
+
+
+class Transport:
+	"""Next stage that records batches, with room only while `room` is set"""
+
+	def __init__(self):
+		self.events = []
+		self.room = True
+		self.received = threading.Event()
+
+	def __call__(self, event_type, data, flush=False):
+		self.events.append((event_type, data["id"]))
+		self.received.set()
+
+	def has_room(self, count):
+		return self.room
+
+
+@pytest.fixture
+def transport():
+	return Transport()
+
+
+@pytest.fixture
+def pipelines():
+	pipelines = []
+	yield pipelines
+	for pipeline in pipelines:
+		pipeline.close()
+
+
+def _pipeline(pipelines, transport, **kwargs):
+	kwargs.setdefault("flush_interval_ms", 60000)
+	pipeline = EventPipeline(transport, has_room=transport.has_room, **kwargs)
+	pipelines.append(pipeline)
+	return pipeline
+
+
+def test_unknown_drop_policy_is_rejected():
+	with pytest.raises(ValueError):
+		EventPipeline(lambda *args, **kwargs: None, drop_policy="drop_newest")
+
+
+def test_drop_unsampled_evicts_unsampled_transactions_first(pipelines, transport):
+	pipeline = _pipeline(pipelines, transport, capacity=3, batch_size=100, drop_policy=DROP_UNSAMPLED)
+	pipeline("transaction", {"id": "u1", "sampled": False})
+	pipeline("span", {"id": "s1"})
+	pipeline("transaction", {"id": "t1", "sampled": True})
+	pipeline("span", {"id": "s2"})
+	pipeline("span", {"id": "s3"})
+	pipeline.flush()
+
+	# u1 went first, then the oldest sampled event
+	assert transport.events == [("transaction", "t1"), ("span", "s2"), ("span", "s3")]
+	stats = pipeline.stats()
+	assert (stats["dropped"], stats["dropped_unsampled"], stats["enqueued"]) == (2, 1, 5)
+
+
+def test_drop_oldest_ignores_sampling(pipelines, transport):
+	pipeline = _pipeline(pipelines, transport, capacity=2, batch_size=100, drop_policy=DROP_OLDEST)
+	pipeline("span", {"id": "s1"})
+	pipeline("transaction", {"id": "u1", "sampled": False})
+	pipeline("span", {"id": "s2"})
+	pipeline.flush()
+	assert transport.events == [("transaction", "u1"), ("span", "s2")]
+	assert pipeline.stats()["dropped_unsampled"] == 0
+
+
+def test_full_batch_wakes_the_flush_thread(pipelines, transport):
+	pipeline = _pipeline(pipelines, transport, batch_size=3)
+	pipeline("span", {"id": "s1"})
+	pipeline("span", {"id": "s2"})
+	assert not transport.received.wait(0.2)
+
+	pipeline("span", {"id": "s3"})
+	assert transport.received.wait(5)
+	deadline = time.monotonic() + 5
+	while pipeline.stats()["flushed"] < 3 and time.monotonic() < deadline:
+		time.sleep(0.01)
+	assert transport.events == [("span", "s1"), ("span", "s2"), ("span", "s3")]
+
+
+def test_batches_are_held_back_while_the_transport_is_full(pipelines, transport):
+	pipeline = _pipeline(pipelines, transport, batch_size=100)
+	transport.room = False
+	pipeline("span", {"id": "s1"})
+	pipeline.flush()
+	assert transport.events == []
+	assert pipeline.stats()["held_back"] == 1
+	assert pipeline.stats()["buffered"] == 1
+
+	transport.room = True
+	pipeline.flush()
+	assert transport.events == [("span", "s1")]
+	assert pipeline.stats()["flushed"] == 1
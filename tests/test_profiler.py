@@ -0,0 +1,118 @@
+"""
+Sampling profiler: stacks of request threads folded per route, the bounds
+on what is kept, and merging the workers' folded files
+"""
+
+import threading
+
+from erpnext_apm.histograms import OVERFLOW_ROUTE
+from erpnext_apm.profiler import TRUNCATED, StackProfiler, main, merge_folded
+
+ROUTE = "GET /api/method/<method>"
+
+
+def _held(release):
+	release.wait(5)
+
+
+def _serve(profiler, route, entered, release):
+	profiler.enter(route)
+	entered.set()
+	_held(release)
+	profiler.exit()
+
+
+def _sample_request(profiler, route, ticks=3):
+	"""Sample a request thread `ticks` times while it waits in _held"""
+	entered, release = threading.Event(), threading.Event()
+	thread = threading.Thread(target=_serve, args=(profiler, route, entered, release))
+	thread.start()
+	entered.wait(5)
+	for _ in range(ticks):
+		profiler.sample()
+	release.set()
+	thread.join()
+
+
+def test_request_threads_are_folded_per_route():
+	profiler = StackProfiler()
+	idle = threading.Event()
+	bystander = threading.Thread(target=idle.wait, args=(5,))
+	bystander.start()
+	try:
+		_sample_request(profiler, ROUTE)
+	finally:
+		idle.set()
+		bystander.join()
+
+	(line,) = profiler.folded()
+	stack, count = line.rsplit(" ", 1)
+	frames = stack.split(";")
+	assert count == "3"
+	assert frames[0] == ROUTE
+	assert frames[-4:] == [
+		"tests.test_profiler._serve",
+		"tests.test_profiler._held",
+		"threading.Event.wait",
+		"threading.Condition.wait",
+	]
+	assert profiler.stats()["samples"] == 3
+
+
+def test_stacks_are_cut_at_max_depth():
+	profiler = StackProfiler(max_depth=3)
+	_sample_request(profiler, ROUTE, ticks=1)
+	# The innermost frames are kept
+	assert profiler.folded() == [
+		f"{ROUTE};tests.test_profiler._held;threading.Event.wait;threading.Condition.wait 1"
+	]
+
+
+def test_thread_still_in_the_same_frame_is_not_walked_again():
+	profiler = StackProfiler()
+	walked = []
+	fold = profiler._fold
+	profiler._fold = lambda frame: walked.append(frame) or fold(frame)
+	_sample_request(profiler, ROUTE, ticks=3)
+
+	# Blocked in the same wait for all three ticks
+	assert len(walked) == 1
+	((stack, count),) = profiler._routes[ROUTE].items()
+	assert count == 3 and stack[-1] == "threading.Condition.wait"
+
+
+def _exit_with(profiler, route, stacks):
+	profiler.enter(route)
+	profiler._active[threading.get_ident()].samples.update(stacks)
+	return profiler.exit()
+
+
+def test_routes_and_stacks_past_their_limits_are_pooled():
+	profiler = StackProfiler(max_stacks=2, max_routes=1)
+	_exit_with(profiler, "GET /app/item", {("a",): 1, ("b",): 1})
+	_exit_with(profiler, "GET /app/item", {("c",): 2, ("a",): 1})
+	_exit_with(profiler, "GET /app/user", {("a",): 1})
+	assert sorted(profiler.folded()) == [
+		f"{OVERFLOW_ROUTE};a 1",
+		f"GET /app/item;{TRUNCATED} 2",
+		"GET /app/item;a 2",
+		"GET /app/item;b 1",
+	]
+	# A request without samples adds nothing
+	assert _exit_with(profiler, "GET /app/todo", {}) is None
+
+
+def test_merge_sums_the_workers_files(tmp_path, capsys):
+	for pid, count in ((101, 2), (102, 5)):
+		profiler = StackProfiler()
+		_exit_with(profiler, ROUTE, {("frappe.handler.handle", "frappe.client.get_list"): count})
+		_exit_with(profiler, "GET /app/item", {("frappe.desk.form.load.getdoc",): 1})
+		(tmp_path / f"{pid}.folded").write_text("\n".join(profiler.folded()))
+
+	totals = merge_folded(str(tmp_path))
+	assert totals[f"{ROUTE};frappe.handler.handle;frappe.client.get_list"] == 7
+	assert totals["GET /app/item;frappe.desk.form.load.getdoc"] == 2
+	assert list(merge_folded(str(tmp_path), "GET /app/item")) == ["GET /app/item;frappe.desk.form.load.getdoc"]
+
+	assert main([str(tmp_path), ROUTE]) == 0
+	assert capsys.readouterr().out == f"{ROUTE};frappe.handler.handle;frappe.client.get_list 7\n"
@@ -0,0 +1,132 @@
+"""
+Prometheus exposition: per-worker metrics files summed on scrape, and the
+bearer token on the in-app metrics path
+"""
+
+import os
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from erpnext_apm.prometheus import CONTENT_TYPE, WorkerMetrics, read_workers, render, serve_metrics
+
+
+def _samples(text):
+	"""Return {series: value} of an exposition, without the comments"""
+	samples = {}
+	for line in text.splitlines():
+		if line and not line.startswith("#"):
+			series, value = line.rsplit(" ", 1)
+			samples[series] = float(value)
+	return samples
+
+
+def _exited_worker(directory):
+	"""Count requests in a child process that then exits"""
+	pid = os.fork()
+	if pid == 0:
+		code = 1
+		try:
+			metrics = WorkerMetrics(directory, stats=lambda: {"breaker_trips": 2, "breaker_open": 1})
+			metrics.begin()
+			metrics.end("GET /app/item", 0.2)
+			metrics.begin()
+			metrics.sync()
+			code = 0
+		finally:
+			os._exit(code)
+	_pid, status = os.waitpid(pid, 0)
+	assert os.waitstatus_to_exitcode(status) == 0
+
+
+def test_exposition_of_a_worker(tmp_path):
+	directory = str(tmp_path)
+	metrics = WorkerMetrics(directory)
+	metrics.begin()
+	metrics.end("GET /app/item", 0.003)
+	metrics.begin()
+	metrics.end("GET /app/item", 0.7, error=True)
+	metrics.begin()
+	metrics.end('GET /api/method/"quoted"', 30)
+	metrics.begin()
+	metrics.queued(0.02)
+
+	samples = _samples(render(directory))
+	assert samples["erpnext_apm_workers"] == 1
+	assert samples["erpnext_apm_http_requests_in_flight"] == 1
+	item = 'route="GET /app/item"'
+	assert samples[f"erpnext_apm_http_requests_total{{{item}}}"] == 2
+	assert samples[f"erpnext_apm_http_request_errors_total{{{item}}}"] == 1
+	assert samples[f'erpnext_apm_http_request_duration_seconds_bucket{{{item},le="0.005"}}'] == 1
+	assert samples[f'erpnext_apm_http_request_duration_seconds_bucket{{{item},le="1"}}'] == 2
+	assert samples[f"erpnext_apm_http_request_duration_seconds_sum{{{item}}}"] == pytest.approx(0.703)
+	quoted = 'route="GET /api/method/\\"quoted\\""'
+	assert samples[f'erpnext_apm_http_request_duration_seconds_bucket{{{quoted},le="10"}}'] == 0
+	assert samples[f'erpnext_apm_http_request_duration_seconds_bucket{{{quoted},le="+Inf"}}'] == 1
+	assert samples['erpnext_apm_http_request_queue_seconds_bucket{le="0.025"}'] == 1
+
+
+def test_exited_workers_keep_their_counters_but_not_their_gauges(tmp_path):
+	# One file per process, so the other worker is a child
+	directory = str(tmp_path)
+	_exited_worker(directory)
+
+	samples = _samples(render(directory))
+	assert samples["erpnext_apm_workers"] == 0
+	assert samples['erpnext_apm_http_requests_total{route="GET /app/item"}'] == 1
+	assert samples["erpnext_apm_breaker_trips_total"] == 2
+	assert samples["erpnext_apm_http_requests_in_flight"] == 0
+	assert samples["erpnext_apm_breaker_open_workers"] == 0
+
+	# The next worker takes the file over and counts on from there
+	metrics = WorkerMetrics(directory, stats=lambda: {"breaker_trips": 1})
+	metrics.end("GET /app/item", 0.1)
+	metrics.sync()
+	(worker,) = read_workers(directory)
+	assert worker["live"] and worker["pid"] == os.getpid()
+	samples = _samples(render(directory))
+	assert samples['erpnext_apm_http_requests_total{route="GET /app/item"}'] == 2
+	assert samples["erpnext_apm_breaker_trips_total"] == 3
+
+
+def _scrape(directory, authorization=None):
+	environ = {"PATH_INFO": "/metrics"}
+	setup_testing_defaults(environ)
+	if authorization is not None:
+		environ["HTTP_AUTHORIZATION"] = authorization
+	response = {}
+
+	def start_response(status, headers):
+		response.update(status=status, headers=dict(headers))
+
+	body = b"".join(serve_metrics(environ, start_response, directory, "s3cret"))
+	return response["status"], response["headers"], body
+
+
+@pytest.mark.parametrize("authorization", [None, "", "Bearer wrong", "Basic czNjcmV0", "Bearer s3cret "])
+def test_metrics_path_refuses_scrapers_without_the_token(tmp_path, authorization):
+	status, headers, body = _scrape(str(tmp_path), authorization)
+	assert status == "401 Unauthorized"
+	assert headers["WWW-Authenticate"] == "Bearer"
+	assert b"erpnext_apm" not in body
+
+
+def test_metrics_path_answers_with_the_token(tmp_path):
+	WorkerMetrics(str(tmp_path)).end("GET /app/item", 0.1)
+	status, headers, body = _scrape(str(tmp_path), "Bearer s3cret")
+	assert status == "200 OK"
+	assert headers["Content-Type"] == CONTENT_TYPE
+	assert b'erpnext_apm_http_requests_total{route="GET /app/item"} 1' in body
+
+
+def test_middleware_serves_the_metrics_path_untraced(make_runtime, tmp_path):
+	from erpnext_apm.wsgi import ElasticAPMWSGI
+
+	runtime = make_runtime(PROMETHEUS=True, PROMETHEUS_DIR=str(tmp_path), PROMETHEUS_TOKEN="s3cret")
+	middleware = ElasticAPMWSGI(lambda environ, start_response: pytest.fail("reached the app"), runtime.config)
+	environ = {"PATH_INFO": "/metrics", "HTTP_AUTHORIZATION": "Bearer s3cret"}
+	setup_testing_defaults(environ)
+	statuses = []
+	body = b"".join(middleware(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+	assert statuses == ["200 OK"]
+	assert b"erpnext_apm_workers 1" in body
@@ -0,0 +1,94 @@
+"""
+Trace propagation: a job enqueued by a traced request continues its trace
+"""
+
+from elasticapm.traces import execution_context
+
+from erpnext_apm import bootstrap, jobs, propagation
+from erpnext_apm.propagation import TRACEPARENT_KEY, _wrap_enqueue, pop_trace_parent
+from tests.intake import flush
+
+TRACEPARENT = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+
+
+def _enqueue(method, *args, **kwargs):
+	return kwargs
+
+
+def test_nothing_is_attached_outside_a_transaction():
+	assert _wrap_enqueue(_enqueue)("erpnext.tasks.run", doc="X") == {"doc": "X"}
+
+
+def test_jobs_run_inline_are_left_alone(make_runtime):
+	runtime = make_runtime()
+	runtime.client.begin_transaction("request")
+	try:
+		kwargs = _wrap_enqueue(_enqueue)("erpnext.tasks.run", now=True)
+	finally:
+		runtime.client.end_transaction("POST /api/method/run", "success")
+	assert TRACEPARENT_KEY not in kwargs
+
+
+def _enqueue_in_request(runtime):
+	runtime.client.begin_transaction("request")
+	try:
+		trace_parent = execution_context.get_transaction().trace_parent.to_string()
+		return trace_parent, _wrap_enqueue(_enqueue)("erpnext.tasks.run", doc="X")
+	finally:
+		runtime.client.end_transaction("POST /api/method/run", "success")
+
+
+def test_jobs_of_sites_with_the_app_carry_the_traceparent(make_runtime, monkeypatch):
+	monkeypatch.setattr(propagation, "_site_pops_trace_parent", lambda: True)
+	trace_parent, kwargs = _enqueue_in_request(make_runtime())
+	assert kwargs == {"doc": "X", TRACEPARENT_KEY: trace_parent}
+
+
+def test_jobs_of_sites_without_the_app_are_left_alone(make_runtime, monkeypatch):
+	# Their before_job does not run, so the key would reach the job method
+	monkeypatch.setattr(propagation, "_site_pops_trace_parent", lambda: False)
+	_trace_parent, kwargs = _enqueue_in_request(make_runtime())
+	assert kwargs == {"doc": "X"}
+
+
+def test_jobs_are_left_alone_when_the_site_cannot_be_checked(make_runtime, monkeypatch):
+	def fail():
+		raise RuntimeError("no site connected")
+
+	monkeypatch.setattr(propagation, "_site_pops_trace_parent", fail)
+	_trace_parent, kwargs = _enqueue_in_request(make_runtime())
+	assert kwargs == {"doc": "X"}
+
+
+def test_pop_trace_parent():
+	kwargs = {TRACEPARENT_KEY: TRACEPARENT, "doc": "X"}
+	trace_parent = pop_trace_parent(kwargs)
+	assert kwargs == {"doc": "X"}
+	assert trace_parent.trace_id == "0af7651916cd43dd8448eb211c80319c"
+	assert trace_parent.span_id == "b7ad6b7169203331"
+
+	kwargs = {TRACEPARENT_KEY: "not a traceparent"}
+	assert pop_trace_parent(kwargs) is None
+	assert kwargs == {}
+	assert pop_trace_parent(None) is None
+
+
+def test_job_continues_the_trace_of_the_request(make_runtime, intake, monkeypatch):
+	monkeypatch.setattr(bootstrap, "_setup_done", True)
+	monkeypatch.setattr(bootstrap, "_active", True)
+	runtime = make_runtime(role="worker")
+
+	runtime.client.begin_transaction("request")
+	trace_parent = execution_context.get_transaction().trace_parent.to_string()
+	runtime.client.end_transaction("POST /api/method/erpnext.submit", "success")
+
+	kwargs = {TRACEPARENT_KEY: trace_parent, "name": "SINV-0001"}
+	jobs.before_job(method="erpnext.accounts.repost", kwargs=kwargs)
+	# The job method never sees the key
+	assert kwargs == {"name": "SINV-0001"}
+	jobs.after_job(method="erpnext.accounts.repost", kwargs=kwargs)
+	flush(runtime)
+
+	request, job = sorted(intake.wait_for("transaction", 2), key=lambda transaction: transaction["type"] == "job")
+	assert job["trace_id"] == request["trace_id"]
+	assert job["parent_id"] == request["id"]
@@ -0,0 +1,114 @@
+"""
+Request queueing time: parsing the front proxy's stamp, and what the
+middleware does with it on a real request
+"""
+
+import time
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from erpnext_apm.queueing import parse_request_start, queue_time, request_start
+from tests.intake import flush
+
+WAITED = 0.25
+
+
+def test_parse_request_start_units():
+	"""The unit of the stamp is told from its magnitude"""
+	assert parse_request_start("1700000000.123") == pytest.approx(1700000000.123)
+	assert parse_request_start("t=1700000000.123") == pytest.approx(1700000000.123)
+	assert parse_request_start("1700000000123") == pytest.approx(1700000000.123)
+	assert parse_request_start("t=1700000000123456") == pytest.approx(1700000000.123456)
+	assert parse_request_start("1700000000123456789") == pytest.approx(1700000000.123456789)
+	assert parse_request_start(" t=abc ") is None
+
+
+def test_request_start_prefers_x_request_start():
+	environ = {"HTTP_X_QUEUE_START": "t=1700000001", "HTTP_X_REQUEST_START": "t=1700000000"}
+	assert request_start(environ) == 1700000000
+	assert request_start({"HTTP_X_QUEUE_START": "1700000001"}) == 1700000001
+	assert request_start({}) is None
+
+
+def test_queue_time_rejects_implausible_stamps():
+	now = 1700000000.0
+	assert queue_time(now - 0.5, now) == pytest.approx(0.5)
+	# Small skew into the future counts as no wait, large skew as a bad stamp
+	assert queue_time(now + 0.5, now) == 0.0
+	assert queue_time(now + 5, now) is None
+	assert queue_time(now - 7200, now) is None
+	assert queue_time(None, now) is None
+
+
+def _app(environ, start_response):
+	start_response("200 OK", [("Content-Type", "text/plain")])
+	return [b"pong"]
+
+
+def _call(middleware, stamp=None):
+	environ = {"PATH_INFO": "/api/method/ping", "REQUEST_METHOD": "GET"}
+	setup_testing_defaults(environ)
+	if stamp is not None:
+		environ["HTTP_X_REQUEST_START"] = stamp
+	body = b"".join(middleware(environ, lambda status, headers, exc_info=None: None))
+	assert body == b"pong"
+
+
+def _stamp(unit, started):
+	if unit == "s":
+		return f"t={started:.3f}"
+	if unit == "ms":
+		return str(round(started * 1000))
+	return f"t={round(started * 1000000)}"
+
+
+@pytest.mark.parametrize("unit", ["s", "ms", "us"])
+def test_stamped_request_records_queue_time(make_runtime, intake, unit):
+	from erpnext_apm.wsgi import ElasticAPMWSGI
+
+	runtime = make_runtime(QUEUE_TIME=True)
+	middleware = ElasticAPMWSGI(_app, runtime.config)
+	started = time.time() - WAITED
+	_call(middleware, _stamp(unit, started))
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert transaction["name"] == "GET /api/method/ping"
+	assert transaction["context"]["tags"]["queue_time_ms"] == pytest.approx(WAITED * 1000, abs=100)
+	# The transaction starts at the proxy's stamp
+	assert transaction["timestamp"] / 1000000 == pytest.approx(started, abs=0.01)
+
+	(span,) = [span for span in intake.events("span") if span["name"] == "request queue"]
+	assert span["subtype"] == "queue"
+	assert span["duration"] == pytest.approx(WAITED * 1000, abs=100)
+
+	histogram = runtime.queue_time.histogram
+	assert sum(histogram.collect()) == 1
+
+
+def test_unstamped_request_has_no_queue_time(make_runtime, intake):
+	from erpnext_apm.wsgi import ElasticAPMWSGI
+
+	runtime = make_runtime(QUEUE_TIME=True)
+	_call(ElasticAPMWSGI(_app, runtime.config))
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert "queue_time_ms" not in transaction["context"].get("tags", {})
+	assert not [span for span in intake.events("span") if span["name"] == "request queue"]
+
+
+def test_queue_time_off_ignores_the_stamp(make_runtime, intake):
+	from erpnext_apm.wsgi import ElasticAPMWSGI
+
+	runtime = make_runtime(QUEUE_TIME=False)
+	assert runtime.queue_time is None
+	before = time.time()
+	_call(ElasticAPMWSGI(_app, runtime.config), _stamp("s", before - WAITED))
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert "queue_time_ms" not in transaction["context"].get("tags", {})
+	assert transaction["timestamp"] / 1000000 >= before - 0.001
+	assert not [span for span in intake.events("span") if span["name"] == "request queue"]
@@ -0,0 +1,75 @@
+"""
+Request context capture of ElasticAPMWSGI: lazy from allowlists, eager or off
+"""
+
+from wsgiref.util import setup_testing_defaults
+
+from erpnext_apm.wsgi import ElasticAPMWSGI, _resolve_header_keys
+from tests.intake import flush
+
+
+def _app(environ, start_response):
+	start_response("200 OK", [("Content-Type", "application/json")])
+	return [b"{}"]
+
+
+def _environ():
+	environ = {
+		"PATH_INFO": "/api/resource/Item/ITEM-0001",
+		"REQUEST_METHOD": "GET",
+		"HTTP_USER_AGENT": "pytest",
+		"HTTP_COOKIE": "sid=secret",
+		"HTTP_AUTHORIZATION": "token abc:def",
+		"HTTP_X_FRAPPE_SITE_NAME": "erp.example.com",
+		"CONTENT_TYPE": "application/json",
+	}
+	setup_testing_defaults(environ)
+	return environ
+
+
+def test_header_keys_are_resolved_to_environ_keys():
+	keys = _resolve_header_keys(("User-Agent", "Content-Type", "X-Frappe-Site-Name"))
+	assert keys == (
+		("HTTP_USER_AGENT", "User-Agent"),
+		("CONTENT_TYPE", "Content-Type"),
+		("HTTP_X_FRAPPE_SITE_NAME", "X-Frappe-Site-Name"),
+	)
+
+
+def test_lazy_context_only_has_allowlisted_keys():
+	middleware = ElasticAPMWSGI(_app, {"CAPTURE_HEADERS": ("User-Agent", "Cookie"), "CAPTURE_ENVIRON": ("REMOTE_ADDR",)})
+	environ = _environ()
+	environ["REMOTE_ADDR"] = "10.0.0.7"
+
+	context = middleware._build_request_context(environ)
+	assert context["method"] == "GET"
+	assert context["headers"] == {"User-Agent": "pytest", "Cookie": "sid=secret"}
+	assert context["env"] == {"REMOTE_ADDR": "10.0.0.7"}
+	assert context["url"]["pathname"] == "/api/resource/Item/ITEM-0001"
+
+
+def _request_context(intake, runtime, capture_context):
+	middleware = ElasticAPMWSGI(_app, dict(runtime.config, CAPTURE_CONTEXT=capture_context))
+	b"".join(middleware(_environ(), lambda status, headers, exc_info=None: None))
+	flush(runtime)
+	(transaction,) = intake.wait_for("transaction")
+	return transaction["context"].get("request")
+
+
+def test_sent_transaction_carries_lazy_context(make_runtime, intake):
+	request = _request_context(intake, make_runtime(), "lazy")
+	assert request["headers"]["User-Agent"] == "pytest"
+	assert request["headers"]["X-Frappe-Site-Name"] == "erp.example.com"
+	# Not on the default allowlist
+	assert "Cookie" not in request["headers"] and "cookies" not in request
+	assert "Authorization" not in request["headers"]
+
+
+def test_eager_context_copies_every_header(make_runtime, intake):
+	request = _request_context(intake, make_runtime(), "eager")
+	assert request["headers"]["user-agent"] == "pytest"
+	assert "authorization" in request["headers"]
+
+
+def test_context_off_sends_none(make_runtime, intake):
+	assert _request_context(intake, make_runtime(), "off") is None
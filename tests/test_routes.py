@@ -0,0 +1,73 @@
+"""
+Route templates for transaction names, and the cap on distinct names
+"""
+
+import pytest
+
+from erpnext_apm.routes import OVERFLOW_TEMPLATE, RouteNormalizer, normalize_path
+
+
+@pytest.mark.parametrize(
+	"path, template",
+	[
+		("/", "/"),
+		("/api/resource/Sales Invoice/SINV-00123", "/api/resource/Sales Invoice/<name>"),
+		("/api/resource/Sales Invoice", "/api/resource/Sales Invoice"),
+		("/api/method/frappe.client.get_list", "/api/method/frappe.client.get_list"),
+		("/api/method/frappe.client.get_list/extra", "/api/method/frappe.client.get_list"),
+		("/api/v2/document/Item/ITEM-42", "/api/v2/document/Item/<name>"),
+		("/api/v2/document/Item/ITEM-42/submit", "/api/v2/document/Item/<name>/<method>"),
+		("/api/v2/method/Item/ping", "/api/v2/method/Item/ping"),
+		("/app/item/ITEM-42", "/app/item/<name>"),
+		("/app/item", "/app/item"),
+		("/desk/todo/abc123", "/desk/todo/<name>"),
+		("/assets/frappe/dist/js/desk.bundle.js", "/assets/*"),
+		("/files/invoice.pdf", "/files/*"),
+		("/private/files/payslip.pdf", "/private/files/*"),
+		("/orders/12345/lines/7", "/orders/<id>/lines/<id>"),
+		("/blog/hello-world", "/blog/hello-world"),
+		("/track/0123456789abcdef", "/track/<id>"),
+		# Incomplete and odd paths
+		("//app//item//ITEM-42/", "/app/item/<name>"),
+		("/api", "/api"),
+		("/api/method", "/api/method"),
+		("/api/resource/Item/ITEM-42/extra", "/api/resource/Item/<name>"),
+		("/api/v2/document/Item", "/api/v2/document/Item"),
+		("/api/unknown/123", "/api/unknown/<id>"),
+		("/private/backups/db.sql.gz", "/private/backups/db.sql.gz"),
+	],
+)
+def test_normalize_path(path, template):
+	assert normalize_path(path) == template
+
+
+def test_normalizer_memoizes_paths_and_caps_names():
+	routes = RouteNormalizer(cache_size=2, max_names=2)
+	assert routes.normalize("/app/item/A-1") == "/app/item/<name>"
+	assert routes.normalize("/app/item/B-2") == "/app/item/<name>"
+	assert routes.normalize("/app/todo/T-1") == "/app/todo/<name>"
+	# A third template goes over the cap
+	assert routes.normalize("/app/user/U-1") == OVERFLOW_TEMPLATE
+	# Templates seen before the cap was reached keep working
+	assert routes.normalize("/app/item/C-3") == "/app/item/<name>"
+
+	stats = routes.stats()
+	assert stats == {"cached_paths": 2, "distinct_names": 2, "overflowed": 1}
+
+
+def test_least_recently_used_paths_are_evicted():
+	routes = RouteNormalizer(cache_size=2)
+	routes.normalize("/app/item/A-1")
+	routes.normalize("/app/item/B-2")
+	routes.normalize("/app/item/A-1")
+	routes.normalize("/app/item/C-3")
+	assert list(routes._cache) == ["/app/item/A-1", "/app/item/C-3"]
+
+
+def test_paths_over_the_cap_are_counted_once_per_path():
+	routes = RouteNormalizer(max_names=1)
+	routes.normalize("/app/item/A-1")
+	for _ in range(3):
+		assert routes.normalize("/app/user/U-1") == OVERFLOW_TEMPLATE
+	assert routes.normalize("/app/todo/T-1") == OVERFLOW_TEMPLATE
+	assert routes.stats()["overflowed"] == 2
@@ -0,0 +1,118 @@
+"""
+Head sampling: per-route rates, the token bucket budget and the keep rule
+for unsampled errors and slow requests
+"""
+
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from erpnext_apm import sampling
+from erpnext_apm.sampling import Sampler, TokenBucket
+from tests.intake import flush
+
+
+class FakeClock:
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	clock = FakeClock()
+	monkeypatch.setattr(sampling.time, "monotonic", clock)
+	return clock
+
+
+def test_token_bucket_burst_and_refill(clock):
+	bucket = TokenBucket(rate=2, burst=3)
+	assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+	clock.now += 0.5
+	assert bucket.take()
+	assert not bucket.take()
+
+	# Refills never go past the burst
+	clock.now += 60
+	assert sum(bucket.take() for _ in range(10)) == 3
+
+
+def test_token_bucket_without_rate_is_unlimited():
+	bucket = TokenBucket(rate=0)
+	assert all(bucket.take() for _ in range(1000))
+
+
+def test_first_matching_rule_wins():
+	sampler = Sampler(
+		default_rate=0.5,
+		route_rates=(("/assets/*", 0.0), ("/api/method/frappe.*", 0.1), ("/api/method/*", 1.0)),
+	)
+	assert sampler.rate_for("/assets/*") == 0.0
+	assert sampler.rate_for("/api/method/frappe.client.get_list") == 0.1
+	assert sampler.rate_for("/api/method/erpnext.stock.get_item_details") == 1.0
+	assert sampler.rate_for("/app/item/<name>") == 0.5
+	assert sampler._rates["/app/item/<name>"] == 0.5
+
+
+def test_should_sample_spends_the_budget(clock):
+	sampler = Sampler(default_rate=1.0, max_tps=5)
+	decisions = [sampler.should_sample("/app/item/<name>") for _ in range(8)]
+	assert decisions == [True] * 5 + [False] * 3
+
+	sampler = Sampler(default_rate=1.0, route_rates=(("/assets/*", 0.0),), max_tps=5)
+	# Rate 0 routes do not use up the budget
+	assert not any(sampler.should_sample("/assets/*") for _ in range(10))
+	assert sampler.should_sample("/app/item/<name>")
+	assert sampler.stats() == {"sampled": 1, "unsampled": 10, "promoted": 0, "site_throttled": 0, "sites": 0}
+
+
+def test_each_site_has_its_own_budget(clock):
+	sampler = Sampler(default_rate=1.0, max_tps=10, site_max_tps=2)
+	busy = [sampler.should_sample("/app/item/<name>", "busy.example.com") for _ in range(4)]
+	assert busy == [True, True, False, False]
+	# A throttled site leaves the worker's budget to the others
+	assert sampler.should_sample("/app/item/<name>", "quiet.example.com")
+	assert sampler.should_sample("/app/item/<name>")
+	assert sampler.bucket.tokens == 6
+
+	clock.now += 0.5
+	assert sampler.should_sample("/app/item/<name>", "busy.example.com")
+	stats = sampler.stats()
+	assert (stats["site_throttled"], stats["sites"], stats["sampled"]) == (2, 2, 5)
+
+
+def test_keep_reason():
+	sampler = Sampler(slow_threshold_ms=500)
+	assert sampler.keep_reason(200, 0.1) is None
+	assert sampler.keep_reason(503, 0.1) == "error"
+	assert sampler.keep_reason(None, 0.1, failed=True) == "error"
+	assert sampler.keep_reason(404, 0.6) == "slow"
+
+	sampler = Sampler(slow_threshold_ms=0, keep_errors=False)
+	assert sampler.keep_reason(500, 60) is None
+
+
+def _app(environ, start_response):
+	status = "500 Internal Server Error" if environ["PATH_INFO"].endswith("fail") else "200 OK"
+	start_response(status, [])
+	return [b""]
+
+
+def test_unsampled_requests_are_kept_only_when_failing(make_runtime, intake):
+	from erpnext_apm.wsgi import ElasticAPMWSGI
+
+	runtime = make_runtime(SAMPLE_RATE=0, SAMPLE_RATES="")
+	middleware = ElasticAPMWSGI(_app, runtime.config)
+	for path in ("/api/method/ok", "/api/method/fail", "/api/method/ok"):
+		environ = {"PATH_INFO": path}
+		setup_testing_defaults(environ)
+		b"".join(middleware(environ, lambda status, headers, exc_info=None: None))
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert transaction["name"] == "GET /api/method/fail"
+	assert transaction["context"]["tags"]["sampling_reason"] == "error"
+	assert middleware.sampler.stats()["promoted"] == 1
@@ -0,0 +1,84 @@
+"""
+Scheduler ticks: a transaction per tick with site and event spans, and the
+tick metrics
+"""
+
+from erpnext_apm import scheduler
+from tests.intake import flush
+
+
+class FakeJobType:
+	def __init__(self, method, due):
+		self.method = method
+		self.frequency = "Hourly"
+		self.due = due
+
+	def enqueue(self):
+		return self.due
+
+
+FakeJobType.enqueue = scheduler._wrap_job_type_enqueue(FakeJobType.enqueue)
+
+JOB_TYPES = {
+	"site1.local": [FakeJobType("erpnext.stock.reorder_item", True), FakeJobType("frappe.email.pull", False)],
+	"site2.local": [FakeJobType("frappe.deferred_insert.save_to_db", True)],
+}
+
+
+@scheduler._wrap_enqueue_events_for_site
+def enqueue_events_for_site(site):
+	for job_type in JOB_TYPES[site]:
+		job_type.enqueue()
+
+
+@scheduler._wrap_enqueue_events_for_all_sites
+def enqueue_events_for_all_sites():
+	for site in JOB_TYPES:
+		enqueue_events_for_site(site)
+
+
+def _samples(metricset):
+	samples = {}
+	for data in metricset.collect():
+		samples.update({name: sample["value"] for name, sample in data["samples"].items()})
+	return samples
+
+
+def test_outside_a_tick_the_wrappers_only_call_through():
+	assert FakeJobType("frappe.email.pull", True).enqueue()
+	assert enqueue_events_for_site("site2.local") is None
+
+
+def test_tick_is_traced_with_site_and_event_spans(make_runtime, intake):
+	runtime = make_runtime(role="scheduler")
+	enqueue_events_for_all_sites()
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert (transaction["type"], transaction["name"]) == ("scheduler", "scheduler tick")
+	tags = transaction["context"]["tags"]
+	assert (tags["sites"], tags["jobs_enqueued"], tags["overrun"]) == (2, 2, False)
+
+	spans = sorted(span["name"] for span in intake.wait_for("span", 4))
+	assert spans == [
+		"enqueue erpnext.stock.reorder_item",
+		"enqueue frappe.deferred_insert.save_to_db",
+		"site site1.local",
+		"site site2.local",
+	]
+
+	samples = _samples(runtime.scheduler_metrics)
+	assert samples["scheduler.tick.count"] == 1
+	assert samples["scheduler.tick.sites"] == 2
+	assert samples["scheduler.tick.jobs_enqueued"] == 2
+
+
+def test_ticks_longer_than_the_interval_are_overruns(make_runtime):
+	metricset = make_runtime(role="scheduler").scheduler_metrics
+	metricset.record_tick(30, 60, sites=1, jobs_enqueued=0, backlog={"default": 4})
+	metricset.record_tick(75, 60, sites=1, jobs_enqueued=0, backlog={"default": 9})
+
+	samples = _samples(metricset)
+	assert samples["scheduler.tick.count"] == 2
+	assert samples["scheduler.tick.overrun"] == 1
+	assert samples["scheduler.queue.backlog"] == 9
@@ -0,0 +1,67 @@
+"""
+Site resolution: the site of a request taken the way Frappe takes it, and
+the cap on distinct sites
+"""
+
+from wsgiref.util import setup_testing_defaults
+
+import pytest
+
+from erpnext_apm.sites import OVERFLOW_SITE, SiteResolver, site_name
+from tests.intake import flush
+
+
+@pytest.mark.parametrize(
+	"host, site",
+	[
+		("erp.example.com", "erp.example.com"),
+		("erp.example.com:8000", "erp.example.com"),
+		("[::1]:8000", "[::1]"),
+		("[2001:db8::1]", "[2001:db8::1]"),
+	],
+)
+def test_site_name_strips_the_port(host, site):
+	assert site_name(host) == site
+
+
+def test_resolve_follows_frappe():
+	resolver = SiteResolver()
+	# The header is taken as is, port and all
+	assert resolver.resolve({"HTTP_X_FRAPPE_SITE_NAME": "erp.local", "HTTP_HOST": "proxy:8000"}) == "erp.local"
+	assert resolver.resolve({"HTTP_HOST": "erp.example.com:8000", "SERVER_NAME": "localhost"}) == "erp.example.com"
+	assert resolver.resolve({"SERVER_NAME": "localhost"}) == "localhost"
+	assert resolver.resolve({}) is None
+
+
+def test_sites_past_the_cap_are_pooled():
+	resolver = SiteResolver(max_sites=2, cache_size=3)
+	for host in ("a.example.com", "b.example.com:8000", "c.example.com", "d.example.com", "a.example.com"):
+		resolver.resolve({"HTTP_HOST": host})
+
+	assert resolver.resolve({"HTTP_HOST": "b.example.com"}) == "b.example.com"
+	assert resolver.resolve({"HTTP_HOST": "e.example.com"}) == OVERFLOW_SITE
+	assert resolver.stats() == {"cached_hosts": 3, "distinct_sites": 2, "overflowed": 3}
+
+
+def _app(environ, start_response):
+	start_response("200 OK", [])
+	return [b""]
+
+
+def test_requests_are_labelled_and_budgeted_per_site(make_runtime, intake):
+	from erpnext_apm.wsgi import ElasticAPMWSGI
+
+	runtime = make_runtime(SITE_MAX_TPS=1, SAMPLE_RATE=1, SAMPLE_RATES="")
+	middleware = ElasticAPMWSGI(_app, runtime.config)
+	for host in ("a.example.com:8000", "a.example.com:8000", "b.example.com"):
+		environ = {"PATH_INFO": "/api/method/ping", "HTTP_HOST": host}
+		setup_testing_defaults(environ)
+		b"".join(middleware(environ, lambda status, headers, exc_info=None: None))
+	flush(runtime)
+
+	transactions = intake.wait_for("transaction", 2)
+	assert sorted(transaction["context"]["tags"]["site"] for transaction in transactions) == [
+		"a.example.com",
+		"b.example.com",
+	]
+	assert middleware.sampler.stats()["site_throttled"] == 1
@@ -0,0 +1,92 @@
+"""
+Span compression: the agent merges runs of fast database spans with the
+settings passed on from ERPNEXT_APM_SPAN_COMPRESSION*
+"""
+
+import time
+
+import pytest
+
+from erpnext_apm import db, nplusone
+from erpnext_apm.state import end_state, start_state
+from tests.intake import flush
+
+
+class FakeDatabase:
+	# Queries containing one of these take longer than any compression limit used here
+	slow = ()
+
+	def sql(self, query, values=None):
+		if any(value in query for value in self.slow):
+			time.sleep(0.03)
+		return []
+
+
+@pytest.fixture
+def database(monkeypatch):
+	monkeypatch.setattr(nplusone, "_threshold", 0)
+	monkeypatch.setattr(FakeDatabase, "sql", db._wrap_sql(FakeDatabase.sql, "mariadb"))
+	return FakeDatabase()
+
+
+def _loop(runtime, database, intake, count=10, queries=("select qty from `tabBin` where item_code = '{}'",)):
+	runtime.client.begin_transaction("request")
+	start_state()
+	for query in queries:
+		for index in range(count):
+			database.sql(query.format(f"ITEM-{index}"))
+	end_state()
+	runtime.client.end_transaction("GET /app/bin", "success")
+	flush(runtime)
+	intake.wait_for("transaction")
+	return intake.events("span")
+
+
+def test_a_loop_of_queries_becomes_one_composite_span(make_runtime, intake, database):
+	runtime = make_runtime()
+	(span,) = _loop(runtime, database, intake)
+	assert span["name"] == db.fingerprint_sql("select qty from `tabBin` where item_code = 'ITEM-0'", "mariadb")[1]
+	assert span["composite"]["count"] == 10
+	assert span["composite"]["compression_strategy"] == "exact_match"
+	assert span["context"]["db"]["statement"] == "select qty from `tabBin` where item_code = ?"
+
+
+def test_different_queries_on_a_table_are_not_merged(make_runtime, intake, database):
+	runtime = make_runtime()
+	queries = (
+		"select qty from `tabBin` where item_code = '{}'",
+		"select warehouse from `tabBin` where item_code = '{}'",
+	)
+	spans = _loop(runtime, database, intake, count=5, queries=queries)
+	assert sorted(span["context"]["db"]["statement"] for span in spans) == [
+		"select qty from `tabBin` where item_code = ?",
+		"select warehouse from `tabBin` where item_code = ?",
+	]
+	assert [span["composite"]["count"] for span in spans] == [5, 5]
+	assert spans[0]["name"] != spans[1]["name"]
+
+
+def test_same_kind_compression_merges_different_queries(make_runtime, intake, database):
+	runtime = make_runtime(SPAN_COMPRESSION_SAME_KIND_MAX_DURATION_MS=50)
+	# Alternating, so no two neighbours are an exact match
+	queries = ("select qty from `tabBin` where item_code = '{}'", "select name from `tabItem` where name = '{}'") * 3
+	(span,) = _loop(runtime, database, intake, count=1, queries=queries)
+	assert span["composite"]["count"] == 6
+	assert span["composite"]["compression_strategy"] == "same_kind"
+
+
+def test_a_slow_query_is_sent_on_its_own_and_splits_the_run(make_runtime, intake, database):
+	runtime = make_runtime(SPAN_COMPRESSION_MAX_DURATION_MS=20)
+	database.slow = ("'ITEM-5'",)
+	spans = _loop(runtime, database, intake)
+	assert sorted(span["composite"]["count"] for span in spans if "composite" in span) == [4, 5]
+	(slow,) = [span for span in spans if "composite" not in span]
+	assert slow["duration"] >= 30
+
+
+@pytest.mark.parametrize("settings", [{"SPAN_COMPRESSION": False}, {"SPAN_COMPRESSION_MAX_DURATION_MS": 0}])
+def test_spans_are_kept_apart_when_compression_is_off(make_runtime, intake, database, settings):
+	runtime = make_runtime(**settings)
+	spans = _loop(runtime, database, intake)
+	assert len(spans) == 10
+	assert not any("composite" in span for span in spans)
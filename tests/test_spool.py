@@ -0,0 +1,121 @@
+"""
+Disk spool: the ring file across wrap-around and crashes, and replay of
+spooled batches once the APM server is back
+"""
+
+import struct
+import time
+
+import elasticapm
+
+from erpnext_apm.spool import HEADER_SIZE, RingSpool, read_spools
+from tests.intake import flush
+
+# Offset of the tail in the file header
+TAIL_AT = struct.calcsize("<8sHHQQ")
+
+
+def _payload(name, size=20):
+	return name.encode().ljust(size, b".")
+
+
+def test_batches_come_back_in_order_across_the_end_of_the_ring(tmp_path):
+	spool = RingSpool(str(tmp_path / "1.spool"), capacity=64)
+	# 28 bytes per record with its header
+	assert spool.append(_payload("a"))
+	assert spool.append(_payload("b"))
+	offset, payload = spool.peek()
+	spool.commit(offset, payload)
+
+	# Written from offset 56, so it wraps to the start of the ring
+	assert spool.append(_payload("c"))
+	assert spool.peek()[1] == _payload("b")
+	spool.commit(*spool.peek())
+	assert spool.peek()[1] == _payload("c")
+
+	# Full: the oldest batch makes room, a batch larger than the ring is refused
+	assert spool.append(_payload("d"))
+	assert spool.append(_payload("e"))
+	assert not spool.append(_payload("f", size=80))
+	assert spool.peek()[1] == _payload("d")
+	assert spool.stats()["dropped"] == 2
+	spool.close()
+
+
+def _crash(spool):
+	"""Leave the file as a killed worker would: mapped data written, no cleanup"""
+	spool._mm.flush()
+	spool.close(remove_if_empty=False)
+
+
+def test_torn_records_are_skipped_after_a_crash(tmp_path):
+	path = str(tmp_path / "1.spool")
+	spool = RingSpool(path, capacity=256)
+	spool.append(_payload("a"))
+	spool.append(_payload("b"))
+	spool.append(_payload("c"))
+	_crash(spool)
+
+	with open(path, "r+b") as f:
+		# b's payload only half written
+		f.seek(HEADER_SIZE + 28 + 8 + 10)
+		f.write(b"\0" * 10)
+		# c's record cut off by a tail that moved on before it was complete
+		f.seek(TAIL_AT)
+		f.write(struct.pack("<Q", 28 * 2 + 12))
+
+	spool = RingSpool(path)
+	assert spool.batches == 2
+	offset, payload = spool.peek()
+	assert payload == _payload("a")
+	spool.commit(offset, payload)
+	# b fails its checksum and is not replayed
+	assert spool.peek() is None
+	assert spool.stats()["corrupt"] == 1
+	spool.close()
+
+
+def test_read_spools_tells_live_workers_from_exited_ones(tmp_path):
+	live = RingSpool(str(tmp_path / "1.spool"), capacity=128)
+	live.append(_payload("a"))
+	exited = RingSpool(str(tmp_path / "2.spool"), capacity=128)
+	_crash(exited)
+
+	spools = read_spools(str(tmp_path))
+	assert [(spool["live"], spool["bytes_used"]) for spool in spools] == [(True, 28), (False, 0)]
+	live.close()
+
+
+def test_spooled_batches_are_replayed_once_the_breaker_closes(make_runtime, intake, tmp_path):
+	runtime = make_runtime(
+		SPOOL=True,
+		SPOOL_DIR=str(tmp_path / "spool"),
+		SPOOL_REPLAY_RATE=50,
+		BREAKER_FAILURES=1,
+		BREAKER_BACKOFF_MS=100,
+	)
+	spool = runtime.spool.spool
+
+	intake.failing = True
+	runtime.client.begin_transaction("request")
+	elasticapm.label(attempt="spooled")
+	runtime.client.end_transaction("GET /app/item", "success")
+	flush(runtime)
+	assert spool.stats()["appended"] == 1
+	assert runtime.breaker.state == "open"
+
+	# The server is back: the next send is the probe that closes the breaker
+	intake.failing = False
+	time.sleep(0.2)
+	runtime.client.begin_transaction("request")
+	elasticapm.label(attempt="probe")
+	runtime.client.end_transaction("GET /app/item", "success")
+	flush(runtime)
+	assert runtime.breaker.state == "closed"
+
+	transactions = intake.wait_for("transaction", 2)
+	assert sorted(transaction["context"]["tags"]["attempt"] for transaction in transactions) == ["probe", "spooled"]
+	deadline = time.monotonic() + 5
+	while spool.stats()["batches"] and time.monotonic() < deadline:
+		time.sleep(0.02)
+	assert spool.stats()["replayed"] == 1
@@ -0,0 +1,105 @@
+"""
+Tail sampling: buffered spans of head-unsampled requests are sent in order
+when the request turns out slow or failing, and dropped otherwise
+"""
+
+import time
+from wsgiref.util import setup_testing_defaults
+
+import elasticapm
+
+from erpnext_apm.tail_sampling import TailSampler
+from tests.intake import flush
+
+
+def _sampler(**kwargs):
+	sent = []
+	sampler = TailSampler(lambda event_type, data, flush=False: sent.append((event_type, data)), **kwargs)
+	return sampler, sent
+
+
+def _run(sampler, transaction_id, spans, duration, result="success"):
+	sampler.start(transaction_id)
+	for index in range(spans):
+		sampler("span", {"id": f"{transaction_id}-{index}", "transaction_id": transaction_id})
+	keep = sampler.decide(transaction_id, duration, result)
+	sampler("transaction", {"id": transaction_id})
+	sampler.discard(transaction_id)
+	return keep
+
+
+def test_fast_successful_transactions_are_dropped():
+	sampler, sent = _sampler(latency_threshold_ms=100)
+	assert not _run(sampler, "t1", spans=3, duration=0.01)
+	assert sent == []
+	assert sampler.stats() == {"kept": 0, "dropped": 1, "spans_overflowed": 0, "in_flight": 0, "buffered_spans": 0}
+
+
+def test_slow_and_failed_transactions_are_sent_spans_first():
+	sampler, sent = _sampler(latency_threshold_ms=100)
+	assert _run(sampler, "slow", spans=2, duration=0.5)
+	assert _run(sampler, "failed", spans=1, duration=0.01, result="server_error")
+	assert [(event_type, data["id"]) for event_type, data in sent] == [
+		("span", "slow-0"),
+		("span", "slow-1"),
+		("transaction", "slow"),
+		("span", "failed-0"),
+		("transaction", "failed"),
+	]
+	assert sampler.kept == 2
+
+
+def test_keep_rate_keeps_some_ordinary_transactions():
+	sampler, _sent = _sampler(latency_threshold_ms=0, keep_rate=1.0)
+	assert _run(sampler, "t1", spans=0, duration=0.01)
+
+
+def test_span_limits_are_counted_as_dropped_spans():
+	sampler, sent = _sampler(latency_threshold_ms=100, max_spans=2)
+	_run(sampler, "t1", spans=5, duration=1.0)
+	transaction = sent[-1][1]
+	assert len(sent) == 3
+	assert transaction["span_count"]["dropped"] == 3
+
+	sampler, sent = _sampler(latency_threshold_ms=100, max_spans=10, max_buffered_spans=3)
+	sampler.start("a")
+	sampler.start("b")
+	for index in range(2):
+		sampler("span", {"id": index, "transaction_id": "a"})
+		sampler("span", {"id": index, "transaction_id": "b"})
+	# The worker-wide limit is shared by both transactions
+	assert sampler.stats()["buffered_spans"] == 3
+	assert sampler.spans_overflowed == 1
+
+
+def test_events_of_other_transactions_pass_through():
+	sampler, sent = _sampler()
+	sampler("span", {"id": "s", "transaction_id": "not-buffered"})
+	sampler("metricset", {"samples": {}})
+	assert [event_type for event_type, _data in sent] == ["span", "metricset"]
+
+
+def _app(environ, start_response):
+	with elasticapm.capture_span("load report", span_type="app"):
+		if environ["PATH_INFO"].endswith("slow"):
+			time.sleep(0.1)
+	start_response("200 OK", [])
+	return [b""]
+
+
+def test_middleware_sends_only_the_slow_request(make_runtime, intake):
+	from erpnext_apm.wsgi import ElasticAPMWSGI
+
+	runtime = make_runtime(TAIL_SAMPLING=True, SAMPLE_RATE=0, SAMPLE_RATES="", SLOW_THRESHOLD_MS=50)
+	middleware = ElasticAPMWSGI(_app, runtime.config)
+	for path in ("/api/method/fast", "/api/method/slow", "/api/method/fast"):
+		environ = {"PATH_INFO": path}
+		setup_testing_defaults(environ)
+		b"".join(middleware(environ, lambda status, headers, exc_info=None: None))
+	flush(runtime)
+
+	(transaction,) = intake.wait_for("transaction")
+	assert transaction["name"] == "GET /api/method/slow"
+	(span,) = [span for span in intake.events("span") if span["name"] == "load report"]
+	assert span["transaction_id"] == transaction["id"]
+	assert runtime.tail.stats()["dropped"] == 2
@@ -0,0 +1,137 @@
+"""
+Watchdog: requests running past each threshold are reported once, with the
+stack their thread is in, in the request's own trace
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import elasticapm
+
+from erpnext_apm.breaker import CircuitBreaker
+from erpnext_apm.watchdog import TRANSACTION_TYPE, Watchdog, install_watchdog
+from tests.intake import flush
+
+NAME = "POST /api/method/erpnext.accounts.utils.reconcile"
+
+
+def _stuck(release):
+	release.wait(10)
+
+
+def _request(client, watchdog, registered, release):
+	transaction = client.begin_transaction("request")
+	elasticapm.set_transaction_name(NAME)
+	watchdog.register(NAME, transaction)
+	registered.set()
+	try:
+		_stuck(release)
+	finally:
+		watchdog.unregister()
+		client.end_transaction(NAME, "HTTP 2xx")
+
+
+def test_each_threshold_is_reported_once_with_the_request_stack(make_runtime, intake):
+	runtime = make_runtime()
+	watchdog = Watchdog(runtime.client, thresholds_ms=(400, 50), pipeline=runtime.pipeline)
+	registered, release = threading.Event(), threading.Event()
+	thread = threading.Thread(target=_request, args=(runtime.client, watchdog, registered, release))
+	thread.start()
+	registered.wait(5)
+	try:
+		watchdog.check()
+		assert watchdog.reported == 0
+
+		time.sleep(0.1)
+		watchdog.check()
+		watchdog.check()
+		assert watchdog.reported == 1
+
+		time.sleep(0.35)
+		watchdog.check()
+		assert watchdog.reported == 2
+	finally:
+		release.set()
+		thread.join()
+	watchdog.check()
+	flush(runtime)
+
+	transactions = intake.wait_for("transaction", 3)
+	(request,) = [transaction for transaction in transactions if transaction["type"] == "request"]
+	stuck = [transaction for transaction in transactions if transaction["type"] == TRANSACTION_TYPE]
+	assert len(stuck) == 2
+	for report in stuck:
+		assert (report["name"], report["result"]) == (NAME, "stuck")
+		assert report["trace_id"] == request["trace_id"]
+		assert report["parent_id"] == request["id"]
+	assert sorted(report["context"]["tags"]["watchdog_threshold_ms"] for report in stuck) == [50, 400]
+
+	errors = intake.wait_for("error", 2)
+	assert len(errors) == 2
+	exception = errors[0]["exception"]
+	assert exception["type"] == "RequestStuck"
+	assert "_stuck" in [frame["function"] for frame in exception["stacktrace"]]
+
+
+def test_requests_that_end_in_time_are_not_reported(make_runtime):
+	runtime = make_runtime()
+	watchdog = Watchdog(runtime.client, thresholds_ms=(50,))
+	watchdog.register(NAME)
+	watchdog.unregister()
+	time.sleep(0.06)
+	watchdog.check()
+	assert watchdog.stats() == {"thresholds_s": [0.05], "in_flight": 0, "reported": 0}
+
+
+@contextmanager
+def _in_flight(runtime, watchdog):
+	"""A request held in _stuck on another thread until the block ends"""
+	registered, release = threading.Event(), threading.Event()
+	thread = threading.Thread(target=_request, args=(runtime.client, watchdog, registered, release))
+	thread.start()
+	registered.wait(5)
+	try:
+		yield
+	finally:
+		release.set()
+		thread.join()
+
+
+def test_thresholds_crossed_between_two_checks_are_reported_once(make_runtime, intake):
+	runtime = make_runtime()
+	watchdog = Watchdog(runtime.client, thresholds_ms=(50, 100), pipeline=runtime.pipeline)
+	with _in_flight(runtime, watchdog):
+		time.sleep(0.15)
+		watchdog.check()
+		watchdog.check()
+	assert watchdog.reported == 1
+	flush(runtime)
+
+	(stuck,) = [t for t in intake.wait_for("transaction", 2) if t["type"] == TRANSACTION_TYPE]
+	assert stuck["context"]["tags"]["watchdog_threshold_ms"] == 100
+
+
+def test_reports_are_shed_while_the_breaker_is_open(make_runtime, intake):
+	runtime = make_runtime()
+	breaker = CircuitBreaker(failure_threshold=1)
+	breaker.record_failure()
+	watchdog = Watchdog(runtime.client, thresholds_ms=(50,), breaker=breaker, pipeline=runtime.pipeline)
+	with _in_flight(runtime, watchdog):
+		time.sleep(0.06)
+		watchdog.check()
+	flush(runtime)
+
+	assert watchdog.reported == 0
+	assert breaker.shed == 1
+	assert [t["type"] for t in intake.wait_for("transaction")] == ["request"]
+	assert intake.events("error") == []
+
+
+def test_thresholds_are_sorted_and_non_positive_ones_dropped(make_runtime):
+	runtime = make_runtime()
+	assert Watchdog(runtime.client, thresholds_ms=(500, 0, -1, 100)).thresholds == (0.1, 0.5)
+
+	# Nothing to watch for, so no thread either
+	runtime.config["WATCHDOG_THRESHOLDS_MS"] = (0,)
+	assert install_watchdog(runtime) is None